@@ -2,8 +2,10 @@ import six
 from smtplib import SMTPException
 
 from adjutant.api.v1.utils import create_notification
+from adjutant.common import dependencies
+from adjutant.exceptions import DependencyUnavailable
 
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.template import loader
 from django.conf import settings
 
@@ -86,10 +88,15 @@ def send_email(to_addresses, context, conf, task):
             email.attach_alternative(
                 html_template.render(context), "text/html")
 
-        email.send(fail_silently=False)
+        with dependencies.track('smtp', 'send'), \
+                dependencies.get_breaker('smtp').guard(), \
+                dependencies.within_deadline(
+                    'smtp', settings.EMAIL_TIMEOUT) as timeout:
+            email.connection = get_connection(timeout=timeout)
+            email.send(fail_silently=False)
         return True
 
-    except SMTPException as e:
+    except (SMTPException, DependencyUnavailable) as e:
         notes = {
             'errors':
                 ("Error: '%s' while sending additional email for task: %s"
@@ -154,14 +154,20 @@ class BaseAction(object):
             return settings.DEFAULT_ACTION_SETTINGS.get(
                 self.__class__.__name__, {})
 
+    # NOTE: Each stage runs inside an identity request cache, so repeated
+    # Keystone reads across the validation steps are only made once.
+    # Inside an API request this is the request's own cache.
     def pre_approve(self):
-        return self._pre_approve()
+        with user_store.request_cache():
+            return self._pre_approve()
 
     def post_approve(self):
-        return self._post_approve()
+        with user_store.request_cache():
+            return self._post_approve()
 
     def submit(self, token_data):
-        return self._submit(token_data)
+        with user_store.request_cache():
+            return self._submit(token_data)
 
     def _pre_approve(self):
         raise NotImplementedError
@@ -246,7 +252,8 @@ class UserMixin(ResourceMixin):
     def _validate_username_exists(self):
         id_manager = user_store.IdentityManager()
 
-        self.user = id_manager.find_user(self.username, self.domain.id)
+        self.user = id_manager.find_user(
+            self.username, self.domain.id, use_filter=True)
         if not self.user:
             self.add_note('No user present with username')
             return False
@@ -287,33 +294,68 @@ class UserMixin(ResourceMixin):
         return self._user_roles_edit(
             user, roles, project_id, remove=True, inherited=inherited)
 
+    def bulk_grant_roles(self, edits):
+        """
+        Grants the roles of several (user, roles, project_id, inherited)
+        edits in one go.
+        """
+        return self._user_roles_bulk_edit(edits, remove=False)
+
     # Helper function to add or remove roles
     def _user_roles_edit(self, user, roles, project_id, remove=False,
                          inherited=False):
+        return self._user_roles_bulk_edit(
+            [(user, roles, project_id, inherited)], remove=remove)
+
+    def _user_roles_bulk_edit(self, edits, remove=False):
         id_manager = user_store.IdentityManager()
         if not remove:
-            action_fn = id_manager.add_user_role
+            action_fn = id_manager.add_user_roles
             action_string = "granting"
         else:
-            action_fn = id_manager.remove_user_role
+            action_fn = id_manager.remove_user_roles
             action_string = "removing"
-        ks_roles = []
+        assignments = []
         try:
-            for role in roles:
-                ks_role = id_manager.find_role(role)
-                if ks_role:
-                    ks_roles.append(ks_role)
-                else:
-                    raise TypeError("Keystone missing role: %s" % role)
-
-            for role in ks_roles:
-                action_fn(user, role, project_id, inherited=inherited)
+            for user, roles, project_id, inherited in edits:
+                for role in roles:
+                    ks_role = id_manager.find_role(role)
+                    if ks_role:
+                        assignments.append(
+                            (user, ks_role, project_id, inherited))
+                    else:
+                        raise TypeError("Keystone missing role: %s" % role)
         except Exception as e:
             self.add_note(
                 "Error: '%s' while %s the roles: %s on user: %s " %
                 (e, action_string, roles, user))
             raise
 
+        # NOTE: the calls are made concurrently, so every failure is
+        # noted before raising the first.
+        errors = []
+        changed_projects = set()
+        results = action_fn(assignments)
+        for (user, role, project_id, inherited), error in zip(
+                assignments, results):
+            if error is not None:
+                self.add_note(
+                    "Error: '%s' while %s the roles: %s on user: %s " %
+                    (error, action_string, [role.name], user))
+                errors.append(error)
+            else:
+                # inherited roles show up in the subtree's listings too
+                changed_projects.add(
+                    None if inherited
+                    else getattr(project_id, 'id', project_id))
+        if None in changed_projects:
+            # covers every project
+            changed_projects = set([None])
+        for project_id in changed_projects:
+            user_store.membership_cache.bump(project_id)
+        if errors:
+            raise errors[0]
+
     def enable_user(self, user=None):
         id_manager = user_store.IdentityManager()
         try:
@@ -396,7 +438,7 @@ class ProjectMixin(ResourceMixin):
     def _validate_project_absent(self):
         id_manager = user_store.IdentityManager()
         project = id_manager.find_project(
-            self.project_name, self.domain_id)
+            self.project_name, self.domain_id, fresh=True)
         if project:
             self.add_note("Existing project with name '%s'." %
                           self.project_name)
@@ -16,7 +16,7 @@ from django.conf import settings
 import paramiko
 
 from adjutant.actions.v1 import (base, misc, projects, users)
-from adjutant.common import user_store
+from adjutant.common import dependencies, user_store
 from adjutant.actions.utils import validate_steps
 
 
@@ -56,20 +56,29 @@ class MailingListSubscribeAction(base.BaseAction):
             self.settings['private_key'])
         client = paramiko.client.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(hostname=self.settings['host'],
-                       port=self.settings['port'],
-                       username=self.settings['user'],
-                       pkey=key)
 
-        stdin, stdout, stderr = client.exec_command(command)
-
-        errors = stderr.read()
-        if errors:
-            self.add_note('Error executing mailman command, check logs.')
-            raise ConnectionError(errors)
-
-        # Note(knikolla): Not entirely sure if closing before reading is fine.
-        r = stdout.read().decode('utf-8').split('\n')
+        with dependencies.track('mailman', 'ssh'), \
+                dependencies.get_breaker('mailman').guard(
+                    failures=paramiko.SSHException), \
+                dependencies.within_deadline('mailman') as timeout:
+            client.connect(hostname=self.settings['host'],
+                           port=self.settings['port'],
+                           username=self.settings['user'],
+                           pkey=key, timeout=timeout,
+                           banner_timeout=timeout, auth_timeout=timeout)
+
+            stdin, stdout, stderr = client.exec_command(
+                command, timeout=timeout)
+
+            errors = stderr.read()
+            if errors:
+                self.add_note(
+                    'Error executing mailman command, check logs.')
+                raise ConnectionError(errors)
+
+            # Note(knikolla): Not entirely sure if closing before reading
+            # is fine.
+            r = stdout.read().decode('utf-8').split('\n')
         client.close()
         return r
 
@@ -168,8 +177,9 @@ class MocNewUserAction(users.NewUserAction):
             )
         else:
             self.roles = list(missing)
-            self.grant_roles(user['id'], self.roles, self.project_id)
-            self.grant_roles(user['id'], self.inherited_roles, self.project_id, True)
+            self.bulk_grant_roles([
+                (user['id'], self.roles, self.project_id, False),
+                (user['id'], self.inherited_roles, self.project_id, True)])
 
             self.add_note(
                 'Accepted by %s. User added with roles %s on project %s.'
@@ -149,7 +149,8 @@ class NewProjectWithUserAction(UserNameAction, ProjectMixin, UserMixin):
 
     def _validate_user(self):
         id_manager = user_store.IdentityManager()
-        user = id_manager.find_user(self.username, self.domain_id)
+        # NOTE: a fresh lookup, as a missing user is created
+        user = id_manager.find_user(self.username, self.domain_id, fresh=True)
 
         if not user:
             self.add_note(
@@ -455,10 +456,12 @@ class AddDefaultUsersToProjectAction(BaseAction, ProjectMixin, UserMixin):
 
         if self.valid and not self.action.state == "completed":
             try:
-                for user in self.users:
-                    ks_user = id_manager.find_user(user, self.domain_id)
-
-                    self.grant_roles(ks_user, self.roles, self.project_id)
+                ks_users = [id_manager.find_user(user, self.domain_id)
+                            for user in self.users]
+                self.bulk_grant_roles([
+                    (ks_user, self.roles, self.project_id, False)
+                    for ks_user in ks_users])
+                for ks_user in ks_users:
                     self.add_note(
                         'User: "%s" given roles: %s on project: %s.' %
                         (ks_user.name, self.roles, self.project_id))
@@ -20,6 +20,7 @@ from adjutant.actions.v1.users import (
     EditUserRolesAction, NewUserAction, ResetUserPasswordAction,
     UpdateUserEmailAction)
 from adjutant.api.models import Task
+from adjutant.common import user_store
 from adjutant.common.tests import fake_clients
 from adjutant.common.tests.fake_clients import setup_identity_cache
 from adjutant.common.tests.utils import modify_dict_settings, AdjutantTestCase
@@ -538,6 +539,62 @@ class UserActionTests(AdjutantTestCase):
         roles = fake_client._get_roles_as_names(user, project)
         self.assertEqual(sorted(roles), sorted(['_member_', 'project_mod']))
 
+    def edit_roles_action(self, roles, inherited_roles):
+        project = fake_clients.FakeProject(name="test_project")
+        user = fake_clients.FakeUser(
+            name="test@example.com", password="123", email="test@example.com")
+        setup_identity_cache(projects=[project], users=[user])
+
+        task = Task.objects.create(
+            ip_address="0.0.0.0",
+            keystone_user={
+                'roles': ['admin', 'project_mod'],
+                'project_id': project.id,
+                'project_domain_id': 'default',
+            })
+        data = {
+            'domain_id': 'default',
+            'user_id': user.id,
+            'project_id': project.id,
+            'roles': roles,
+            'inherited_roles': inherited_roles,
+            'remove': False
+        }
+        action = EditUserRolesAction(data, task=task, order=1)
+        action.pre_approve()
+        action.post_approve()
+        self.assertEqual(action.valid, True)
+        return action, project
+
+    def test_edit_user_roles_bumps_listings_once(self):
+        """
+        The project's user listings are invalidated once per edit, or
+        every project's once if a role is inherited.
+        """
+        action, project = self.edit_roles_action(
+            ['_member_', 'project_mod'], [])
+        with mock.patch.object(
+                user_store.membership_cache, 'bump') as bump:
+            action.submit({})
+        bump.assert_called_once_with(project.id)
+
+        action, project = self.edit_roles_action(
+            ['_member_'], ['project_mod'])
+        with mock.patch.object(
+                user_store.membership_cache, 'bump') as bump:
+            action.submit({})
+        bump.assert_called_once_with(None)
+
+    def test_edit_user_roles_failed_not_bumped(self):
+        action, project = self.edit_roles_action(['_member_'], [])
+        with mock.patch.object(
+                user_store.membership_cache, 'bump') as bump, \
+                mock.patch.object(
+                    fake_clients.FakeManager, 'add_user_roles',
+                    return_value=[ValueError("failed")]):
+            self.assertRaises(ValueError, action.submit, {})
+        bump.assert_not_called()
+
     def test_edit_user_roles_add_complete(self):
         """
         Add roles to existing user.
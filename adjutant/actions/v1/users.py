@@ -43,7 +43,8 @@ class NewUserAction(UserNameAction, ProjectMixin, UserMixin):
 
         # check if user exists and is valid
         # this may mean we need a token.
-        user = self._get_target_user()
+        # NOTE: a fresh lookup, as a missing user is created
+        user = id_manager.find_user(self.username, self.domain_id, fresh=True)
         if not user:
             self.add_note(
                 "No user present with username '%s'. "
@@ -130,8 +131,9 @@ class NewUserAction(UserNameAction, ProjectMixin, UserMixin):
         if self.action.state == "default":
             # default action: Create a new user in the tenant and add roles
             user = self.create_user(token_data['password'])
-            self.grant_roles(user, self.roles, self.project_id)
-            self.grant_roles(user, self.inherited_roles, self.project_id, True)
+            self.bulk_grant_roles([
+                (user, self.roles, self.project_id, False),
+                (user, self.inherited_roles, self.project_id, True)])
 
             self.add_note(
                 'User %s has been created, with roles %s in project %s.'
@@ -141,8 +143,9 @@ class NewUserAction(UserNameAction, ProjectMixin, UserMixin):
             # first re-enable user
             user = self.find_user()
             self.enable_user(user)
-            self.grant_roles(user, self.roles, self.project_id)
-            self.grant_roles(user, self.inherited_roles, self.project_id, True)
+            self.bulk_grant_roles([
+                (user, self.roles, self.project_id, False),
+                (user, self.inherited_roles, self.project_id, True)])
             self.update_password(token_data['password'])
 
             self.add_note('User %s password has been changed.' % self.username)
@@ -155,8 +158,9 @@ class NewUserAction(UserNameAction, ProjectMixin, UserMixin):
         elif self.action.state == "existing":
             # Existing action: only add roles.
             user = self.find_user()
-            self.grant_roles(user, self.roles, self.project_id)
-            self.grant_roles(user, self.inherited_roles, self.project_id, True)
+            self.bulk_grant_roles([
+                (user, self.roles, self.project_id, False),
+                (user, self.inherited_roles, self.project_id, True)])
 
             self.add_note(
                 'Existing user %s has been given roles %s in project %s.'
@@ -271,9 +275,8 @@ class EditUserRolesAction(UserIdAction, ProjectMixin, UserMixin):
         user = self._get_target_user()
         project = id_manager.get_project(self.project_id)
         # user roles
-        current_roles = id_manager.get_roles(user, project)
-        current_inherited_roles = id_manager.get_roles(
-            user, project, inherited=True)
+        current_roles, current_inherited_roles = (
+            id_manager.get_project_roles(user, project))
         current_roles = {role.name for role in current_roles}
         current_inherited_roles = {
             role.name for role in current_inherited_roles}
@@ -352,10 +355,10 @@ class EditUserRolesAction(UserIdAction, ProjectMixin, UserMixin):
 
         if self.action.state == "default":
             user = self._get_target_user()
-            self._user_roles_edit(user, self.roles, self.project_id,
-                                  remove=self.remove)
-            self._user_roles_edit(user, self.inherited_roles, self.project_id,
-                                  remove=self.remove, inherited=True)
+            self._user_roles_bulk_edit([
+                (user, self.roles, self.project_id, False),
+                (user, self.inherited_roles, self.project_id, True)],
+                remove=self.remove)
 
             if self.remove and self.roles:
                 self.add_note(
@@ -420,7 +423,8 @@ class UpdateUserEmailAction(UserIdAction, UserMixin):
 
             id_manager = user_store.IdentityManager()
 
-            if id_manager.find_user(self.new_email, self.domain_id):
+            if id_manager.find_user(
+                    self.new_email, self.domain_id, fresh=True):
                 self.add_note("User with same username already exists")
                 return False
             self.add_note("No user with same username")
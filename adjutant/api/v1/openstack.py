@@ -12,10 +12,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
+from concurrent import futures
+import json
+
 from django.conf import settings
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.http import StreamingHttpResponse
 from django.utils import timezone
 
-
 from rest_framework.response import Response
 
 from adjutant.common import user_store
@@ -24,133 +30,333 @@ from adjutant.api import utils
 from adjutant.api.v1 import tasks
 from adjutant.api.v1.utils import add_task_id_for_roles, create_notification
 from adjutant.common.quota import QuotaManager
+from adjutant.common.utils import concurrent_executor, wait_for_results
+from adjutant.exceptions import DependencyUnavailable
 
 
 class UserList(tasks.InviteUser):
 
-    @utils.mod_or_admin
-    def get(self, request):
-        """Get a list of all users who have been added to a project"""
-        class_conf = settings.TASK_SETTINGS.get(
-            'edit_user', settings.DEFAULT_TASK_SETTINGS)
-        role_blacklist = class_conf.get('role_blacklist', [])
-        user_list = []
-        id_manager = user_store.IdentityManager()
-        project_id = request.keystone_user['project_id']
-        project = id_manager.get_project(project_id)
-
-        can_manage_roles = user_store.get_managable_roles(
-            request.keystone_user['roles'])
-
-        active_emails = set()
-        for user in id_manager.list_users(project):
-            skip = False
-            roles = []
-            for role in user.roles:
-                if role.name in role_blacklist:
-                    skip = True
-                    continue
-                roles.append(role.name)
-            if skip:
-                continue
-            inherited_roles = []
-            for role in user.inherited_roles:
-                if role.name in role_blacklist:
-                    skip = True
-                    continue
-                inherited_roles.append(role.name)
-            if skip:
-                continue
-
-            email = getattr(user, 'email', '')
-            enabled = getattr(user, 'enabled')
-            user_status = 'Active' if enabled else 'Account Disabled'
-            active_emails.add(email)
-            user_list.append({
-                'id': user.id,
-                'name': user.name,
-                'email': email,
-                'roles': roles,
-                'inherited_roles': inherited_roles,
-                'cohort': 'Member',
-                'status': user_status,
-                'manageable': set(can_manage_roles).issuperset(roles),
-            })
-
-        for user in id_manager.list_inherited_users(project):
-            skip = False
-            roles = []
-            for role in user.roles:
-                if role.name in role_blacklist:
-                    skip = True
-                    continue
-                roles.append(role.name)
-            if skip:
-                continue
-
-            email = getattr(user, 'email', '')
-            enabled = getattr(user, 'enabled')
-            user_status = 'Active' if enabled else 'Account Disabled'
-            user_list.append({'id': user.id,
-                              'name': user.name,
-                              'email': email,
-                              'roles': roles,
-                              'inherited_roles': [],
-                              'cohort': 'Inherited',
-                              'status': user_status,
-                              'manageable': False,
-                              })
+    # the order the cohorts of users are listed in
+    COHORTS = ('Member', 'Inherited', 'Invited')
+    # the statuses users in Keystone (rather than invites) can have
+    KEYSTONE_STATUSES = ('Active', 'Account Disabled')
 
+    def _parse_query(self, params):
+        """
+        Reads the filters and paging options from the query params,
+        raising ValueError for any that are invalid.
+        """
+        def split(name):
+            return [value.strip() for value in params.get(name, '').split(',')
+                    if value.strip()]
+
+        query = {
+            'cohort': split('cohort'),
+            'role': split('role'),
+            'status': split('status'),
+            'limit': None,
+            'marker': None,
+            'stream': params.get('stream', '').lower() in ('1', 'true'),
+        }
+        for cohort in query['cohort']:
+            if cohort not in self.COHORTS:
+                raise ValueError("Unknown cohort '%s'." % cohort)
+
+        if params.get('limit'):
+            try:
+                query['limit'] = int(params['limit'])
+            except ValueError:
+                query['limit'] = 0
+            if query['limit'] < 1:
+                raise ValueError("limit must be a positive integer.")
+
+        if params.get('marker'):
+            try:
+                cohort, user_id = json.loads(base64.urlsafe_b64decode(
+                    params['marker'].encode('utf-8')).decode('utf-8'))
+            except (ValueError, TypeError):
+                raise ValueError("Invalid marker.")
+            if cohort not in self.COHORTS:
+                raise ValueError("Invalid marker.")
+            query['marker'] = (cohort, user_id)
+        return query
+
+    def _encode_marker(self, cohort, user_id):
+        return base64.urlsafe_b64encode(
+            json.dumps([cohort, user_id]).encode('utf-8')).decode('utf-8')
+
+    def _cohorts_to_list(self, query):
+        """
+        The cohorts that can have users matching the query, so others
+        aren't fetched at all.
+        """
+        cohorts = list(query['cohort'] or self.COHORTS)
+        if query['marker']:
+            first = self.COHORTS.index(query['marker'][0])
+            cohorts = [cohort for cohort in cohorts
+                       if self.COHORTS.index(cohort) >= first]
+        if query['status']:
+            statuses = set(query['status'])
+            if not statuses & set(self.KEYSTONE_STATUSES):
+                cohorts = [cohort for cohort in cohorts
+                           if cohort == 'Invited']
+            if not statuses - set(self.KEYSTONE_STATUSES):
+                cohorts = [cohort for cohort in cohorts
+                           if cohort != 'Invited']
+        return cohorts
+
+    def _list_invited(self, project_id, after=None):
         # Get my active tasks for this project:
         project_tasks = models.Task.objects.filter(
             project_id=project_id,
             task_type="invite_user",
             completed=0,
-            cancelled=0)
+            cancelled=0).order_by('uuid')
+        if after:
+            project_tasks = project_tasks.filter(uuid__gt=after)
+        return list(project_tasks)
 
-        registrations = []
-        for task in project_tasks:
-            status = "Invited"
-            for token in task.tokens:
-                if token.expired:
-                    status = "Expired"
+    def _candidates(self, id_manager, listings, query, role_blacklist):
+        """
+        The users to list, as (cohort, id, source) tuples in order.
 
-            for notification in task.notifications:
-                if notification.error:
-                    status = "Failed"
+        The source is the user's UserAssignments, or the task of an
+        invite. Users are filtered by role from their assignments here,
+        before any of them are resolved.
+        """
+        def role_ids(names):
+            return {role.id for role in map(id_manager.find_role, names)
+                    if role}
+
+        blacklist_ids = role_ids(role_blacklist)
+        wanted_ids = role_ids(query['role']) if query['role'] else None
+        marker_cohort, marker_id = query['marker'] or (None, None)
+
+        candidates = []
+        for cohort in self.COHORTS:
+            for source in listings.get(cohort, []):
+                if cohort == 'Invited':
+                    user_id = source.uuid
+                else:
+                    user_id = source.user_id
+                    all_role_ids = (set(source.role_ids)
+                                    | set(source.inherited_role_ids))
+                    if all_role_ids & blacklist_ids:
+                        continue
+                    if wanted_ids is not None and not (
+                            all_role_ids & wanted_ids):
+                        continue
+                if cohort == marker_cohort and user_id <= marker_id:
+                    continue
+                candidates.append((cohort, user_id, source))
+        return candidates
+
+    def _keystone_user(self, id_manager, cohort, assignments, user,
+                       can_manage_roles):
+        def role_names(ids):
+            return [role.name for role in map(id_manager.get_role, ids)
+                    if role]
+
+        roles = role_names(assignments.role_ids)
+        enabled = getattr(user, 'enabled')
+        user_status = 'Active' if enabled else 'Account Disabled'
+        return {
+            'id': user.id,
+            'name': user.name,
+            'email': getattr(user, 'email', ''),
+            'roles': roles,
+            'inherited_roles': role_names(assignments.inherited_role_ids),
+            'cohort': cohort,
+            'status': user_status,
+            'manageable': cohort == 'Member' and set(
+                can_manage_roles).issuperset(roles),
+        }
 
-            for action in task.actions:
-                if not action.valid:
-                    status = "Invalid"
+    def _invited_user(self, task):
+        status = "Invited"
+        for token in task.tokens:
+            if token.expired:
+                status = "Expired"
+
+        for notification in task.notifications:
+            if notification.error:
+                status = "Failed"
+
+        for action in task.actions:
+            if not action.valid:
+                status = "Invalid"
+
+        task_data = {}
+        for action in task.actions:
+            task_data.update(action.action_data)
+
+        # NOTE(adriant): commenting out for now as it causes more confusion
+        # than it helps. May uncomment once different duplication checking
+        # measures are in place.
+        # if task_data['email'] not in active_emails:
+        user = {
+            'id': task.uuid,
+            'name': task_data['email'],
+            'email': task_data['email'],
+            'roles': task_data['roles'],
+            'inherited_roles': task_data['inherited_roles'],
+            'cohort': 'Invited',
+            'status': status
+        }
+        if not settings.USERNAME_IS_EMAIL:
+            user['name'] = task_data['username']
+        return user
 
-            task_data = {}
-            for action in task.actions:
-                task_data.update(action.action_data)
+    def _users(self, id_manager, candidates, query, can_manage_roles,
+               batch_size):
+        """
+        Yields (index, user) for the candidates matching the query,
+        resolving the users from Keystone batch_size at a time.
+        """
+        batch_size = max(batch_size, 1)
+        for start in range(0, len(candidates), batch_size):
+            batch = candidates[start:start + batch_size]
+            users = {user.id: user for user in id_manager.get_users(
+                [source for cohort, _, source in batch
+                 if cohort != 'Invited'])}
+
+            for offset, (cohort, user_id, source) in enumerate(batch):
+                if cohort == 'Invited':
+                    user = self._invited_user(source)
+                elif user_id in users:
+                    user = self._keystone_user(
+                        id_manager, cohort, source, users[user_id],
+                        can_manage_roles)
+                else:
+                    continue
 
-            registrations.append(
-                {'uuid': task.uuid, 'task_data': task_data, 'status': status})
-
-        for task in registrations:
-            # NOTE(adriant): commenting out for now as it causes more confusion
-            # than it helps. May uncomment once different duplication checking
-            # measures are in place.
-            # if task['task_data']['email'] not in active_emails:
-            user = {
-                'id': task['uuid'],
-                'name': task['task_data']['email'],
-                'email': task['task_data']['email'],
-                'roles': task['task_data']['roles'],
-                'inherited_roles':
-                    task['task_data']['inherited_roles'],
-                'cohort': 'Invited',
-                'status': task['status']
-            }
-            if not settings.USERNAME_IS_EMAIL:
-                user['name'] = task['task_data']['username']
+                if query['status'] and user['status'] not in query['status']:
+                    continue
+                if query['role'] and not set(query['role']) & set(
+                        user['roles'] + user['inherited_roles']):
+                    continue
+                yield start + offset, user
 
-            user_list.append(user)
+    @utils.mod_or_admin
+    def get(self, request):
+        """
+        Get a list of all users who have been added to a project.
+
+        The users can be filtered by cohort, role and status, each a
+        comma separated list of values to match any of. With a limit the
+        users are returned a page at a time, along with the marker for
+        the next page (None on the last). With stream=true all matching
+        users are instead sent as newline delimited JSON as they are
+        resolved.
+        """
+        class_conf = settings.TASK_SETTINGS.get(
+            'edit_user', settings.DEFAULT_TASK_SETTINGS)
+        role_blacklist = class_conf.get('role_blacklist', [])
+        try:
+            query = self._parse_query(request.query_params)
+        except ValueError as e:
+            return Response({'errors': [str(e)]}, status=400)
 
-        return Response({'users': user_list})
+        project_id = request.keystone_user['project_id']
+        can_manage_roles = user_store.get_managable_roles(
+            request.keystone_user['roles'])
+
+        if query['stream'] or not settings.USER_LIST_CACHE_TIME:
+            return self._list_users(
+                project_id, query, role_blacklist, can_manage_roles)
+
+        # NOTE: Listings are cached by the query and the roles the caller
+        # can manage, against the version of the project's membership
+        # from before they were built.
+        cache_key = (
+            tuple(sorted((name, tuple(values))
+                         for name, values in request.query_params.lists())),
+            frozenset(can_manage_roles))
+        version = user_store.membership_cache.version(project_id)
+        payload = user_store.membership_cache.get(project_id, cache_key)
+        if payload is not None:
+            return Response(payload)
+
+        response = self._list_users(
+            project_id, query, role_blacklist, can_manage_roles)
+        if response.status_code == 200:
+            user_store.membership_cache.set(
+                project_id, cache_key, version, response.data)
+        return response
+
+    def _list_users(self, project_id, query, role_blacklist,
+                    can_manage_roles):
+        id_manager = user_store.IdentityManager()
+        project = id_manager.get_project(project_id)
+
+        cohorts = self._cohorts_to_list(query)
+        list_calls = {
+            'Member': id_manager.list_user_assignments,
+            'Inherited': id_manager.list_inherited_user_assignments,
+        }
+        listings = {}
+
+        # NOTE: The Keystone assignments are fetched concurrently while the
+        # pending invites are queried from the database in this thread.
+        with concurrent_executor(max_workers=2) as executor:
+            sources = [
+                (cohort, executor.submit(list_calls[cohort], project))
+                for cohort in cohorts if cohort in list_calls]
+            if 'Invited' in cohorts:
+                marker_cohort, marker_id = query['marker'] or (None, None)
+                listings['Invited'] = self._list_invited(
+                    project_id, marker_id if marker_cohort == 'Invited'
+                    else None)
+            try:
+                results = wait_for_results(
+                    [future for _, future in sources],
+                    settings.CONCURRENT_REQUEST_TIMEOUT)
+            except futures.TimeoutError:
+                self.logger.warning(
+                    "(%s) - Timed out listing users for project %s."
+                    % (timezone.now(), project_id))
+                return Response(
+                    {'errors': ['Timed out fetching the project users.']},
+                    status=504)
+        listings.update(zip([cohort for cohort, _ in sources], results))
+
+        candidates = self._candidates(
+            id_manager, listings, query, role_blacklist)
+
+        if query['stream']:
+            users = self._users(
+                id_manager, candidates, query, can_manage_roles,
+                settings.USER_LIST_BATCH_SIZE)
+            return StreamingHttpResponse(
+                (json.dumps(user) + '\n' for _, user in users),
+                content_type='application/x-ndjson')
+
+        limit = query['limit']
+        users = []
+        next_marker = None
+        for index, user in self._users(
+                id_manager, candidates, query, can_manage_roles,
+                limit or len(candidates)):
+            users.append(user)
+            if len(users) == limit:
+                if index + 1 < len(candidates):
+                    cohort, user_id, _ = candidates[index]
+                    next_marker = self._encode_marker(cohort, user_id)
+                break
+
+        response = {'users': users}
+        if limit:
+            response['next'] = next_marker
+        return Response(response)
+
+
+@receiver(post_save, sender=models.Task)
+def _invalidate_user_list(sender, instance, **kwargs):
+    # Invites are listed with the project's users, and edits to their
+    # roles complete with these tasks.
+    if (instance.task_type in ('invite_user', 'edit_user', 'edit_roles')
+            and instance.project_id):
+        user_store.membership_cache.bump(instance.project_id)
 
 
 class UserDetail(tasks.TaskView):
@@ -176,10 +382,10 @@ class UserDetail(tasks.TaskView):
         project_id = request.keystone_user['project_id']
         project = id_manager.get_project(project_id)
 
-        roles = [role.name for role in id_manager.get_roles(user, project)]
+        roles, inherited_roles = id_manager.get_project_roles(user, project)
+        roles = [role.name for role in roles]
         roles_blacklisted = set(role_blacklist) & set(roles)
-        inherited_roles = [
-            role.name for role in id_manager.get_roles(user, project, True)]
+        inherited_roles = [role.name for role in inherited_roles]
         inherited_roles_blacklisted = (
             set(role_blacklist) & set(inherited_roles))
 
@@ -243,10 +449,10 @@ class UserRoles(tasks.TaskView):
             self.task_type, settings.DEFAULT_TASK_SETTINGS)
         role_blacklist = class_conf.get('role_blacklist', [])
 
-        roles = [role.name for role in id_manager.get_roles(user, project)]
+        roles, inherited_roles = id_manager.get_project_roles(user, project)
+        roles = [role.name for role in roles]
         roles_blacklisted = set(role_blacklist) & set(roles)
-        inherited_roles = [
-            role.name for role in id_manager.get_roles(user, project, True)]
+        inherited_roles = [role.name for role in inherited_roles]
         inherited_roles_blacklisted = (
             set(role_blacklist) & set(inherited_roles))
 
@@ -458,12 +664,20 @@ class UpdateProjectQuotas(tasks.TaskView):
             regions = (region.id for region in id_manager.list_regions())
 
         region_quotas = []
+        unavailable_regions = []
 
         quota_manager = QuotaManager(self.project_id)
         for region in regions:
             if self.check_region_exists(region):
-                region_quotas.append(quota_manager.get_region_quota_data(
-                    region, include_usage))
+                try:
+                    region_quotas.append(quota_manager.get_region_quota_data(
+                        region, include_usage))
+                except DependencyUnavailable as e:
+                    # a failing region shouldn't take down the others
+                    self.logger.warning(
+                        "(%s) - Skipping quotas for region %s: %s"
+                        % (timezone.now(), region, e))
+                    unavailable_regions.append(region)
             else:
                 return Response(
                     {"ERROR": ['Region: %s is not valid' % region]}, 400)
@@ -471,6 +685,7 @@ class UpdateProjectQuotas(tasks.TaskView):
         response_tasks = self.get_active_quota_tasks()
 
         return Response({'regions': region_quotas,
+                         "unavailable_regions": unavailable_regions,
                          "quota_sizes": quota_settings,
                          "quota_size_order": size_order,
                          "active_quota_tasks": response_tasks})
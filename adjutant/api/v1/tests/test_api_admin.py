@@ -27,6 +27,7 @@ from rest_framework import status
 from rest_framework.test import APITestCase
 
 from adjutant.api.models import Task, Token, Notification
+from adjutant.common import dependencies
 from adjutant.common.tests import fake_clients
 from adjutant.common.tests.fake_clients import (
     FakeManager, setup_identity_cache)
@@ -343,6 +344,61 @@ class AdminAPITests(APITestCase):
 
         self.assertEqual(response.json()['error_notifications'], [])
 
+    def test_topology_refresh(self):
+        """
+        Admins can reload the cached regions and domains.
+        """
+        setup_identity_cache()
+
+        url = "/v1/topology"
+        headers = {
+            'project_name': "test_project",
+            'project_id': "test_project_id",
+            'roles': "admin,_member_",
+            'username': "test@example.com",
+            'user_id': "test_user_id",
+            'authenticated': True
+        }
+        response = self.client.post(url, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['regions'],
+                         ['RegionOne', 'RegionTwo'])
+        self.assertEqual(response.json()['domains'], ['Default'])
+
+        headers['roles'] = "project_admin,_member_"
+        response = self.client.post(url, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_dependency_metrics(self):
+        """
+        Admins can see the calls made to external services.
+        """
+        dependencies.metrics.reset()
+        self.addCleanup(dependencies.metrics.reset)
+        dependencies.metrics.record('nova', 'get_quota', 'RegionOne', 0.2)
+
+        url = "/v1/dependencies"
+        headers = {
+            'project_name': "test_project",
+            'project_id': "test_project_id",
+            'roles': "admin,_member_",
+            'username': "test@example.com",
+            'user_id': "test_user_id",
+            'authenticated': True
+        }
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stats = response.json()['dependencies']
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['method'], 'get_quota')
+        self.assertEqual(stats[0]['latency_buckets']['0.25'], 1)
+        self.assertIn('circuits', response.json())
+        self.assertIn('caches', response.json())
+
+        headers['roles'] = "project_admin,_member_"
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
     def test_task_update(self):
         """
         Creates a invalid task.
@@ -12,6 +12,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
+import time
+
 import mock
 
 from rest_framework import status
@@ -22,6 +25,8 @@ from django.test.utils import override_settings
 from django.utils import timezone
 
 from adjutant.api.models import Token, Task
+from adjutant.common import dependencies
+from adjutant.common.quota import QuotaManager
 from adjutant.common.tests import fake_clients
 from adjutant.common.tests.fake_clients import (
     FakeManager, setup_identity_cache, get_fake_neutron, get_fake_novaclient,
@@ -30,6 +35,7 @@ from adjutant.common.tests.fake_clients import (
     FakeResource)
 from adjutant.common.tests.utils import (
     modify_dict_settings, AdjutantAPITestCase)
+from adjutant.exceptions import DependencyUnavailable
 
 from datetime import timedelta
 
@@ -205,6 +211,153 @@ class OpenstackAPITests(AdjutantAPITestCase):
         self.assertEqual(normal_user['roles'], ['_member_', 'project_mod'])
         self.assertEqual(normal_user['inherited_roles'], ['_member_'])
 
+    def test_user_list_filtered_and_paged(self):
+        """
+        The user list can be filtered, paged through with a marker,
+        and streamed.
+        """
+        project = fake_clients.FakeProject(name="test_project")
+        users = [
+            fake_clients.FakeUser(name="user%s@example.com" % i,
+                                  email="user%s@example.com" % i)
+            for i in range(5)]
+        users[4].enabled = False
+        assignments = [
+            fake_clients.FakeRoleAssignment(
+                scope={'project': {'id': project.id}},
+                role_name="project_mod" if i == 0 else "_member_",
+                user={'id': user.id})
+            for i, user in enumerate(users)]
+
+        setup_identity_cache(
+            projects=[project], users=users, role_assignments=assignments)
+
+        url = "/v1/openstack/users"
+        headers = {
+            'project_name': "test_project",
+            'project_id': project.id,
+            'roles': "project_admin,_member_,project_mod",
+            'username': "test@example.com",
+            'user_id': "test_user_id",
+            'authenticated': True
+        }
+        data = {'email': "invited@example.com", 'roles': ["_member_"],
+                'project_id': project.id}
+        response = self.client.post(url, data, format='json', headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(
+            url, {'cohort': 'Member', 'role': 'project_mod'}, headers=headers)
+        self.assertEqual(
+            [u['name'] for u in response.json()['users']],
+            ['user0@example.com'])
+
+        response = self.client.get(
+            url, {'status': 'Invited,Account Disabled'}, headers=headers)
+        self.assertEqual(
+            sorted(u['name'] for u in response.json()['users']),
+            ['invited@example.com', 'user4@example.com'])
+
+        paged = []
+        params = {'limit': 2}
+        while True:
+            response = self.client.get(url, params, headers=headers)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            paged.extend(u['name'] for u in response.json()['users'])
+            if not response.json()['next']:
+                break
+            params['marker'] = response.json()['next']
+        self.assertEqual(len(paged), 6)
+        self.assertEqual(len(set(paged)), 6)
+        self.assertEqual(paged[-1], 'invited@example.com')
+
+        response = self.client.get(url, {'stream': 'true'}, headers=headers)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(
+            sorted(json.loads(line.decode())['name'] for line in lines),
+            sorted(paged))
+
+        response = self.client.get(url, {'limit': 0}, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(url, {'marker': 'bogus'}, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_user_list_cached(self):
+        """
+        The user list is cached until Adjutant changes the project's
+        membership.
+        """
+        project = fake_clients.FakeProject(name="test_project")
+        user = fake_clients.FakeUser(
+            name="test@example.com", email="test@example.com")
+        assignment = fake_clients.FakeRoleAssignment(
+            scope={'project': {'id': project.id}},
+            role_name="_member_",
+            user={'id': user.id})
+
+        setup_identity_cache(
+            projects=[project], users=[user], role_assignments=[assignment])
+
+        url = "/v1/openstack/users"
+        headers = {
+            'project_name': "test_project",
+            'project_id': project.id,
+            'roles': "project_admin,_member_,project_mod",
+            'username': "test@example.com",
+            'user_id': "test_user_id",
+            'authenticated': True
+        }
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(len(response.json()['users']), 1)
+
+        # changes made directly in Keystone wait for the cache to expire
+        fake_clients.identity_cache['role_assignments'] = []
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(len(response.json()['users']), 1)
+
+        data = {'email': "test2@example.com", 'roles': ["_member_"],
+                'project_id': project.id}
+        response = self.client.post(url, data, format='json', headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(
+            [u['name'] for u in response.json()['users']],
+            ['test2@example.com'])
+
+    @override_settings(CONCURRENT_REQUEST_TIMEOUT=0.1)
+    def test_user_list_timeout(self):
+        """
+        A source of users that doesn't answer in time fails the request
+        rather than holding it.
+        """
+        project = fake_clients.FakeProject(name="test_project")
+
+        setup_identity_cache(projects=[project])
+
+        def slow_list(manager, project):
+            time.sleep(0.5)
+            return []
+
+        url = "/v1/openstack/users"
+        headers = {
+            'project_name': "test_project",
+            'project_id': project.id,
+            'roles': "project_admin,_member_,project_mod",
+            'username': "test@example.com",
+            'user_id': "test_user_id",
+            'authenticated': True
+        }
+
+        with mock.patch.object(
+                FakeManager, 'list_inherited_user_assignments', slow_list):
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 504)
+        self.assertEqual(
+            response.json(),
+            {'errors': ['Timed out fetching the project users.']})
+
     def test_user_detail(self):
         """
         Confirm that the user detail view functions as expected
@@ -931,6 +1084,113 @@ class QuotaAPITests(AdjutantAPITestCase):
         self.assertEqual(
             recent_task['status'], 'Awaiting Approval')
 
+    def test_quota_region_unavailable(self):
+        """
+        A region whose services are short circuited is left out,
+        while the other regions are still returned.
+        """
+        project = fake_clients.FakeProject(
+            name="test_project", id='test_project_id')
+        setup_identity_cache(projects=[project])
+
+        headers = {
+            'project_name': "test_project",
+            'project_id': project.id,
+            'roles': "project_admin,_member_,project_mod",
+            'username': "test@example.com",
+            'user_id': "user_id",
+            'authenticated': True
+        }
+
+        get_quota_data = QuotaManager.get_region_quota_data
+
+        def get_region_quota_data(manager, region_id, *args):
+            if region_id == 'RegionTwo':
+                raise DependencyUnavailable("nova@RegionTwo is unavailable")
+            return get_quota_data(manager, region_id, *args)
+
+        url = "/v1/openstack/quotas/"
+        with mock.patch.object(QuotaManager, 'get_region_quota_data',
+                               get_region_quota_data):
+            response = self.client.get(url, headers=headers)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [region['region'] for region in response.data['regions']],
+            ['RegionOne'])
+        self.assertEqual(response.data['unavailable_regions'], ['RegionTwo'])
+
+    @override_settings(REQUEST_DEADLINES={'UpdateProjectQuotas': 0.05})
+    def test_quota_deadline_exceeded(self):
+        """
+        A quota request still waiting on the services once its deadline
+        has passed fails with a 504, rather than going on to the other
+        regions.
+        """
+        project = fake_clients.FakeProject(
+            name="test_project", id='test_project_id')
+        setup_identity_cache(projects=[project])
+
+        headers = {
+            'project_name': "test_project",
+            'project_id': project.id,
+            'roles': "project_admin,_member_,project_mod",
+            'username': "test@example.com",
+            'user_id': "user_id",
+            'authenticated': True
+        }
+
+        regions = []
+
+        def get_region_quota_data(manager, region_id, *args):
+            regions.append(region_id)
+            # a call to a region that doesn't answer in time
+            with dependencies.within_deadline('nova') as timeout:
+                time.sleep(timeout)
+                raise IOError("timed out")
+
+        url = "/v1/openstack/quotas/"
+        with mock.patch.object(QuotaManager, 'get_region_quota_data',
+                               get_region_quota_data):
+            response = self.client.get(url, headers=headers)
+
+        self.assertEqual(response.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        self.assertEqual(len(regions), 1)
+        self.assertIsNone(dependencies.get_deadline())
+
+    @override_settings(DEPENDENCY_SETTINGS={
+        'nova': {'failure_threshold': 1, 'reset_timeout': 60}})
+    def test_dependency_unavailable(self):
+        """
+        A request needing a service whose circuit is open gets a 503,
+        with when to retry.
+        """
+        project = fake_clients.FakeProject(
+            name="test_project", id='test_project_id')
+        setup_identity_cache(projects=[project])
+
+        headers = {
+            'project_name': "test_project",
+            'project_id': project.id,
+            'roles': "project_admin,_member_,project_mod",
+            'username': "test@example.com",
+            'user_id': "user_id",
+            'authenticated': True
+        }
+
+        breaker = dependencies.CircuitBreaker('nova')
+        breaker.record_failure()
+
+        url = "/v1/openstack/quotas/"
+        with mock.patch.object(QuotaManager, '__init__',
+                               side_effect=lambda *args: breaker.allow()):
+            response = self.client.get(url, headers=headers)
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn('nova', response.json()['errors'][0])
+        self.assertIn(response['Retry-After'], ('59', '60'))
+
     def test_set_multi_region_quota(self):
         """ Sets a quota to all to all regions in a project """
 
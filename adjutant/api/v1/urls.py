@@ -19,6 +19,8 @@ from django.conf import settings
 
 urlpatterns = [
     url(r'^status/?$', views.StatusView.as_view()),
+    url(r'^topology/?$', views.TopologyView.as_view()),
+    url(r'^dependencies/?$', views.DependencyView.as_view()),
     url(r'^tasks/(?P<uuid>\w+)/?$', views.TaskDetail.as_view()),
     url(r'^tasks/?$', views.TaskList.as_view()),
     url(r'^tokens/(?P<id>\w+)', views.TokenDetail.as_view()),
@@ -23,13 +23,15 @@ from decorator import decorator
 
 from django.conf import settings
 from django.core.exceptions import FieldError
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.template import loader
 from django.utils import timezone
 
 from rest_framework.response import Response
 
 from adjutant.api.models import Notification, Token
+from adjutant.common import dependencies
+from adjutant.exceptions import DependencyUnavailable
 
 
 def create_token(task):
@@ -131,9 +133,14 @@ def send_stage_email(task, email_conf, token=None):
             email.attach_alternative(
                 html_template.render(context), "text/html")
 
-        email.send(fail_silently=False)
+        with dependencies.track('smtp', 'send'), \
+                dependencies.get_breaker('smtp').guard(), \
+                dependencies.within_deadline(
+                    'smtp', settings.EMAIL_TIMEOUT) as timeout:
+            email.connection = get_connection(timeout=timeout)
+            email.send(fail_silently=False)
 
-    except SMTPException as e:
+    except (SMTPException, DependencyUnavailable) as e:
         notes = {
             'errors':
                 ("Error: '%s' while emailing update for task: %s" %
@@ -27,6 +27,7 @@ from adjutant.api.views import SingleVersionView
 from adjutant.api.models import Notification, Task, Token
 from adjutant.api.v1.utils import (
     create_notification, create_token, parse_filters, send_stage_email)
+from adjutant.common import cache, dependencies, user_store
 
 
 class V1VersionEndpoint(SingleVersionView):
@@ -102,6 +103,43 @@ class StatusView(APIViewWithLogger):
         return Response(status, status=200)
 
 
+class TopologyView(APIViewWithLogger):
+
+    @utils.admin
+    def post(self, request, format=None):
+        """
+        Reloads the cached regions and domains from Keystone, such
+        as after adding a region, rather than waiting for the next
+        background refresh.
+        """
+        id_manager = user_store.IdentityManager()
+        regions, domains = id_manager.refresh_topology()
+
+        self.logger.info("(%s) - Region and domain cache refreshed."
+                         % timezone.now())
+        return Response(
+            {'regions': sorted(region.id for region in regions),
+             'domains': sorted(domain.name for domain in domains)},
+            status=200)
+
+
+class DependencyView(APIViewWithLogger):
+
+    @utils.admin
+    def get(self, request, format=None):
+        """
+        Call counts, errors and latencies for each external service,
+        the state of their circuit breakers, how many of their reads
+        were hedged, and the hits and misses of the shared caches.
+        """
+        return Response(
+            {'dependencies': dependencies.metrics.snapshot(),
+             'circuits': dependencies.circuit_states(),
+             'hedging': dependencies.hedge_stats(),
+             'caches': cache.metrics.snapshot()},
+            status=200)
+
+
 class NotificationList(APIViewWithLogger):
 
     @utils.admin
@@ -0,0 +1,225 @@
+# Copyright (C) 2019 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A cache tier on Django's cache framework, shared by every worker using
+the same cache in CACHES (such as memcached), for the identity, topology,
+quota and response caches.
+"""
+
+from collections import defaultdict
+import hashlib
+from logging import getLogger
+import threading
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+
+class CacheMetrics(object):
+    """Hits, misses, sets, invalidations and errors by namespace."""
+
+    COUNTERS = ('hits', 'misses', 'sets', 'invalidations', 'errors')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: dict.fromkeys(self.COUNTERS, 0))
+
+    def record(self, namespace, counter):
+        with self._lock:
+            self._counts[namespace][counter] += 1
+
+    def snapshot(self):
+        """The counts by namespace, with the hit rate of each."""
+        with self._lock:
+            snapshot = {namespace: dict(counts)
+                        for namespace, counts in self._counts.items()}
+        for counts in snapshot.values():
+            reads = counts['hits'] + counts['misses']
+            counts['hit_rate'] = (
+                float(counts['hits']) / reads if reads else None)
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+metrics = CacheMetrics()
+
+_MISSING = object()
+
+
+class SharedCache(object):
+    """
+    A namespace of the cache tier.
+
+    Keys can be any value with a stable repr, and are hashed into the
+    namespace so they suit any backend. Every key is versioned by the
+    namespace's version, also held in the cache, so invalidate drops
+    the whole namespace for every worker at once.
+
+    Shared namespaces use the SHARED_CACHE cache of CACHES. Others use
+    a private local memory cache, for caches that can't be shared.
+    Errors from the backend are logged and treated as misses, so a
+    cache outage only costs the calls it would have saved.
+    """
+
+    def __init__(self, namespace, shared=True):
+        self.namespace = namespace
+        self.shared = shared
+        self._private = None
+        if not shared:
+            self._private = LocMemCache(
+                'adjutant-%s-%s' % (namespace, uuid4().hex), {})
+
+    @property
+    def backend(self):
+        if self._private is not None:
+            return self._private
+        return caches[settings.SHARED_CACHE]
+
+    def _key(self, key):
+        return "adjutant:%s:%s" % (
+            self.namespace,
+            hashlib.sha256(repr(key).encode('utf-8')).hexdigest())
+
+    def _version(self):
+        version_key = "adjutant:%s:version" % self.namespace
+        version = self.backend.get(version_key)
+        if version is None:
+            self.backend.add(version_key, 1, None)
+            version = self.backend.get(version_key, 1)
+        return version
+
+    def _error(self, action, e):
+        metrics.record(self.namespace, 'errors')
+        getLogger('adjutant').warning(
+            "Cache error while %s %s: %s" % (action, self.namespace, e))
+
+    def get(self, key, default=None):
+        try:
+            value = self.backend.get(
+                self._key(key), _MISSING, version=self._version())
+        except Exception as e:
+            self._error('reading', e)
+            value = _MISSING
+        if value is _MISSING:
+            metrics.record(self.namespace, 'misses')
+            return default
+        metrics.record(self.namespace, 'hits')
+        return value
+
+    def set(self, key, value, ttl):
+        """Caches the value for ttl seconds, or not at all if 0."""
+        if not ttl:
+            return
+        try:
+            self.backend.set(
+                self._key(key), value, ttl, version=self._version())
+            metrics.record(self.namespace, 'sets')
+        except Exception as e:
+            self._error('writing', e)
+
+    def delete(self, key):
+        try:
+            self.backend.delete(self._key(key), version=self._version())
+        except Exception as e:
+            self._error('deleting from', e)
+
+    def counter(self, key):
+        """The value of a counter, which isn't counted as a hit or miss."""
+        try:
+            return self.backend.get(
+                self._key(key), 0, version=self._version())
+        except Exception as e:
+            self._error('reading', e)
+            return 0
+
+    def incr(self, key):
+        """
+        Increments a counter (missing counters are 0), returning the
+        new value.
+        """
+        try:
+            version = self._version()
+            try:
+                return self.backend.incr(self._key(key), version=version)
+            except ValueError:
+                if self.backend.add(self._key(key), 1, None,
+                                    version=version):
+                    return 1
+                return self.backend.incr(self._key(key), version=version)
+        except Exception as e:
+            self._error('incrementing in', e)
+
+    def invalidate(self):
+        """Drops every key in the namespace."""
+        version_key = "adjutant:%s:version" % self.namespace
+        try:
+            try:
+                self.backend.incr(version_key)
+            except ValueError:
+                self.backend.add(version_key, 2, None)
+            metrics.record(self.namespace, 'invalidations')
+        except Exception as e:
+            self._error('invalidating', e)
+
+
+class MemcacheClient(object):
+    """
+    A namespace of the cache tier that looks like a memcache client,
+    for libraries (such as keystonemiddleware) that take one. A time of
+    0 means the value isn't cached, rather than cached forever.
+    """
+
+    def __init__(self, namespace):
+        self._cache = SharedCache(namespace)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, time=0, min_compress_len=0):
+        self._cache.set(key, value, time)
+        return True
+
+    def delete(self, key, time=0):
+        self._cache.delete(key)
+        return True
+
+
+class CachedResource(object):
+    """
+    A plain copy of a Keystone resource's attributes, which unlike the
+    resource itself can be pickled into the cache tier.
+    """
+
+    def __init__(self, info):
+        self._info = dict(info)
+        self.__dict__.update(self._info)
+
+    @classmethod
+    def from_resource(cls, resource):
+        if hasattr(resource, 'to_dict'):
+            return cls(resource.to_dict())
+        return cls({name: value for name, value in vars(resource).items()
+                    if not name.startswith('_') and name != 'manager'})
+
+    def to_dict(self):
+        return dict(self._info)
+
+    def __repr__(self):
+        return "<CachedResource %s>" % self._info
@@ -0,0 +1,639 @@
+# Copyright (C) 2019 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import contextmanager
+import functools
+import inspect
+from logging import getLogger
+import math
+import threading
+from time import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from keystoneauth1 import exceptions as ksa_exceptions
+
+from adjutant.common.utils import (
+    ContextThreadPoolExecutor, register_context_propagator)
+from adjutant.exceptions import DeadlineExceeded, DependencyUnavailable
+
+
+# Used for any value a dependency doesn't set in DEPENDENCY_SETTINGS
+DEFAULT_DEPENDENCY_SETTINGS = {
+    # seconds to wait on a single call
+    'timeout': 30,
+    # consecutive failures before calls are short circuited
+    'failure_threshold': 5,
+    # seconds to short circuit calls for before letting one through
+    'reset_timeout': 30,
+    # percentile of recent latency (such as 95) after which a hedgeable
+    # read is sent again, or 0 to never hedge
+    'hedge_percentile': 0,
+    # most reads hedged, as a fraction of all reads
+    'hedge_budget': 0.05,
+}
+
+
+def get_setting(dependency, name):
+    """
+    Returns a setting for a dependency (such as 'keystone' or 'nova'),
+    falling back to the 'default' entry of DEPENDENCY_SETTINGS and then
+    to DEFAULT_DEPENDENCY_SETTINGS.
+    """
+    dependency_settings = settings.DEPENDENCY_SETTINGS
+    for key in (dependency, 'default'):
+        value = dependency_settings.get(key, {}).get(name)
+        if value is not None:
+            return value
+    return DEFAULT_DEPENDENCY_SETTINGS[name]
+
+
+def is_failure(e):
+    """
+    Whether an exception means the dependency itself is failing (it
+    couldn't be reached, timed out, or had a server error), rather than
+    rejecting a request.
+    """
+    if isinstance(e, (OSError, ksa_exceptions.ConnectionError)):
+        return True
+    status = getattr(e, 'http_status', None) or getattr(e, 'code', None)
+    return isinstance(status, int) and status >= 500
+
+
+class CircuitBreaker(object):
+    """
+    Short circuits calls to a dependency that keeps failing.
+
+    After failure_threshold consecutive failures the circuit opens and
+    calls raise DependencyUnavailable straight away. Once reset_timeout
+    seconds have passed a single probe call is let through (half open),
+    which closes the circuit if it succeeds or opens it again if not.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, dependency=None, region=None):
+        self.name = name
+        self.dependency = dependency or name
+        self.region = region
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._probing or time() >= self._opened_at + get_setting(
+                self.dependency, 'reset_timeout'):
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        """
+        Raises DependencyUnavailable unless a call may be made now.
+
+        Returns True if the call is the half open probe.
+        """
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return False
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            retry_after = (self._opened_at or time()) + get_setting(
+                self.dependency, 'reset_timeout') - time()
+        e = DependencyUnavailable(
+            "%s is unavailable, calls to it are being short circuited."
+            % self.name)
+        e.adjutant_dependency = self.name
+        # seconds until a call may be let through again
+        e.retry_after = max(retry_after, 1)
+        raise e
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= get_setting(
+                    self.dependency, 'failure_threshold'):
+                if self._opened_at is None:
+                    getLogger('adjutant').warning(
+                        "Circuit for %s opened after %s failures."
+                        % (self.name, self._failures))
+                self._opened_at = time()
+            self._probing = False
+
+    def release(self):
+        """Ends a call that neither succeeded nor failed."""
+        with self._lock:
+            self._probing = False
+
+    @contextmanager
+    def guard(self, failures=()):
+        """
+        Wraps a call to the dependency, recording its outcome.
+
+        Exceptions matching is_failure (or one of the extra failures
+        types) count against the dependency, as does setting failed on
+        the yielded outcome. Failures already recorded by another
+        dependency's breaker (such as a token request to Keystone inside
+        a Nova call) aren't counted again.
+        """
+        self.allow()
+        outcome = _Outcome()
+        try:
+            yield outcome
+        except Exception as e:
+            if getattr(e, 'adjutant_dependency', None):
+                self.release()
+            elif is_failure(e) or isinstance(e, failures):
+                e.adjutant_dependency = self.name
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        if outcome.failed:
+            self.record_failure()
+        else:
+            self.record_success()
+
+
+class _Outcome(object):
+    """Lets a guarded call mark itself failed without raising."""
+    failed = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(dependency, region=None):
+    """
+    Returns the CircuitBreaker for a dependency, with a separate one
+    per region for regional services, named as 'nova@RegionOne'.
+    """
+    name = dependency if region is None else "%s@%s" % (dependency, region)
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(
+                name, CircuitBreaker(name, dependency, region))
+    return breaker
+
+
+def reset_breakers():
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def circuit_states():
+    """The state of every circuit breaker, as {name: state}."""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.state for breaker in breakers}
+
+
+@receiver(setting_changed)
+def _reset_on_settings_change(setting, **kwargs):
+    if setting == 'DEPENDENCY_SETTINGS':
+        reset_breakers()
+
+
+class DependencyMetrics(object):
+    """
+    Counts, errors and a latency histogram of the calls made to each
+    dependency, by (dependency, method, region).
+    """
+
+    # upper bounds, in seconds, of the latency histogram buckets
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, dependency, method, region, duration, error=False):
+        key = (dependency, method, region)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {
+                    'count': 0, 'errors': 0, 'total_time': 0.0,
+                    'buckets': [0] * (len(self.BUCKETS) + 1)}
+            stats['count'] += 1
+            stats['errors'] += int(error)
+            stats['total_time'] += duration
+            for i, bound in enumerate(self.BUCKETS):
+                if duration <= bound:
+                    break
+            else:
+                i = len(self.BUCKETS)
+            stats['buckets'][i] += 1
+
+    def snapshot(self):
+        """The stats as a list of dicts, with labelled buckets."""
+        bounds = [str(bound) for bound in self.BUCKETS] + ['+Inf']
+        with self._lock:
+            items = [(key, dict(stats, buckets=list(stats['buckets'])))
+                     for key, stats in self._stats.items()]
+        return [
+            {'dependency': dependency, 'method': method, 'region': region,
+             'count': stats['count'], 'errors': stats['errors'],
+             'total_time': stats['total_time'],
+             'latency_buckets': dict(zip(bounds, stats['buckets']))}
+            for (dependency, method, region), stats in sorted(
+                items, key=lambda item: tuple(str(k) for k in item[0]))]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+metrics = DependencyMetrics()
+
+_local = threading.local()
+
+
+def _get_labels():
+    labels = getattr(_local, 'labels', None)
+    if labels is None:
+        labels = _local.labels = {}
+    return labels
+
+
+@contextmanager
+def operation(dependency, name):
+    """
+    Names the calls made to a dependency within the block, such as
+    the IdentityManager method making them. Only the outermost
+    operation for a dependency is used.
+    """
+    labels = _get_labels()
+    if dependency in labels:
+        yield
+        return
+    labels[dependency] = name
+    try:
+        yield
+    finally:
+        labels.pop(dependency, None)
+
+
+def instrumented(dependency):
+    """
+    Class decorator running each public method within an operation
+    of the same name, so calls to the dependency are recorded by it.
+    """
+    def decorate(cls):
+        for name, method in inspect.getmembers(cls, _is_method):
+            if name.startswith('_'):
+                continue
+            # the function itself, rather than an unbound method on 2.7
+            method = getattr(method, '__func__', method)
+            setattr(cls, name, _operation_method(dependency, name, method))
+        return cls
+    return decorate
+
+
+def _is_method(member):
+    """
+    Whether a class member is a plain method, which on Python 2.7 is an
+    unbound method (and a function on Python 3).
+    """
+    return (inspect.isfunction(getattr(member, '__func__', member))
+            and getattr(member, '__self__', None) is None)
+
+
+def _operation_method(dependency, name, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with operation(dependency, name):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def track(dependency, method=None, region=None):
+    """
+    Records a single call to a dependency: its latency and whether it
+    raised, in the metrics and the calls of the current request.
+
+    The method defaults to the name of the enclosing operation.
+    """
+    method = _get_labels().get(dependency, method)
+    start = time()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        duration = time() - start
+        metrics.record(dependency, method, region, duration, error)
+        calls = get_request_calls()
+        if calls is not None:
+            name = dependency if region is None else "%s@%s" % (
+                dependency, region)
+            calls.append((name, duration, error))
+
+
+def get_request_calls():
+    """The calls recorded for the current request, or None."""
+    return getattr(_local, 'calls', None)
+
+
+def set_request_calls(calls):
+    """Starts (with a list) or ends (with None) a request's record."""
+    _local.calls = calls
+
+
+def get_deadline():
+    """The time the current request must answer by, or None."""
+    return getattr(_local, 'deadline', None)
+
+
+def set_deadline(deadline):
+    """Sets (as a timestamp) or clears the current request's deadline."""
+    _local.deadline = deadline
+
+
+def time_left():
+    """Seconds left until the request's deadline, or None."""
+    deadline = get_deadline()
+    if deadline is None:
+        return None
+    return deadline - time()
+
+
+def deadline_passed():
+    left = time_left()
+    return left is not None and left <= 0
+
+
+def _deadline_exceeded(dependency):
+    e = DeadlineExceeded(
+        "The request ran out of time waiting for %s." % dependency)
+    e.adjutant_dependency = dependency
+    return e
+
+
+@contextmanager
+def within_deadline(dependency, timeout=None):
+    """
+    Yields the timeout for a call to a dependency: its timeout setting
+    (or the given one), cut short to the time left before the request's
+    deadline.
+
+    Raises DeadlineExceeded if the deadline has already passed, or in
+    place of whatever the call raised if it failed once the deadline
+    passed. A circuit breaker doesn't count DeadlineExceeded against
+    the dependency, so this goes inside the breaker's guard.
+    """
+    if timeout is None:
+        timeout = get_setting(dependency, 'timeout')
+    left = time_left()
+    if left is None or left >= timeout:
+        yield timeout
+        return
+    if left <= 0:
+        raise _deadline_exceeded(dependency)
+    try:
+        yield left
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        if deadline_passed():
+            raise _deadline_exceeded(dependency)
+        raise
+
+
+@contextmanager
+def _restored_context(labels, calls, deadline):
+    previous = (getattr(_local, 'labels', None), get_request_calls(),
+                get_deadline())
+    _local.labels = labels
+    set_request_calls(calls)
+    set_deadline(deadline)
+    try:
+        yield
+    finally:
+        _local.labels, _local.calls, _local.deadline = previous
+
+
+def summarize_calls(calls):
+    """
+    Totals a request's calls by dependency, as 'name: count/seconds'
+    strings with the number of errors if there were any.
+    """
+    totals = {}
+    for name, duration, error in calls:
+        count, total, errors = totals.get(name, (0, 0.0, 0))
+        totals[name] = (count + 1, total + duration, errors + int(error))
+    summary = []
+    for name, (count, total, errors) in sorted(totals.items()):
+        entry = "%s: %s/%.3fs" % (name, count, total)
+        if errors:
+            entry += " (%s errors)" % errors
+        summary.append(entry)
+    return summary
+
+
+class Hedger(object):
+    """
+    Hedges the idempotent reads of a dependency: once a read has taken
+    longer than the hedge_percentile of that read's recent latencies,
+    an identical one is sent, and whichever answers first is used.
+
+    Hedges spend from a budget that each read adds hedge_budget to (up
+    to MAX_TOKENS), so when the dependency is slow across the board,
+    such as during an outage, they add at most that fraction of load.
+    Reads made within a hedged read aren't hedged themselves.
+
+    Hedged reads run on a pool of threads that never queues: when all
+    of its threads are busy, reads are made unhedged on the request's
+    own thread instead of waiting for one.
+    """
+
+    # recent latencies kept per read
+    WINDOW = 200
+    # latencies needed before a read is hedged
+    MIN_SAMPLES = 20
+    # most hedges that can be saved up for a burst of slow reads
+    MAX_TOKENS = 10
+
+    def __init__(self, dependency):
+        self.dependency = dependency
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._tokens = 0.0
+        self._stats = {'reads': 0, 'hedged': 0, 'hedge_wins': 0,
+                       'pool_full': 0}
+        self._executor = None
+        self._slots = None
+
+    def delay(self, name):
+        """
+        Seconds after which the read is hedged, or None if it isn't.
+        """
+        percentile = get_setting(self.dependency, 'hedge_percentile')
+        latencies = self._latencies.get(name)
+        if not percentile or not latencies or (
+                len(latencies) < self.MIN_SAMPLES):
+            return None
+        latencies = sorted(latencies)
+        index = int(math.ceil(percentile / 100.0 * len(latencies))) - 1
+        return latencies[min(max(index, 0), len(latencies) - 1)]
+
+    def _record(self, name, duration):
+        with self._lock:
+            latencies = self._latencies.get(name)
+            if latencies is None:
+                latencies = self._latencies[name] = deque(
+                    maxlen=self.WINDOW)
+            latencies.append(duration)
+
+    def _earn(self):
+        with self._lock:
+            self._stats['reads'] += 1
+            self._tokens = min(
+                self.MAX_TOKENS, self._tokens + get_setting(
+                    self.dependency, 'hedge_budget'))
+
+    def _spend(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self._stats['hedged'] += 1
+            return True
+
+    def _refund(self):
+        with self._lock:
+            self._tokens += 1
+            self._stats['hedged'] -= 1
+
+    def _submit(self, func, *args, **kwargs):
+        """
+        Runs the read on the pool, or returns None if every thread of
+        the pool is busy, rather than queueing it.
+        """
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    size = settings.MAX_CONCURRENT_REQUESTS * 4
+                    self._slots = threading.BoundedSemaphore(size)
+                    self._executor = ContextThreadPoolExecutor(
+                        max_workers=size)
+        if not self._slots.acquire(False):
+            with self._lock:
+                self._stats['pool_full'] += 1
+            return None
+
+        def hedgeable(*args, **kwargs):
+            _local.hedging = True
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _local.hedging = False
+
+        try:
+            future = self._executor.submit(hedgeable, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+    def call(self, name, func, *args, **kwargs):
+        """Makes the read func(*args, **kwargs), hedged if need be."""
+        if getattr(_local, 'hedging', False) or not get_setting(
+                self.dependency, 'hedge_percentile'):
+            return func(*args, **kwargs)
+        self._earn()
+        delay = self.delay(name)
+        start = time()
+        primary = None
+        if delay is not None:
+            primary = self._submit(func, *args, **kwargs)
+        if primary is None:
+            result = func(*args, **kwargs)
+            self._record(name, time() - start)
+            return result
+
+        primary.add_done_callback(
+            lambda future: self._record(name, time() - start))
+        done, pending = wait([primary], timeout=delay)
+        if done or not self._spend():
+            return primary.result()
+
+        hedge = self._submit(func, *args, **kwargs)
+        if hedge is None:
+            self._refund()
+            return primary.result()
+        pending = set([primary, hedge])
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        with self._lock:
+                            self._stats['hedge_wins'] += 1
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+_hedgers = {}
+
+
+def get_hedger(dependency):
+    hedger = _hedgers.get(dependency)
+    if hedger is None:
+        with _breakers_lock:
+            hedger = _hedgers.setdefault(dependency, Hedger(dependency))
+    return hedger
+
+
+def hedge_stats():
+    """Reads, hedges and hedges that answered first, by dependency."""
+    return {dependency: hedger.stats()
+            for dependency, hedger in list(_hedgers.items())}
+
+
+# Keep naming and recording calls made from a request's worker threads,
+# and holding them to its deadline.
+register_context_propagator(
+    lambda: functools.partial(
+        _restored_context, dict(_get_labels()), get_request_calls(),
+        get_deadline()))
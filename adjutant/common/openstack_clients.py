@@ -13,7 +13,16 @@
 #    under the License.
 
 
+from logging import getLogger
+import threading
+from time import time
+
+import requests
+from six.moves.urllib.parse import urlparse
+
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
 from keystoneauth1.identity import v3
 from keystoneauth1 import session
@@ -24,6 +33,9 @@ from neutronclient.v2_0 import client as neutronclient
 from novaclient import client as novaclient
 from octaviaclient.api.v2 import octavia
 
+from adjutant.common import dependencies, service_token
+from adjutant.exceptions import DependencyUnavailable
+
 # Defined for use locally
 DEFAULT_COMPUTE_VERSION = "2"
 DEFAULT_IDENTITY_VERSION = "3"
@@ -36,58 +48,395 @@ DEFAULT_VOLUME_VERSION = "2"
 # Auth session shared by default with all clients
 client_auth_session = None
 
+# Version discovery documents, kept across rebuilds of the auth session
+_discovery_cache = {}
+
+# Pooled clients, as {(dependency, region, version): client}
+_clients = {}
+
+_clients_lock = threading.RLock()
+
+# Public Octavia endpoints, as {region: (url, expiry timestamp)}
+_octavia_endpoints = {}
+
+# Spreads identity calls over KEYSTONE['endpoints'], if set
+_keystone_balancer = None
+
+# Keeps the auth session's token fresh, and shared between workers
+_service_token_manager = None
+
+
+@receiver(setting_changed)
+def _reset_on_keystone_change(setting, **kwargs):
+    if setting == 'KEYSTONE':
+        reset_clients()
+
+
+def reset_clients():
+    """
+    Drops the shared auth session, every pooled client and the cached
+    endpoints, so the next call to a get_*client function builds them
+    again.
+    """
+    global client_auth_session, _keystone_balancer, _service_token_manager
+    with _clients_lock:
+        _clients.clear()
+        _octavia_endpoints.clear()
+        client_auth_session = None
+        _keystone_balancer = None
+        manager, _service_token_manager = _service_token_manager, None
+    if manager is not None:
+        manager.stop()
+
+
+def _build_auth_session():
+    auth = v3.Password(
+        username=settings.KEYSTONE['username'],
+        password=settings.KEYSTONE['password'],
+        project_name=settings.KEYSTONE['project_name'],
+        auth_url=settings.KEYSTONE['auth_url'],
+        user_domain_id=settings.KEYSTONE.get('domain_id', "default"),
+        project_domain_id=settings.KEYSTONE.get('domain_id', "default"),
+    )
+
+    # NOTE: requests keeps 10 connections per host by default, which
+    # concurrent calls from one worker use up quickly, so the pool is
+    # sized from config. A session we pass in doesn't get keystoneauth's
+    # keep-alive adapters mounted, so we mount them ourselves.
+    pool_size = settings.KEYSTONE.get('connection_pool_size', 10)
+    http_session = requests.Session()
+    for scheme in ('https://', 'http://'):
+        http_session.mount(scheme, session.TCPKeepAliveAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size))
+
+    auth_session = session.Session(
+        auth=auth, session=http_session,
+        discovery_cache=_discovery_cache,
+        timeout=dependencies.get_setting('keystone', 'timeout'))
+    get_service_token_manager().attach(auth, auth_session)
+    return auth_session
+
 
 def get_auth_session():
     """ Returns a global auth session to be shared by all clients """
     global client_auth_session
     if not client_auth_session:
-
-        auth = v3.Password(
-            username=settings.KEYSTONE['username'],
-            password=settings.KEYSTONE['password'],
-            project_name=settings.KEYSTONE['project_name'],
-            auth_url=settings.KEYSTONE['auth_url'],
-            user_domain_id=settings.KEYSTONE.get('domain_id', "default"),
-            project_domain_id=settings.KEYSTONE.get('domain_id', "default"),
-        )
-        client_auth_session = session.Session(auth=auth)
+        with _clients_lock:
+            if not client_auth_session:
+                client_auth_session = _build_auth_session()
 
     return client_auth_session
 
 
+def get_service_token_manager():
+    """
+    Returns the ServiceTokenManager for the auth session's token, as
+    set up by SERVICE_TOKEN.
+    """
+    global _service_token_manager
+    if _service_token_manager is None:
+        with _clients_lock:
+            if _service_token_manager is None:
+                _service_token_manager = service_token.build_manager()
+    return _service_token_manager
+
+
+def start_service_token_refresh():
+    """
+    Sets up the auth session, using the stored token if it is fresh
+    enough, and starts refreshing the token in the background, which
+    authenticates straight away if there was no fresh stored token.
+    """
+    get_auth_session()
+    get_service_token_manager().start()
+
+
+class EndpointBalancer(object):
+    """
+    Spreads the calls to a dependency with several interchangeable
+    endpoints (such as Keystone replicas) over those that are healthy.
+
+    Reads go to the endpoint with the fewest calls in progress from
+    this worker, and are retried on another endpoint if theirs fails.
+    Writes always go to the first healthy endpoint in the configured
+    order, so they land on the same replica and aren't retried.
+
+    Health is checked passively: each endpoint has its own circuit
+    breaker, using the dependency's settings, which takes it out of
+    rotation after failure_threshold consecutive failures and lets a
+    probe call through once reset_timeout has passed.
+
+    Calls are balanced if their URL starts with one of the endpoints or
+    aliases (such as the auth_url), or is relative to the dependency's
+    service_type in the catalog.
+    """
+
+    READS = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, dependency, urls, service_type, aliases=()):
+        self.dependency = dependency
+        self.service_type = service_type
+        self.endpoints = [
+            _Endpoint(url.rstrip('/'), dependencies.CircuitBreaker(
+                "%s (%s)" % (dependency, url), dependency))
+            for url in urls]
+        self.prefixes = sorted(
+            set([endpoint.url for endpoint in self.endpoints]
+                + [alias.rstrip('/') for alias in aliases if alias]),
+            key=len, reverse=True)
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def _rebase(self, url, kwargs):
+        """
+        Returns a function giving the url (and kwargs) of the call for
+        an endpoint, or None if the call isn't to be balanced.
+        """
+        for prefix in self.prefixes:
+            if url == prefix or url.startswith(prefix + '/'):
+                path = url[len(prefix):]
+                return lambda endpoint: (endpoint.url + path, kwargs)
+        endpoint_filter = kwargs.get('endpoint_filter') or {}
+        if (not urlparse(url).netloc and not kwargs.get('endpoint_override')
+                and endpoint_filter.get('service_type') == self.service_type):
+            return lambda endpoint: (
+                url, dict(kwargs, endpoint_override=endpoint.url))
+        return None
+
+    def _choose(self, write, tried):
+        """
+        The endpoint for the next attempt at a call, claiming one of its
+        outstanding calls, or None if there are no healthy ones left.
+        """
+        with self._lock:
+            healthy = [endpoint for endpoint in self.endpoints
+                       if endpoint not in tried
+                       and endpoint.breaker.state != endpoint.breaker.OPEN]
+            if not healthy:
+                return None
+            if write:
+                endpoint = healthy[0]
+            else:
+                # start from a rotating point, so idle endpoints share
+                # the calls rather than the first taking all of them
+                start = self._next % len(healthy)
+                self._next += 1
+                rotated = healthy[start:] + healthy[:start]
+                endpoint = min(rotated, key=lambda e: e.outstanding)
+            endpoint.outstanding += 1
+        return endpoint
+
+    def _release(self, endpoint):
+        with self._lock:
+            endpoint.outstanding -= 1
+
+    def request(self, send, url, method, **kwargs):
+        """Makes a call with send(url, method, **kwargs), balanced."""
+        rebase = self._rebase(url, kwargs)
+        if rebase is None:
+            return send(url, method, **kwargs)
+        write = method.upper() not in self.READS
+        tried = []
+        while True:
+            endpoint = self._choose(write, tried)
+            if endpoint is None:
+                e = DependencyUnavailable(
+                    "%s is unavailable, none of its endpoints are healthy."
+                    % self.dependency)
+                e.adjutant_dependency = self.dependency
+                e.retry_after = dependencies.get_setting(
+                    self.dependency, 'reset_timeout')
+                raise e
+            tried.append(endpoint)
+            last_attempt = write or len(tried) == len(self.endpoints)
+            try:
+                endpoint_url, endpoint_kwargs = rebase(endpoint)
+                with endpoint.breaker.guard() as outcome, \
+                        dependencies.within_deadline(
+                            self.dependency,
+                            endpoint_kwargs.get('timeout')) as timeout:
+                    endpoint_kwargs['timeout'] = timeout
+                    response = send(endpoint_url, method, **endpoint_kwargs)
+                    outcome.failed = response.status_code >= 500
+            except DependencyUnavailable:
+                # another call is already probing this endpoint
+                if last_attempt:
+                    raise
+                continue
+            except Exception as e:
+                if last_attempt or not dependencies.is_failure(e):
+                    raise
+                getLogger('adjutant').warning(
+                    "Retrying %s %s on another endpoint after: %s"
+                    % (method, url, e))
+                continue
+            finally:
+                self._release(endpoint)
+            if outcome.failed and not last_attempt:
+                continue
+            return response
+
+    def states(self):
+        """The health of each endpoint, as {url: breaker state}."""
+        return {endpoint.url: endpoint.breaker.state
+                for endpoint in self.endpoints}
+
+
+class _Endpoint(object):
+
+    def __init__(self, url, breaker):
+        self.url = url
+        self.breaker = breaker
+        self.outstanding = 0
+
+
+def get_keystone_balancer():
+    """
+    Returns the EndpointBalancer for Keystone's replicas, or None if
+    KEYSTONE['endpoints'] isn't set.
+    """
+    global _keystone_balancer
+    urls = settings.KEYSTONE.get('endpoints')
+    if not urls:
+        return None
+    if _keystone_balancer is None:
+        with _clients_lock:
+            if _keystone_balancer is None:
+                _keystone_balancer = EndpointBalancer(
+                    'keystone', urls, 'identity',
+                    aliases=[settings.KEYSTONE['auth_url']])
+    return _keystone_balancer
+
+
+class GuardedSession(session.Session):
+    """
+    Session for the calls to one dependency, guarded by its circuit
+    breaker and recorded in the dependency metrics.
+
+    Requests without authentication are the token requests made by the
+    auth plugin, so those go through the Keystone breaker instead.
+    Server errors count as failures even when the client asked for the
+    response rather than an exception. Calls to Keystone are spread
+    over its endpoints if there are several. Calls are held to the
+    request's deadline, if it has one.
+    """
+
+    def __init__(self, breaker, **kwargs):
+        super(GuardedSession, self).__init__(**kwargs)
+        self.breaker = breaker
+
+    def request(self, url, method, **kwargs):
+        breaker = self.breaker
+        if kwargs.get('authenticated') is False:
+            breaker = dependencies.get_breaker('keystone')
+        with dependencies.track(
+                breaker.dependency, method, breaker.region), \
+                breaker.guard() as outcome, \
+                dependencies.within_deadline(
+                    breaker.dependency, self.timeout) as timeout:
+            kwargs['timeout'] = timeout
+            send = super(GuardedSession, self).request
+            balancer = (get_keystone_balancer()
+                        if breaker.dependency == 'keystone' else None)
+            if balancer is not None:
+                response = balancer.request(send, url, method, **kwargs)
+            else:
+                response = send(url, method, **kwargs)
+            outcome.failed = response.status_code >= 500
+        return response
+
+
+def _get_session(dependency, region=None):
+    """
+    Returns a session for calls to a dependency, sharing the auth and
+    connection pool of the auth session, but with the dependency's own
+    timeout and circuit breaker.
+    """
+    auth_session = get_auth_session()
+    return GuardedSession(
+        dependencies.get_breaker(dependency, region),
+        auth=auth_session.auth, session=auth_session.session,
+        discovery_cache=_discovery_cache,
+        timeout=dependencies.get_setting(dependency, 'timeout'))
+
+
+def _get_client(dependency, region, version, build):
+    """
+    Returns the pooled client for (dependency, region, version),
+    calling build() with a session for the dependency to create it the
+    first time it is asked for.
+
+    The clients only hold their session and endpoint, so a single
+    instance is safe to use from every thread in the worker.
+    """
+    key = (dependency, region, version)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = build(
+                    _get_session(dependency, region))
+    return client
+
+
 def get_keystoneclient(version=DEFAULT_IDENTITY_VERSION):
-    return ks_client.Client(
-        version,
-        session=get_auth_session())
+    return _get_client(
+        'keystone', None, version,
+        lambda session: ks_client.Client(
+            version,
+            session=session))
 
 
 def get_neutronclient(region):
     # always returns neutron client v2
-    return neutronclient.Client(
-        session=get_auth_session(),
-        region_name=region)
+    return _get_client(
+        'neutron', region, '2',
+        lambda session: neutronclient.Client(
+            session=session,
+            region_name=region))
 
 
 def get_novaclient(region, version=DEFAULT_COMPUTE_VERSION):
-    return novaclient.Client(
-        version,
-        session=get_auth_session(),
-        region_name=region)
+    return _get_client(
+        'nova', region, version,
+        lambda session: novaclient.Client(
+            version,
+            session=session,
+            region_name=region))
 
 
 def get_cinderclient(region, version=DEFAULT_VOLUME_VERSION):
-    return cinderclient.Client(
-        version,
-        session=get_auth_session(),
-        region_name=region)
+    return _get_client(
+        'cinder', region, version,
+        lambda session: cinderclient.Client(
+            version,
+            session=session,
+            region_name=region))
 
 
-def get_octaviaclient(region):
-    ks = get_keystoneclient()
+def _get_octavia_endpoint(region):
+    url, expires = _octavia_endpoints.get(region, (None, 0))
+    if expires < time():
+        # NOTE: the token already carries the service catalog, so this
+        # is answered by the session without calling Keystone.
+        url = get_auth_session().get_endpoint(
+            service_type='load-balancer', interface='public',
+            region_name=region)
+        _octavia_endpoints[region] = (
+            url, time() + settings.ENDPOINT_CACHE_TIME)
+    return url
+
 
-    service = ks.services.list(name='octavia')[0]
-    endpoint = ks.endpoints.list(service=service,
-                                 region=region, interface='public')[0]
+def invalidate_octavia_endpoint(region):
+    """
+    Forgets the cached Octavia endpoint for the region, so the next
+    client is built from a fresh catalog lookup.
+    """
+    _octavia_endpoints.pop(region, None)
+
+
+def get_octaviaclient(region):
     return octavia.OctaviaAPI(
-        session=get_auth_session(),
-        endpoint=endpoint.url)
+        session=_get_session('octavia', region),
+        endpoint=_get_octavia_endpoint(region))
@@ -12,12 +12,82 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import functools
 
-from adjutant.common import openstack_clients
+from adjutant.common import dependencies, openstack_clients
+from adjutant.common.cache import SharedCache
+from adjutant.common.utils import SingleFlight
 
 from django.conf import settings
 
 
+# Identical quota and usage reads in progress at the same time, such as
+# from many users of a project opening the quota page, share one call.
+quota_reads = SingleFlight('quota')
+
+# Quota and usage reads, kept for QUOTA_CACHE_TIME seconds if set.
+quota_cache = SharedCache('quota')
+
+_CACHED_READS = ('get_quota', 'get_usage')
+
+
+def _helper_namespace(helper):
+    return (type(helper).__name__, helper.region_name, helper.project_id)
+
+
+def _coalesced(func):
+    """
+    Answers the helper's read from the quota cache, or else shares it
+    with identical ones already in progress, across workers too if a
+    lock store is set.
+    """
+    def read(self, key):
+        result = func(self)
+        quota_cache.set(key, result, settings.QUOTA_CACHE_TIME)
+        return result
+
+    @functools.wraps(func)
+    def wrapper(self):
+        key = (_helper_namespace(self), func.__name__)
+        if settings.QUOTA_CACHE_TIME:
+            result = quota_cache.get(key)
+            if result is not None:
+                return result
+        return quota_reads.do(
+            _helper_namespace(self), func.__name__, read, self, key,
+            shared=True)
+    return wrapper
+
+
+def _forgets_reads(func):
+    """Starts later reads afresh once the helper has written."""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            namespace = _helper_namespace(self)
+            quota_reads.forget(namespace)
+            for name in _CACHED_READS:
+                quota_cache.delete((namespace, name))
+    return wrapper
+
+
+def _invalidate_octavia_on_error(func):
+    """
+    Drops the helper's cached Octavia endpoint if a call fails, in case
+    the endpoint has moved.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except Exception:
+            openstack_clients.invalidate_octavia_endpoint(self.region_name)
+            raise
+    return wrapper
+
+
 class QuotaManager(object):
     """
     A manager to allow easier updating and access to quota information
@@ -27,18 +97,23 @@ class QuotaManager(object):
     default_size_diff_threshold = .2
 
     class ServiceQuotaHelper(object):
+        @_forgets_reads
         def set_quota(self, values):
             self.client.quotas.update(self.project_id, **values)
 
+    @dependencies.instrumented('cinder')
     class ServiceQuotaCinderHelper(ServiceQuotaHelper):
         def __init__(self, region_name, project_id):
             self.client = openstack_clients.get_cinderclient(
                 region=region_name)
+            self.region_name = region_name
             self.project_id = project_id
 
+        @_coalesced
         def get_quota(self):
             return self.client.quotas.get(self.project_id).to_dict()
 
+        @_coalesced
         def get_usage(self):
             volumes = self.client.volumes.list(
                 search_opts={'all_tenants': 1, 'project_id': self.project_id})
@@ -56,15 +131,19 @@ class QuotaManager(object):
                     'snapshots': len(snapshots)
                     }
 
+    @dependencies.instrumented('nova')
     class ServiceQuotaNovaHelper(ServiceQuotaHelper):
         def __init__(self, region_name, project_id):
             self.client = openstack_clients.get_novaclient(
                 region=region_name)
+            self.region_name = region_name
             self.project_id = project_id
 
+        @_coalesced
         def get_quota(self):
             return self.client.quotas.get(self.project_id).to_dict()
 
+        @_coalesced
         def get_usage(self):
             nova_usage = self.client.limits.get(
                 tenant_id=self.project_id).to_dict()['absolute']
@@ -82,18 +161,22 @@ class QuotaManager(object):
 
             return nova_usage_dict
 
+    @dependencies.instrumented('neutron')
     class ServiceQuotaNeutronHelper(ServiceQuotaHelper):
         def __init__(self, region_name, project_id):
             self.client = openstack_clients.get_neutronclient(
                 region=region_name)
+            self.region_name = region_name
             self.project_id = project_id
 
+        @_forgets_reads
         def set_quota(self, values):
             body = {
                 'quota': values
             }
             self.client.update_quota(self.project_id, body)
 
+        @_coalesced
         def get_usage(self):
             networks = self.client.list_networks(
                 tenant_id=self.project_id)['networks']
@@ -119,15 +202,20 @@ class QuotaManager(object):
                     'security_group_rule': len(security_group_rules)
                     }
 
+        @_coalesced
         def get_quota(self):
             return self.client.show_quota(self.project_id)['quota']
 
+    @dependencies.instrumented('octavia')
     class ServiceQuotaOctaviaHelper(ServiceQuotaNeutronHelper):
         def __init__(self, region_name, project_id):
             self.client = openstack_clients.get_octaviaclient(
                 region=region_name)
+            self.region_name = region_name
             self.project_id = project_id
 
+        @_coalesced
+        @_invalidate_octavia_on_error
         def get_quota(self):
             project_quota = self.client.quota_show(
                 project_id=self.project_id)
@@ -145,9 +233,13 @@ class QuotaManager(object):
 
             return project_quota
 
+        @_forgets_reads
+        @_invalidate_octavia_on_error
         def set_quota(self, values):
             self.client.quota_set(self.project_id, json={'quota': values})
 
+        @_coalesced
+        @_invalidate_octavia_on_error
         def get_usage(self):
             usage = {}
             usage['load_balancer'] = len(self.client.load_balancer_list(
@@ -0,0 +1,262 @@
+# Copyright (C) 2019 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Keeps Adjutant's own (service) token fresh in the background, so user
+requests never wait on authenticating with Keystone, and shares it
+between the worker processes through a token store, chosen by name in
+the SERVICE_TOKEN setting, so they don't each authenticate.
+"""
+
+from contextlib import contextmanager
+import fcntl
+from logging import getLogger
+import os
+import threading
+from time import sleep, time
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from adjutant.common import dependencies
+from adjutant.common.cache import SharedCache
+
+
+class TokenStore(object):
+    """
+    Holds the service token's auth state (as given by the auth plugin's
+    get_auth_state) for every worker, and a lock so only one worker
+    authenticates at a time.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+
+    def load(self):
+        return None
+
+    def save(self, state):
+        pass
+
+    @contextmanager
+    def lock(self):
+        """Yields whether the lock was taken, without waiting for it."""
+        yield True
+
+
+class FileTokenStore(TokenStore):
+    """
+    Keeps the token in a local file only readable by Adjutant's user,
+    for workers on the same host.
+
+    Example options:
+        path: /var/lib/adjutant/service-token.json
+    """
+
+    def __init__(self, path, **options):
+        super(FileTokenStore, self).__init__(**options)
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as state:
+                return state.read() or None
+        except IOError:
+            return None
+
+    def save(self, state):
+        temp_path = "%s.%s" % (self.path, uuid4().hex)
+        descriptor = os.open(
+            temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(descriptor, 'w') as temp:
+            temp.write(state)
+        os.rename(temp_path, self.path)
+
+    @contextmanager
+    def lock(self):
+        with open(self.path + '.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class CacheTokenStore(TokenStore):
+    """
+    Keeps the token in the shared cache tier (SHARED_CACHE), for
+    workers on any host using that cache. Only use a cache no one but
+    Adjutant can read.
+
+    Example options:
+        lock_timeout: 60
+    """
+
+    def __init__(self, lock_timeout=60, **options):
+        super(CacheTokenStore, self).__init__(**options)
+        self.lock_timeout = lock_timeout
+        self._cache = SharedCache('service_token')
+
+    def load(self):
+        return self._cache.get('state')
+
+    def save(self, state):
+        # no longer than the cache keeps anything else
+        self._cache.set('state', state, 24 * 60 * 60)
+
+    @contextmanager
+    def lock(self):
+        backend = self._cache.backend
+        key = self._cache._key('lock')
+        holder = uuid4().hex
+        if not backend.add(key, holder, self.lock_timeout):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            if backend.get(key) == holder:
+                backend.delete(key)
+
+
+TOKEN_STORES = {
+    'local': TokenStore,
+    'file': FileTokenStore,
+    'cache': CacheTokenStore,
+}
+
+
+def register_token_store(name, store_class):
+    TOKEN_STORES[name] = store_class
+
+
+class ServiceTokenManager(object):
+    """
+    Refreshes the token of an auth plugin once it has less than
+    refresh_before seconds left, checking every check_interval seconds
+    from a background thread once started.
+
+    A token in the store that is fresh enough is used rather than
+    authenticating, and only the worker holding the store's lock
+    authenticates, with the others waiting up to wait seconds for its
+    token. So after a restart of every worker Keystone sees one
+    authentication, not one per worker.
+    """
+
+    def __init__(self, store, refresh_before=600, check_interval=30,
+                 wait=10):
+        self.store = store
+        self.refresh_before = refresh_before
+        self.check_interval = check_interval
+        self.wait = wait
+        self._auth = None
+        self._session = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _is_fresh(self, auth_ref):
+        return auth_ref is not None and not auth_ref.will_expire_soon(
+            self.refresh_before)
+
+    def attach(self, auth, session):
+        """Manages the token of the auth plugin used by the session."""
+        self._auth = auth
+        self._session = session
+        self._load()
+
+    def _load(self):
+        """Installs the stored token, if it is fresh enough to use."""
+        state = self.store.load()
+        if not state:
+            return False
+        current = self._auth.auth_ref
+        try:
+            self._auth.set_auth_state(state)
+        except (ValueError, KeyError, TypeError) as e:
+            getLogger('adjutant').warning(
+                "Ignoring unreadable stored service token: %s" % e)
+            self._auth.auth_ref = current
+            return False
+        if not self._is_fresh(self._auth.auth_ref):
+            self._auth.auth_ref = current
+            return False
+        return True
+
+    def ensure_fresh(self):
+        """
+        Makes sure the token has at least refresh_before seconds left,
+        from the store or by authenticating.
+        """
+        if self._auth is None or self._is_fresh(self._auth.auth_ref):
+            return
+        if self._load():
+            return
+        with self.store.lock() as locked:
+            if locked:
+                # the previous holder may have just stored one
+                if self._load():
+                    return
+                with dependencies.track('keystone', 'service_token'):
+                    self._auth.auth_ref = self._auth.get_auth_ref(
+                        self._session)
+                self.store.save(self._auth.get_auth_state())
+                return
+        # another worker is authenticating, so wait for its token
+        end = time() + self.wait
+        while time() < end:
+            sleep(min(0.1, self.wait))
+            if self._load():
+                return
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                self.ensure_fresh()
+            except Exception as e:
+                getLogger('adjutant').warning(
+                    "Failed to refresh the service token: %s" % e)
+            if self._stopped.wait(self.check_interval):
+                return
+
+
+def build_manager():
+    """The ServiceTokenManager set up by SERVICE_TOKEN."""
+    conf = dict(settings.SERVICE_TOKEN)
+    store_name = conf.pop('store', 'local')
+    try:
+        store_class = TOKEN_STORES[store_name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            "Unknown service token store: %s" % store_name)
+    store = store_class(**conf.pop('options', {}))
+    return ServiceTokenManager(store, **conf)
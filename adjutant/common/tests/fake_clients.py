@@ -12,12 +12,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
 from uuid import uuid4
 
 from django.conf import settings
 
 import mock
 
+from adjutant.common.user_store import UserAssignments
+
 
 identity_cache = {}
 neutron_cache = {}
@@ -187,7 +190,7 @@ class FakeManager(object):
         else:
             return self.get_domain(domain)
 
-    def find_user(self, name, domain):
+    def find_user(self, name, domain, use_filter=False, fresh=False):
         domain = self._domain_from_id(domain)
         global identity_cache
         for user in identity_cache['users'].values():
@@ -210,7 +213,8 @@ class FakeManager(object):
 
                 user = users.get(assignment.user['id'])
                 if not user:
-                    user = self.get_user(assignment.user['id'])
+                    # NOTE: copied as Keystone gives new objects per call.
+                    user = copy.copy(self.get_user(assignment.user['id']))
                     user.roles = []
                     user.inherited_roles = []
                     users[user.id] = user
@@ -238,7 +242,8 @@ class FakeManager(object):
 
                     user = users.get(assignment.user['id'])
                     if not user:
-                        user = self.get_user(assignment.user['id'])
+                        user = copy.copy(
+                            self.get_user(assignment.user['id']))
                         user.roles = []
                         user.inherited_roles = []
                         users[user.id] = user
@@ -249,6 +254,33 @@ class FakeManager(object):
 
         return users.values()
 
+    def list_user_assignments(self, project):
+        return sorted(
+            (UserAssignments(user.id, user.domain_id,
+                             tuple(role.id for role in user.roles),
+                             tuple(role.id for role in user.inherited_roles))
+             for user in self.list_users(project)),
+            key=lambda user_assignments: user_assignments.user_id)
+
+    def list_inherited_user_assignments(self, project):
+        return sorted(
+            (UserAssignments(user.id, user.domain_id,
+                             tuple(role.id for role in user.roles), ())
+             for user in self.list_inherited_users(project)),
+            key=lambda user_assignments: user_assignments.user_id)
+
+    def get_users(self, assignments):
+        users = [self.get_user(user_assignments.user_id)
+                 for user_assignments in assignments]
+        return [copy.copy(user) for user in users if user]
+
+    def get_role(self, role_id):
+        global identity_cache
+        for role in identity_cache['roles'].values():
+            if role.id == role_id:
+                return role
+        return None
+
     def create_user(self, name, password, email, created_on,
                     domain='default', default_project=None):
         domain = self._domain_from_id(domain)
@@ -310,6 +342,10 @@ class FakeManager(object):
 
         return roles
 
+    def get_project_roles(self, user, project):
+        return (self.get_roles(user, project),
+                self.get_roles(user, project, inherited=True))
+
     def _get_roles_as_names(self, user, project, inherited=False):
         return [r.name for r in self.get_roles(user, project, inherited)]
 
@@ -365,7 +401,24 @@ class FakeManager(object):
         if role_assignment in identity_cache['role_assignments']:
             identity_cache['role_assignments'].remove(role_assignment)
 
-    def find_project(self, project_name, domain):
+    def add_user_roles(self, assignments):
+        return self._edit_user_roles(self.add_user_role, assignments)
+
+    def remove_user_roles(self, assignments):
+        return self._edit_user_roles(self.remove_user_role, assignments)
+
+    def _edit_user_roles(self, edit, assignments):
+        results = []
+        for user, role, project, inherited in assignments:
+            try:
+                edit(user, role, project, inherited=inherited)
+                results.append(None)
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def find_project(self, project_name, domain, use_filter=False,
+                     fresh=False):
         domain = self._domain_from_id(domain)
         global identity_cache
         for project in identity_cache['projects'].values():
@@ -448,6 +501,11 @@ class FakeManager(object):
         global identity_cache
         return identity_cache['regions'].values()
 
+    def refresh_topology(self):
+        global identity_cache
+        return (list(identity_cache['regions'].values()),
+                list(identity_cache['domains'].values()))
+
     def list_credentials(self, user_id, cred_type=None):
         global identity_cache
         found = []
@@ -0,0 +1,261 @@
+# Copyright (C) 2019 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import pickle
+import shutil
+import tempfile
+
+import mock
+
+from django.core.cache import caches
+from django.test.utils import override_settings
+
+from keystonemiddleware.auth_token import AuthProtocol
+
+from adjutant import middleware
+from adjutant.common import cache, quota, user_store
+from adjutant.common.tests import fake_clients
+from adjutant.common.tests.utils import AdjutantTestCase
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'adjutant-tests',
+    },
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SHARED_CACHE='shared')
+class SharedCacheTests(AdjutantTestCase):
+
+    def setUp(self):
+        caches['shared'].clear()
+        cache.metrics.reset()
+        self.addCleanup(cache.metrics.reset)
+
+    def check_cache(self):
+        shared = cache.SharedCache('test')
+        self.assertIsNone(shared.get(('key', 1)))
+        shared.set(('key', 1), {'value': 1}, 60)
+        self.assertEqual(shared.get(('key', 1)), {'value': 1})
+        # not cached at all without a ttl
+        shared.set('other_key', 'value', 0)
+        self.assertIsNone(shared.get('other_key'))
+
+        # a separate instance (or worker) sees the same keys
+        self.assertEqual(cache.SharedCache('test').get(('key', 1)),
+                         {'value': 1})
+        self.assertIsNone(cache.SharedCache('other').get(('key', 1)))
+
+        self.assertEqual(shared.counter('counter'), 0)
+        self.assertEqual(shared.incr('counter'), 1)
+        self.assertEqual(shared.incr('counter'), 2)
+
+        shared.invalidate()
+        self.assertIsNone(shared.get(('key', 1)))
+        self.assertEqual(shared.counter('counter'), 0)
+
+        self.assertEqual(cache.metrics.snapshot()['test'], {
+            'hits': 2, 'misses': 3, 'sets': 1, 'invalidations': 1,
+            'errors': 0, 'hit_rate': 0.4})
+
+    def test_local_memory(self):
+        self.check_cache()
+
+    def test_file_based(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with override_settings(CACHES={
+                'shared': {
+                    'BACKEND':
+                        'django.core.cache.backends.filebased.FileBasedCache',
+                    'LOCATION': directory,
+                }}):
+            self.check_cache()
+
+    def test_private(self):
+        private = cache.SharedCache('test', shared=False)
+        private.set('key', 'value', 60)
+        self.assertEqual(private.get('key'), 'value')
+        self.assertIsNone(cache.SharedCache('test').get('key'))
+        self.assertIsNone(
+            cache.SharedCache('test', shared=False).get('key'))
+
+    def test_backend_errors_are_misses(self):
+        shared = cache.SharedCache('test')
+        with mock.patch.object(caches['shared'], 'get',
+                               side_effect=IOError("unreachable")):
+            self.assertIsNone(shared.get('key'))
+            shared.set('key', 'value', 60)
+        self.assertEqual(cache.metrics.snapshot()['test']['errors'], 2)
+
+    def test_cached_resource(self):
+        role = fake_clients.FakeRole('_member_')
+        cached = pickle.loads(pickle.dumps(
+            cache.CachedResource.from_resource(role)))
+        self.assertEqual((cached.id, cached.name), (role.id, role.name))
+        self.assertEqual(cached.to_dict(), {'id': role.id, 'name': role.name})
+
+
+class Resource(object):
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SHARED_CACHE='shared')
+class SharedIdentityCacheTests(AdjutantTestCase):
+
+    def setUp(self):
+        caches['shared'].clear()
+
+    def test_role_catalog(self):
+        roles = [fake_clients.FakeRole('_member_')]
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return roles
+
+        first = user_store.RoleCatalog(loader=loader, shared=True)
+        second = user_store.RoleCatalog(loader=loader, shared=True)
+        self.assertEqual(first.find('_member_').id, roles[0].id)
+        self.assertEqual(second.find('_member_').id, roles[0].id)
+        self.assertEqual(len(loads), 1)
+
+        # a role unknown to the shared copy goes to keystone, and the
+        # other workers pick it up from the newer shared copy
+        roles.append(fake_clients.FakeRole('project_mod'))
+        self.assertIsNotNone(second.find('project_mod'))
+        self.assertIsNotNone(first.find('project_mod'))
+        self.assertEqual(len(loads), 2)
+
+        # invalidating drops the shared copy too
+        first.invalidate()
+        second.invalidate()
+        first.find('_member_')
+        second.find('_member_')
+        self.assertEqual(len(loads), 3)
+
+    def test_topology(self):
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return ([Resource(id='RegionOne')],
+                    [Resource(id='default', name='Default')])
+
+        for i in range(2):
+            topology = user_store.TopologyCache(loader=loader, shared=True)
+            self.addCleanup(topology.stop)
+            self.assertEqual(topology.find_domain('Default').id, 'default')
+        self.assertEqual(len(loads), 1)
+
+    def test_membership(self):
+        first = user_store.MembershipCache(shared=True)
+        second = user_store.MembershipCache(shared=True)
+        first.set('project_id', 'key', first.version('project_id'),
+                  {'users': []})
+        self.assertEqual(second.get('project_id', 'key'), {'users': []})
+        second.bump('project_id')
+        self.assertIsNone(first.get('project_id', 'key'))
+
+
+class FakeHelper(object):
+
+    def __init__(self):
+        self.region_name = 'RegionOne'
+        self.project_id = 'project_id'
+        self.reads = 0
+
+    @quota._coalesced
+    def get_quota(self):
+        self.reads += 1
+        return {'cores': 20}
+
+    @quota._forgets_reads
+    def set_quota(self, values):
+        pass
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SHARED_CACHE='shared')
+class QuotaCacheTests(AdjutantTestCase):
+
+    def setUp(self):
+        caches['shared'].clear()
+
+    def test_disabled_by_default(self):
+        helper = FakeHelper()
+        helper.get_quota()
+        helper.get_quota()
+        self.assertEqual(helper.reads, 2)
+
+    @override_settings(QUOTA_CACHE_TIME=60)
+    def test_cached_until_set(self):
+        helper = FakeHelper()
+        self.assertEqual(helper.get_quota(), {'cores': 20})
+        self.assertEqual(FakeHelper().get_quota(), {'cores': 20})
+        self.assertEqual(helper.reads, 1)
+
+        helper.set_quota({'cores': 40})
+        helper.get_quota()
+        self.assertEqual(helper.reads, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, SHARED_CACHE='shared')
+class AuthTokenCacheTests(AdjutantTestCase):
+
+    def setUp(self):
+        caches['shared'].clear()
+        cache.metrics.reset()
+        self.addCleanup(cache.metrics.reset)
+
+    def token_cache(self):
+        """The token cache of a new worker's auth_token middleware."""
+        protocol = AuthProtocol(mock.Mock(), middleware.auth_token_conf())
+        protocol._token_cache.initialize(
+            {middleware.TOKEN_CACHE_ENVIRON: cache.MemcacheClient(
+                'auth_token')})
+        return protocol._token_cache
+
+    def check_shared(self):
+        data = {'token': {'user': {'id': 'user_id'}}}
+        self.assertIsNone(self.token_cache().get('token_id'))
+        self.token_cache().set('token_id', data)
+        self.assertEqual(self.token_cache().get('token_id'), data)
+
+        snapshot = cache.metrics.snapshot()['auth_token']
+        self.assertEqual((snapshot['hits'], snapshot['misses']), (1, 1))
+        self.assertEqual(snapshot['hit_rate'], 0.5)
+
+    def test_shared(self):
+        self.check_shared()
+
+    @override_settings(AUTH_TOKEN_CACHE={
+        'security_strategy': 'MAC', 'secret_key': 'secret'})
+    def test_signed(self):
+        self.check_shared()
+        stored = [value for key, value in caches['shared']._cache.items()
+                  if ':auth_token:' in key and not key.endswith(':version')]
+        self.assertEqual(len(stored), 1)
+        # stored signed and encoded, not as the plain token data
+        self.assertNotIn(b'user_id', pickle.loads(stored[0]))
+
+    @override_settings(AUTH_TOKEN_CACHE={'shared': False})
+    def test_not_shared(self):
+        self.assertNotIn('cache', middleware.auth_token_conf())
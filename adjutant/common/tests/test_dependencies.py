@@ -0,0 +1,281 @@
+# Copyright (C) 2019 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+from django.test.utils import override_settings
+
+from keystoneauth1 import exceptions as ksa_exceptions
+
+from adjutant.common import dependencies
+from adjutant.common.utils import run_concurrently
+from adjutant.common.tests.utils import AdjutantTestCase
+from adjutant.exceptions import DeadlineExceeded, DependencyUnavailable
+
+
+def call(breaker, exception=None):
+    with breaker.guard():
+        if exception:
+            raise exception
+
+
+@override_settings(DEPENDENCY_SETTINGS={
+    'default': {'failure_threshold': 2, 'reset_timeout': 60}})
+class CircuitBreakerTests(AdjutantTestCase):
+
+    def setUp(self):
+        dependencies.reset_breakers()
+        self.addCleanup(dependencies.reset_breakers)
+        self.breaker = dependencies.get_breaker('nova', 'RegionOne')
+
+    def test_opens_after_threshold(self):
+        self.assertRaises(ksa_exceptions.ConnectFailure, call,
+                          self.breaker, ksa_exceptions.ConnectFailure())
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertRaises(ksa_exceptions.ConnectFailure, call,
+                          self.breaker, ksa_exceptions.ConnectFailure())
+        self.assertEqual(self.breaker.state, 'open')
+
+        self.assertRaises(DependencyUnavailable, call, self.breaker)
+
+        # other regions are unaffected
+        call(dependencies.get_breaker('nova', 'RegionTwo'))
+
+    def test_client_errors_not_counted(self):
+        for i in range(3):
+            self.assertRaises(ksa_exceptions.NotFound, call, self.breaker,
+                              ksa_exceptions.NotFound())
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_half_open_probe(self):
+        for i in range(2):
+            self.assertRaises(ksa_exceptions.ConnectFailure, call,
+                              self.breaker, ksa_exceptions.ConnectFailure())
+
+        with override_settings(DEPENDENCY_SETTINGS={
+                'default': {'failure_threshold': 2, 'reset_timeout': 0}}):
+            self.assertEqual(self.breaker.state, 'half_open')
+            # a failed probe opens the circuit again straight away
+            self.assertRaises(ksa_exceptions.ConnectFailure, call,
+                              self.breaker, ksa_exceptions.ConnectFailure())
+            with self.breaker.guard():
+                # only one probe at a time
+                self.assertRaises(DependencyUnavailable, call, self.breaker)
+            self.assertEqual(self.breaker.state, 'closed')
+
+    def test_outcome_failed(self):
+        for i in range(2):
+            with self.breaker.guard() as outcome:
+                outcome.failed = True
+        self.assertEqual(self.breaker.state, 'open')
+
+    def test_nested_failure_counted_once(self):
+        keystone = dependencies.get_breaker('keystone')
+        for i in range(2):
+            with self.assertRaises(ksa_exceptions.ConnectFailure):
+                with self.breaker.guard():
+                    call(keystone, ksa_exceptions.ConnectFailure())
+
+        self.assertEqual(keystone.state, 'open')
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_setting_fallback(self):
+        self.assertEqual(
+            dependencies.get_setting('nova', 'failure_threshold'), 2)
+        self.assertEqual(dependencies.get_setting('nova', 'timeout'), 30)
+
+
+@dependencies.instrumented('nova')
+class FakeHelper(object):
+
+    def get_quota(self, region=None):
+        with dependencies.track('nova', 'GET', region):
+            pass
+
+    def set_quota(self, fail=False):
+        self.get_quota()
+        with dependencies.track('nova', 'PUT'):
+            if fail:
+                raise ksa_exceptions.ConnectFailure()
+
+
+class DependencyMetricsTests(AdjutantTestCase):
+
+    def setUp(self):
+        dependencies.metrics.reset()
+        self.addCleanup(dependencies.metrics.reset)
+
+    def stats(self):
+        return {(s['dependency'], s['method'], s['region']): s
+                for s in dependencies.metrics.snapshot()}
+
+    def test_calls_named_by_operation(self):
+        helper = FakeHelper()
+        helper.get_quota('RegionOne')
+        self.assertRaises(ksa_exceptions.ConnectFailure,
+                          helper.set_quota, True)
+        with dependencies.track('nova', 'GET'):
+            pass
+
+        stats = self.stats()
+        self.assertEqual(stats[('nova', 'get_quota', 'RegionOne')]['count'],
+                         1)
+        # the outermost operation names all its calls
+        self.assertEqual(stats[('nova', 'set_quota', None)]['count'], 2)
+        self.assertEqual(stats[('nova', 'set_quota', None)]['errors'], 1)
+        self.assertEqual(stats[('nova', 'GET', None)]['count'], 1)
+        self.assertEqual(
+            sum(stats[('nova', 'GET', None)]['latency_buckets'].values()), 1)
+
+    def test_request_calls(self):
+        dependencies.set_request_calls([])
+        self.addCleanup(dependencies.set_request_calls, None)
+
+        helper = FakeHelper()
+        run_concurrently(
+            helper.get_quota, ['RegionOne', 'RegionOne'], max_workers=2)
+        try:
+            helper.set_quota(fail=True)
+        except ksa_exceptions.ConnectFailure:
+            pass
+
+        summary = dependencies.summarize_calls(
+            dependencies.get_request_calls())
+        self.assertEqual(len(summary), 2)
+        self.assertTrue(summary[0].startswith('nova: 2/'))
+        self.assertTrue(summary[0].endswith('(1 errors)'))
+        self.assertTrue(summary[1].startswith('nova@RegionOne: 2/'))
+        self.assertEqual(
+            self.stats()[('nova', 'get_quota', 'RegionOne')]['count'], 2)
+
+
+class HedgerTests(AdjutantTestCase):
+
+    def setUp(self):
+        self.hedger = dependencies.Hedger('keystone')
+        for i in range(dependencies.Hedger.MIN_SAMPLES):
+            self.hedger._record('get_user', 0.01)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.calls = []
+
+    def read(self):
+        """Slow the first time it is called, and fast after that."""
+        self.calls.append(threading.current_thread())
+        if len(self.calls) == 1:
+            self.release.wait(5)
+            return 'slow'
+        return 'fast'
+
+    def test_off_by_default(self):
+        self.release.set()
+        self.assertEqual(self.hedger.call('get_user', self.read), 'slow')
+        self.assertEqual(self.calls, [threading.current_thread()])
+
+    @override_settings(DEPENDENCY_SETTINGS={
+        'keystone': {'hedge_percentile': 90, 'hedge_budget': 1}})
+    def test_slow_read_hedged(self):
+        self.assertEqual(self.hedger.delay('get_user'), 0.01)
+        self.assertEqual(self.hedger.call('get_user', self.read), 'fast')
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.hedger.stats(),
+                         {'reads': 1, 'hedged': 1, 'hedge_wins': 1,
+                          'pool_full': 0})
+
+        # not hedged before there are enough latencies for the read
+        self.calls = []
+        self.release.set()
+        self.assertEqual(self.hedger.call('find_user', self.read), 'slow')
+        self.assertEqual(len(self.calls), 1)
+
+    @override_settings(DEPENDENCY_SETTINGS={
+        'keystone': {'hedge_percentile': 90, 'hedge_budget': 0.5}})
+    def test_budget(self):
+        self.hedger.call('get_user', lambda: time.sleep(0.05))
+        self.assertEqual(self.hedger.stats()['hedged'], 0)
+        self.hedger.call('get_user', lambda: time.sleep(0.05))
+        self.assertEqual(self.hedger.stats()['hedged'], 1)
+
+    @override_settings(MAX_CONCURRENT_REQUESTS=1, DEPENDENCY_SETTINGS={
+        'keystone': {'hedge_percentile': 90, 'hedge_budget': 1}})
+    def test_pool_full(self):
+        """
+        Reads don't queue behind a busy pool, they just aren't hedged.
+        """
+        for i in range(4):
+            self.assertIsNotNone(self.hedger._submit(self.release.wait, 5))
+        self.calls.append('earlier read')
+
+        self.assertEqual(self.hedger.call('get_user', self.read), 'fast')
+        self.assertEqual(self.calls[1:], [threading.current_thread()])
+        self.assertEqual(self.hedger.stats()['pool_full'], 1)
+
+    @override_settings(DEPENDENCY_SETTINGS={
+        'keystone': {'hedge_percentile': 90, 'hedge_budget': 1}})
+    def test_errors(self):
+        def read():
+            raise ksa_exceptions.NotFound()
+
+        self.assertRaises(ksa_exceptions.NotFound,
+                          self.hedger.call, 'get_user', read)
+        self.assertEqual(self.hedger.stats()['hedged'], 0)
+
+
+@override_settings(DEPENDENCY_SETTINGS={
+    'nova': {'timeout': 10, 'failure_threshold': 1}})
+class DeadlineTests(AdjutantTestCase):
+
+    def setUp(self):
+        dependencies.reset_breakers()
+        self.addCleanup(dependencies.reset_breakers)
+        self.addCleanup(dependencies.set_deadline, None)
+
+    def test_no_deadline(self):
+        with dependencies.within_deadline('nova') as timeout:
+            self.assertEqual(timeout, 10)
+        with dependencies.within_deadline('smtp', 60) as timeout:
+            self.assertEqual(timeout, 60)
+
+    def test_time_left(self):
+        dependencies.set_deadline(time.time() + 5)
+        with dependencies.within_deadline('nova') as timeout:
+            self.assertTrue(4 < timeout <= 5)
+        dependencies.set_deadline(time.time() + 60)
+        with dependencies.within_deadline('nova') as timeout:
+            self.assertEqual(timeout, 10)
+
+        # worker threads are held to the same deadline
+        def call(i):
+            with dependencies.within_deadline('nova') as timeout:
+                return timeout
+        dependencies.set_deadline(time.time() + 5)
+        for timeout in run_concurrently(call, range(4)):
+            self.assertTrue(timeout <= 5)
+
+    def test_deadline_exceeded(self):
+        breaker = dependencies.get_breaker('nova')
+        dependencies.set_deadline(time.time() - 1)
+        with self.assertRaises(DeadlineExceeded):
+            with breaker.guard(), dependencies.within_deadline('nova'):
+                pass
+
+        # a call cut short by the deadline isn't held against the service
+        dependencies.set_deadline(time.time() + 0.01)
+        with self.assertRaises(DeadlineExceeded):
+            with breaker.guard(), \
+                    dependencies.within_deadline('nova') as timeout:
+                time.sleep(timeout)
+                raise ksa_exceptions.ConnectTimeout()
+        self.assertEqual(breaker.state, 'closed')
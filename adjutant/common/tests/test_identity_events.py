@@ -0,0 +1,173 @@
+# Copyright (C) 2019 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import override_settings
+
+from adjutant import middleware
+from adjutant.common import identity_events, user_store
+from adjutant.common.tests.utils import AdjutantTestCase
+
+
+class HandleNotificationTests(AdjutantTestCase):
+
+    def setUp(self):
+        self.addCleanup(identity_events.stop_consumer)
+
+    def cache_listing(self, project_id):
+        user_store.membership_cache.set(
+            project_id, 'key', user_store.membership_cache.version(
+                project_id), {'users': []})
+
+    def is_cached(self, project_id):
+        return user_store.membership_cache.get(
+            project_id, 'key') is not None
+
+    @override_settings(IDENTITY_NOTIFICATIONS={'transport': 'local'})
+    def test_role_assignments(self):
+        transport = identity_events.start_consumer().transport
+
+        self.cache_listing('project_id')
+        self.cache_listing('other_project_id')
+        transport.publish('identity.role_assignment.created', {
+            'role': 'role_id', 'user': 'user_id', 'project': 'project_id',
+            'inherited_to_projects': False})
+        self.assertFalse(self.is_cached('project_id'))
+        self.assertTrue(self.is_cached('other_project_id'))
+
+        transport.publish('identity.role_assignment.deleted', {
+            'role': 'role_id', 'user': 'user_id', 'project': 'project_id',
+            'inherited_to_projects': True})
+        self.assertFalse(self.is_cached('other_project_id'))
+
+    def test_resources(self):
+        with mock.patch.object(
+                user_store.role_catalog, 'invalidate') as roles, \
+                mock.patch.object(
+                    user_store.project_tree, 'invalidate') as tree, \
+                mock.patch.object(
+                    user_store.negative_lookups, 'invalidate') as absent:
+            identity_events.handle_notification(
+                'identity.role.created', {'resource_info': 'role_id'})
+            identity_events.handle_notification(
+                'identity.project.created', {'resource_info': 'project_id'})
+            # unrelated notifications are ignored
+            identity_events.handle_notification(
+                'compute.instance.create.end', {})
+
+        roles.assert_called_once_with()
+        tree.assert_called_once_with()
+        absent.assert_called_once_with('project')
+
+    def test_user_updated(self):
+        user_store.token_cache.add('token', {'user': {'id': 'user_id'}})
+        self.addCleanup(user_store.token_cache.clear)
+        identity_events.handle_notification(
+            'identity.user.updated', {'resource_info': 'user_id'})
+        self.assertIsNone(user_store.token_cache.get('token'))
+
+    def test_unknown_transport(self):
+        with override_settings(IDENTITY_NOTIFICATIONS={'transport': 'nope'}):
+            self.assertRaises(ImproperlyConfigured,
+                              identity_events.start_consumer)
+        self.assertIsNone(identity_events.start_consumer())
+
+
+class FileTransportTests(AdjutantTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'notifications.log')
+
+    def test_follows_file(self):
+        transport = identity_events.FileTransport(
+            self.path, poll_interval=0.01)
+        transport.publish('identity.user.created', {'resource_info': 'old'})
+
+        received = []
+        done = threading.Event()
+
+        def handler(event_type, payload):
+            received.append((event_type, payload))
+            if len(received) == 2:
+                done.set()
+
+        transport.start(handler)
+        self.addCleanup(transport.stop)
+        with open(self.path, 'a') as notifications:
+            notifications.write('not json\n')
+        transport.publish('identity.user.created', {'resource_info': 'one'})
+        transport.publish('identity.user.deleted', {'resource_info': 'two'})
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual(received, [
+            ('identity.user.created', {'resource_info': 'one'}),
+            ('identity.user.deleted', {'resource_info': 'two'}),
+        ])
+
+
+class ProcessStartupTests(AdjutantTestCase):
+
+    def test_started_once_per_process(self):
+        """
+        The consumer is started on the first request of each process,
+        including workers forked after the application was loaded.
+        """
+        start = mock.Mock(__name__='start_consumer')
+        application = middleware.ProcessStartup(
+            mock.Mock(return_value=[b'']), start)
+        self.assertFalse(start.called)
+
+        with mock.patch('os.getpid', return_value=100):
+            application({}, None)
+            application({}, None)
+        self.assertEqual(start.call_count, 1)
+
+        # a forked worker
+        with mock.patch('os.getpid', return_value=101):
+            application({}, None)
+        self.assertEqual(start.call_count, 2)
+
+
+class WorkerSlotTests(AdjutantTestCase):
+
+    def test_lowest_free_slot(self):
+        """
+        Each worker takes the lowest slot no other holds, and a slot is
+        reused once its worker is gone.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        first, first_lock = identity_events.claim_worker_slot(
+            directory, 'adjutant')
+        self.addCleanup(first_lock.close)
+        second, second_lock = identity_events.claim_worker_slot(
+            directory, 'adjutant')
+        self.assertEqual((first, second), (0, 1))
+
+        # as when the second worker exits
+        second_lock.close()
+        third, third_lock = identity_events.claim_worker_slot(
+            directory, 'adjutant')
+        self.addCleanup(third_lock.close)
+        self.assertEqual(third, 1)
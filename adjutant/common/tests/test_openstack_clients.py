@@ -0,0 +1,225 @@
+# Copyright (C) 2019 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import threading
+
+import mock
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+
+from django.conf import settings
+from django.test.utils import override_settings
+
+from keystoneauth1 import token_endpoint
+
+from adjutant.common import dependencies, openstack_clients
+from adjutant.common.tests.utils import AdjutantTestCase
+from adjutant.common.utils import run_concurrently
+from adjutant.exceptions import DependencyUnavailable
+
+
+@mock.patch('adjutant.common.openstack_clients.novaclient.Client')
+@mock.patch('adjutant.common.openstack_clients._get_session',
+            mock.Mock(return_value='session'))
+class ClientPoolTests(AdjutantTestCase):
+
+    def setUp(self):
+        super(ClientPoolTests, self).setUp()
+        openstack_clients.reset_clients()
+        self.addCleanup(openstack_clients.reset_clients)
+
+    def test_client_reused(self, mock_client):
+        """
+        The same client is returned per service, region and version.
+        """
+        nova = openstack_clients.get_novaclient('RegionOne')
+        self.assertIs(openstack_clients.get_novaclient('RegionOne'), nova)
+        mock_client.assert_called_once_with(
+            '2', session='session', region_name='RegionOne')
+
+        openstack_clients.get_novaclient('RegionTwo')
+        openstack_clients.get_novaclient('RegionOne', version='2.1')
+        self.assertEqual(mock_client.call_count, 3)
+
+    def test_client_built_once_across_threads(self, mock_client):
+        clients = run_concurrently(
+            openstack_clients.get_novaclient, ['RegionOne'] * 8,
+            max_workers=8)
+
+        self.assertEqual(mock_client.call_count, 1)
+        self.assertEqual(len(set(id(client) for client in clients)), 1)
+
+    def test_reset_clients(self, mock_client):
+        openstack_clients.get_novaclient('RegionOne')
+        openstack_clients.reset_clients()
+        openstack_clients.get_novaclient('RegionOne')
+
+        self.assertEqual(mock_client.call_count, 2)
+
+
+@mock.patch('adjutant.common.openstack_clients.get_auth_session')
+class OctaviaEndpointTests(AdjutantTestCase):
+
+    def setUp(self):
+        super(OctaviaEndpointTests, self).setUp()
+        openstack_clients.reset_clients()
+        self.addCleanup(openstack_clients.reset_clients)
+
+    def test_endpoint_cached_per_region(self, mock_session):
+        """
+        The endpoint comes from the session's catalog once per region.
+        """
+        get_endpoint = mock_session.return_value.get_endpoint
+        get_endpoint.side_effect = lambda region_name, **kwargs: (
+            'http://%s/lb' % region_name)
+
+        for i in range(3):
+            openstack_clients.get_octaviaclient('RegionOne')
+        client = openstack_clients.get_octaviaclient('RegionTwo')
+
+        self.assertEqual(get_endpoint.call_count, 2)
+        self.assertTrue(client.endpoint.startswith('http://RegionTwo/lb'))
+
+    def test_endpoint_invalidated(self, mock_session):
+        get_endpoint = mock_session.return_value.get_endpoint
+        get_endpoint.return_value = 'http://example.com/lb'
+
+        openstack_clients.get_octaviaclient('RegionOne')
+        openstack_clients.invalidate_octavia_endpoint('RegionOne')
+        openstack_clients.get_octaviaclient('RegionOne')
+
+        self.assertEqual(get_endpoint.call_count, 2)
+
+    @override_settings(ENDPOINT_CACHE_TIME=0)
+    def test_endpoint_expires(self, mock_session):
+        get_endpoint = mock_session.return_value.get_endpoint
+        get_endpoint.return_value = 'http://example.com/lb'
+
+        openstack_clients.get_octaviaclient('RegionOne')
+        openstack_clients.get_octaviaclient('RegionOne')
+
+        self.assertEqual(get_endpoint.call_count, 2)
+
+
+class StubKeystone(object):
+    """A local HTTP server standing in for a Keystone replica."""
+
+    def __init__(self):
+        self.status = 200
+        self.calls = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def respond(self):
+                stub.calls.append((self.command, self.path))
+                body = json.dumps({'port': stub.port}).encode('utf-8')
+                self.send_response(stub.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = do_DELETE = respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.url = 'http://127.0.0.1:%s/v3' % self.port
+        thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@override_settings(DEPENDENCY_SETTINGS={
+    'keystone': {'failure_threshold': 1, 'reset_timeout': 60}})
+class KeystoneBalancingTests(AdjutantTestCase):
+
+    def setUp(self):
+        super(KeystoneBalancingTests, self).setUp()
+        self.stubs = [StubKeystone() for i in range(3)]
+        for stub in self.stubs:
+            self.addCleanup(stub.stop)
+        keystone = dict(settings.KEYSTONE,
+                        endpoints=[stub.url for stub in self.stubs])
+        override = override_settings(KEYSTONE=keystone)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(openstack_clients.reset_clients)
+        self.session = openstack_clients.GuardedSession(
+            dependencies.get_breaker('keystone'),
+            auth=token_endpoint.Token('http://unused', 'token'))
+
+    def get(self, path='/users'):
+        return self.session.get(
+            path, endpoint_filter={'service_type': 'identity'}).json()
+
+    def test_reads_spread(self):
+        for i in range(6):
+            self.get()
+        self.assertEqual([len(stub.calls) for stub in self.stubs],
+                         [2, 2, 2])
+        self.assertEqual(self.stubs[0].calls[0], ('GET', '/v3/users'))
+
+    def test_least_outstanding(self):
+        balancer = openstack_clients.get_keystone_balancer()
+        busy = balancer._choose(False, [])
+        other = balancer._choose(False, [])
+        self.assertNotEqual(busy, other)
+        balancer._release(other)
+        for i in range(4):
+            endpoint = balancer._choose(False, [])
+            self.assertNotEqual(endpoint, busy)
+            balancer._release(endpoint)
+
+    def test_writes_consistent(self):
+        for i in range(3):
+            self.session.post(
+                '/users', json={},
+                endpoint_filter={'service_type': 'identity'})
+        # the auth_url is routed to the endpoints too
+        self.session.post(settings.KEYSTONE['auth_url'] + '/auth/tokens',
+                          json={}, authenticated=False)
+        self.assertEqual(self.stubs[0].calls, [('POST', '/v3/users')] * 3
+                         + [('POST', '/v3/auth/tokens')])
+
+    def test_unhealthy_endpoints_skipped(self):
+        self.stubs[0].status = 500
+        for i in range(6):
+            self.assertNotEqual(self.get()['port'], self.stubs[0].port)
+        # one failed read, retried elsewhere, takes it out of rotation
+        self.assertEqual(len(self.stubs[0].calls), 1)
+        self.assertEqual(
+            openstack_clients.get_keystone_balancer().states()[
+                self.stubs[0].url], 'open')
+
+        self.session.delete(
+            '/users/user_id', endpoint_filter={'service_type': 'identity'})
+        self.assertEqual(self.stubs[1].calls[-1],
+                         ('DELETE', '/v3/users/user_id'))
+
+        self.stubs[1].stop()
+        self.stubs[2].status = 500
+        self.assertRaises(DependencyUnavailable, self.get)
@@ -0,0 +1,143 @@
+# Copyright (C) 2019 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from datetime import timedelta
+import os
+import shutil
+import tempfile
+import threading
+import time
+from uuid import uuid4
+
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from keystoneauth1 import access
+from keystoneauth1.identity import v3
+
+from adjutant.common import service_token
+from adjutant.common.tests.utils import AdjutantTestCase
+
+
+class FakePassword(v3.Password):
+    """Password auth handing out tokens without calling Keystone."""
+
+    expires_in = 3600
+
+    def __init__(self):
+        super(FakePassword, self).__init__(
+            auth_url='http://localhost:5000/v3', username='admin',
+            password='openstack', project_name='admin',
+            user_domain_id='default', project_domain_id='default')
+        self.authentications = 0
+
+    def get_auth_ref(self, session, **kwargs):
+        self.authentications += 1
+        expires_at = timezone.now() + timedelta(seconds=self.expires_in)
+        return access.create(auth_token=uuid4().hex, body={'token': {
+            'methods': ['password'],
+            'expires_at': expires_at.isoformat(),
+            'user': {'id': 'admin_id', 'name': 'admin',
+                     'domain': {'id': 'default', 'name': 'Default'}},
+        }})
+
+
+class ServiceTokenTests(AdjutantTestCase):
+
+    def worker(self, store, **kwargs):
+        """A ServiceTokenManager for a new worker's auth plugin."""
+        auth = FakePassword()
+        manager = service_token.ServiceTokenManager(store, **kwargs)
+        manager.attach(auth, None)
+        self.addCleanup(manager.stop)
+        return auth, manager
+
+    def check_shared(self, store):
+        first_auth, first = self.worker(store)
+        second_auth, second = self.worker(store)
+
+        first.ensure_fresh()
+        second.ensure_fresh()
+        self.assertEqual(first_auth.authentications, 1)
+        self.assertEqual(second_auth.authentications, 0)
+        self.assertEqual(second_auth.auth_ref.auth_token,
+                         first_auth.auth_ref.auth_token)
+
+        # a new worker starts with the stored token
+        third_auth, third = self.worker(store)
+        self.assertEqual(third_auth.auth_ref.auth_token,
+                         first_auth.auth_ref.auth_token)
+
+    def test_file_store(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'token.json')
+        self.check_shared(service_token.FileTokenStore(path))
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'service-token-tests'}})
+    def test_cache_store(self):
+        caches['default'].clear()
+        self.check_shared(service_token.CacheTokenStore())
+
+    def test_refreshed_before_expiry(self):
+        auth, manager = self.worker(
+            service_token.TokenStore(), refresh_before=600)
+        auth.expires_in = 300
+        manager.ensure_fresh()
+        manager.ensure_fresh()
+        self.assertEqual(auth.authentications, 2)
+
+        auth.expires_in = 3600
+        manager.ensure_fresh()
+        manager.ensure_fresh()
+        self.assertEqual(auth.authentications, 3)
+
+    def test_waits_for_other_worker(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = service_token.FileTokenStore(
+            os.path.join(directory, 'token.json'))
+        first_auth, first = self.worker(store)
+        second_auth, second = self.worker(store, wait=5)
+
+        with store.lock():
+            waiting = threading.Thread(target=second.ensure_fresh)
+            waiting.start()
+            first_auth.auth_ref = first_auth.get_auth_ref(None)
+            store.save(first_auth.get_auth_state())
+        waiting.join(5)
+        self.assertEqual(second_auth.authentications, 0)
+        self.assertEqual(second_auth.auth_ref.auth_token,
+                         first_auth.auth_ref.auth_token)
+
+    def test_background_refresh(self):
+        auth, manager = self.worker(
+            service_token.TokenStore(), check_interval=60)
+        manager.start()
+        for i in range(100):
+            if auth.auth_ref is not None:
+                break
+            time.sleep(0.01)
+        manager.stop()
+        self.assertEqual(auth.authentications, 1)
+
+    def test_unknown_store(self):
+        with override_settings(SERVICE_TOKEN={'store': 'nope'}):
+            self.assertRaises(ImproperlyConfigured,
+                              service_token.build_manager)
@@ -0,0 +1,645 @@
+# Copyright (C) 2019 Catalyst IT Ltd
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from datetime import timedelta
+import time
+
+import mock
+
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from keystoneclient import exceptions as ks_exceptions
+
+from adjutant.common import user_store
+from adjutant.common.tests import fake_clients
+from adjutant.common.tests.utils import AdjutantTestCase
+from adjutant.middleware import KeystoneHeaderUnwrapper
+
+
+class CountingManager(object):
+    """
+    Minimal stand in for the IdentityManager, counting backend calls.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    @user_store.cached_read
+    def get_user(self, user_id):
+        self.calls.append(('get_user', user_id))
+        return {'id': user_id}
+
+    @user_store.cached_read
+    def get_roles(self, user, project, inherited=False):
+        self.calls.append(('get_roles', user, project, inherited))
+        return []
+
+    @user_store.invalidates(*user_store._ROLE_READS)
+    def add_user_role(self, user, role, project, inherited=False):
+        self.calls.append(('add_user_role', user, role, project))
+
+
+class RequestCacheTests(AdjutantTestCase):
+
+    def test_no_cache_outside_context(self):
+        manager = CountingManager()
+        manager.get_user('user_id')
+        manager.get_user('user_id')
+        self.assertEqual(len(manager.calls), 2)
+
+    def test_reads_memoized_in_context(self):
+        manager = CountingManager()
+        with user_store.request_cache():
+            manager.get_user('user_id')
+            manager.get_user(user_id='user_id')
+            manager.get_user('other_id')
+        self.assertEqual(
+            manager.calls,
+            [('get_user', 'user_id'), ('get_user', 'other_id')])
+
+    def test_resources_keyed_by_id(self):
+        manager = CountingManager()
+        user = fake_clients.FakeUser(name="test@example.com")
+        with user_store.request_cache():
+            manager.get_roles(user, 'project_id')
+            manager.get_roles(user.id, 'project_id', False)
+            manager.get_roles(user.id, 'project_id', True)
+        self.assertEqual(len(manager.calls), 2)
+
+    def test_write_invalidates(self):
+        manager = CountingManager()
+        with user_store.request_cache():
+            manager.get_roles('user_id', 'project_id')
+            manager.get_user('user_id')
+            manager.add_user_role('user_id', 'role', 'project_id')
+            manager.get_roles('user_id', 'project_id')
+            manager.get_user('user_id')
+        self.assertEqual(
+            [call[0] for call in manager.calls],
+            ['get_roles', 'get_user', 'add_user_role', 'get_roles'])
+
+    def test_nested_context_shares_cache(self):
+        manager = CountingManager()
+        with user_store.request_cache() as outer:
+            with user_store.request_cache() as inner:
+                manager.get_user('user_id')
+            self.assertIs(outer, inner)
+            manager.get_user('user_id')
+        self.assertEqual(len(manager.calls), 1)
+        self.assertIsNone(user_store.get_request_cache())
+
+
+class RoleCatalogTests(AdjutantTestCase):
+
+    def setUp(self):
+        self.roles = [fake_clients.FakeRole("_member_"),
+                      fake_clients.FakeRole("project_mod")]
+        self.loads = 0
+
+        def loader():
+            self.loads += 1
+            return self.roles
+
+        self.catalog = user_store.RoleCatalog(loader=loader)
+
+    def test_indexes(self):
+        member = self.roles[0]
+        self.assertEqual(self.catalog.get(member.id), member)
+        self.assertEqual(self.catalog.find("project_mod"), self.roles[1])
+        self.assertEqual(len(self.catalog.list()), 2)
+        self.assertEqual(self.loads, 1)
+
+    def test_unknown_role_reloads_once(self):
+        self.catalog.find("_member_")
+        new_role = fake_clients.FakeRole("heat_stack_owner")
+        self.roles.append(new_role)
+        self.assertEqual(self.catalog.find("heat_stack_owner"), new_role)
+        self.assertEqual(self.loads, 2)
+
+        self.assertIsNone(self.catalog.find("missing"))
+        self.assertIsNone(self.catalog.find("missing"))
+        self.assertEqual(self.loads, 3)
+
+    @override_settings(ROLE_CACHE_TIME=0)
+    def test_expiry(self):
+        self.catalog.find("_member_")
+        self.catalog.find("_member_")
+        self.assertEqual(self.loads, 2)
+
+    def test_invalidate(self):
+        self.catalog.find("_member_")
+        self.catalog.invalidate()
+        self.catalog.find("_member_")
+        self.assertEqual(self.loads, 2)
+
+
+class TopologyCacheTests(AdjutantTestCase):
+
+    def setUp(self):
+        fake_clients.setup_identity_cache()
+        self.regions = list(fake_clients.identity_cache['regions'].values())
+        self.domains = list(fake_clients.identity_cache['domains'].values())
+        self.loads = 0
+
+        def loader():
+            self.loads += 1
+            return self.regions, self.domains
+
+        self.topology = user_store.TopologyCache(loader=loader)
+        self.addCleanup(self.topology.stop)
+
+    def test_lookups(self):
+        self.assertEqual(
+            self.topology.get_region('RegionOne').id, 'RegionOne')
+        self.assertEqual(self.topology.get_domain('default').name, 'Default')
+        self.assertEqual(self.topology.find_domain('Default').id, 'default')
+        self.assertEqual(len(self.topology.list_regions()), 2)
+        self.assertEqual(self.loads, 1)
+
+    def test_unknown_region_reloads_once(self):
+        self.assertIsNone(self.topology.get_region('RegionThree'))
+        self.assertIsNone(self.topology.get_region('RegionThree'))
+        self.assertEqual(self.loads, 2)
+
+    @override_settings(TOPOLOGY_CACHE_TIME=0)
+    def test_expiry(self):
+        self.topology.get_region('RegionOne')
+        self.topology.get_region('RegionOne')
+        self.assertEqual(self.loads, 2)
+
+    @override_settings(TOPOLOGY_REFRESH_INTERVAL=0.01)
+    def test_background_refresh(self):
+        self.topology.list_regions()
+        for i in range(100):
+            if self.loads > 1:
+                break
+            time.sleep(0.01)
+        self.assertGreater(self.loads, 1)
+        self.assertIsNotNone(self.topology.refreshed_on)
+
+
+@mock.patch('adjutant.common.user_store.get_keystoneclient')
+class BulkRoleEditTests(AdjutantTestCase):
+
+    def test_add_user_roles(self, mock_client):
+        def grant(role, user, project, **kwargs):
+            if role == 'existing':
+                raise ks_exceptions.Conflict()
+            if role == 'broken':
+                raise ks_exceptions.Forbidden()
+
+        grant_mock = mock_client.return_value.roles.grant
+        grant_mock.side_effect = grant
+
+        results = user_store.IdentityManager().add_user_roles([
+            ('user_id', 'new', 'project_id', False),
+            ('user_id', 'existing', 'project_id', False),
+            ('user_id', 'broken', 'project_id', False),
+            ('user_id', 'new', 'project_id', True),
+        ])
+
+        self.assertIsNone(results[0])
+        self.assertIsNone(results[1])
+        self.assertIsInstance(results[2], ks_exceptions.Forbidden)
+        self.assertIsNone(results[3])
+        self.assertEqual(grant_mock.call_count, 4)
+        grant_mock.assert_any_call(
+            'new', user='user_id', project='project_id',
+            os_inherit_extension_inherited=True)
+
+
+@mock.patch('adjutant.common.user_store.get_keystoneclient')
+class BulkUserLookupTests(AdjutantTestCase):
+
+    def test_fetched_by_id(self, mock_client):
+        """
+        Users are fetched by id, however many share a domain, rather
+        than by listing the domain.
+        """
+        ks_client = mock_client.return_value
+        ks_client.users.get.side_effect = (
+            lambda user_id: mock.Mock(id=user_id))
+        assignments = [
+            user_store.UserAssignments(user_id, 'default', ('member',), ())
+            for user_id in ('d', 'c', 'b', 'a')]
+
+        found = user_store.IdentityManager().get_users(assignments)
+
+        self.assertEqual([user.id for user in found], ['d', 'c', 'b', 'a'])
+        ks_client.users.list.assert_not_called()
+
+    def test_deleted_users_left_out(self, mock_client):
+        def get(user_id):
+            if user_id != 'a':
+                raise ks_exceptions.NotFound()
+            return mock.Mock(id=user_id)
+
+        mock_client.return_value.users.get.side_effect = get
+        assignments = [
+            user_store.UserAssignments(user_id, 'default', ('member',), ())
+            for user_id in ('a', 'b')]
+
+        found = user_store.IdentityManager().get_users(assignments)
+
+        self.assertEqual([user.id for user in found], ['a'])
+
+
+@mock.patch('adjutant.common.user_store.get_keystoneclient')
+class ProjectRolesTests(AdjutantTestCase):
+
+    def test_direct_and_inherited(self, mock_client):
+        list_mock = mock_client.return_value.role_assignments.list
+        list_mock.return_value = [
+            mock.Mock(role={'id': 'member'}, scope={'project': {}}),
+            mock.Mock(role={'id': 'admin'}, scope={
+                'project': {}, 'OS-INHERIT:inherited_to': 'projects'}),
+        ]
+
+        with mock.patch.object(user_store.role_catalog, 'get',
+                               side_effect=lambda role_id: role_id):
+            with user_store.request_cache():
+                id_manager = user_store.IdentityManager()
+                self.assertEqual(
+                    id_manager.get_project_roles('user_id', 'project_id'),
+                    (['member'], ['admin']))
+                self.assertEqual(
+                    id_manager.get_roles('user_id', 'project_id'),
+                    ['member'])
+                self.assertEqual(
+                    id_manager.get_roles('user_id', 'project_id', True),
+                    ['admin'])
+
+        list_mock.assert_called_once_with(user='user_id', project='project_id')
+
+    def test_deleted_roles_left_out(self, mock_client):
+        """
+        Roles deleted since their assignments were listed are left out,
+        rather than returned as None.
+        """
+        mock_client.return_value.role_assignments.list.return_value = [
+            mock.Mock(role={'id': 'member'},
+                      scope={'project': {'id': 'project_id'}}),
+            mock.Mock(role={'id': 'deleted'},
+                      scope={'project': {'id': 'project_id'}}),
+            mock.Mock(role={'id': 'deleted'}, scope={
+                'project': {'id': 'project_id'},
+                'OS-INHERIT:inherited_to': 'projects'}),
+        ]
+        id_manager = user_store.IdentityManager()
+        assignments = [user_store.UserAssignments(
+            'user_id', 'default', ('member', 'deleted'), ('deleted',))]
+
+        with mock.patch.object(
+                user_store.role_catalog, 'get',
+                side_effect=lambda role_id: (
+                    None if role_id == 'deleted' else role_id)), \
+                mock.patch.object(
+                    id_manager, 'list_user_assignments',
+                    return_value=assignments), \
+                mock.patch.object(
+                    id_manager, 'get_users',
+                    return_value=[mock.Mock(id='user_id')]):
+            self.assertEqual(
+                id_manager.get_project_roles('user_id', 'project_id'),
+                (['member'], []))
+            self.assertEqual(id_manager.get_all_roles('user_id'),
+                             {'project_id': ['member']})
+            user = id_manager.list_users('project_id')[0]
+            self.assertEqual((user.roles, user.inherited_roles),
+                             (['member'], []))
+
+
+class ProjectTreeTests(AdjutantTestCase):
+
+    def setUp(self):
+        # default -> parent -> child -> grandchild, default -> other
+        self.parent = fake_clients.FakeProject("parent", parent_id='default')
+        self.child = fake_clients.FakeProject(
+            "child", parent_id=self.parent.id)
+        self.grandchild = fake_clients.FakeProject(
+            "grandchild", parent_id=self.child.id)
+        self.other = fake_clients.FakeProject("other", parent_id='default')
+        self.projects = [
+            self.grandchild, self.child, self.parent, self.other]
+        self.loads = 0
+
+        def loader():
+            self.loads += 1
+            return self.projects
+
+        self.tree = user_store.ProjectTree(loader=loader)
+
+    def test_ancestors_and_depth(self):
+        self.assertEqual(self.tree.ancestor_ids(self.grandchild.id),
+                         [self.child.id, self.parent.id])
+        self.assertEqual(self.tree.ancestor_ids(self.parent.id), [])
+        self.assertEqual(self.tree.depth(self.parent.id), 1)
+        self.assertEqual(self.tree.depth(self.grandchild.id), 3)
+        self.assertEqual(self.loads, 1)
+
+    def test_descendants(self):
+        self.assertEqual(self.tree.descendant_ids(self.parent.id),
+                         [self.child.id, self.grandchild.id])
+        self.assertEqual(self.tree.descendant_ids(self.other.id), [])
+
+    def test_add(self):
+        self.tree.descendant_ids(self.parent.id)
+        new = fake_clients.FakeProject("new", parent_id=self.child.id)
+        self.tree.add(new.id, new.parent_id)
+
+        self.assertEqual(self.tree.depth(new.id), 3)
+        self.assertEqual(self.tree.ancestor_ids(new.id),
+                         [self.child.id, self.parent.id])
+        self.assertIn(new.id, self.tree.descendant_ids(self.parent.id))
+        self.assertEqual(self.loads, 1)
+
+    def test_unknown_project_reloads_once(self):
+        self.assertIsNone(self.tree.ancestor_ids('missing'))
+        # not reloaded again straight after loading
+        self.assertEqual(self.loads, 1)
+
+        later = time.time() + user_store.ProjectTree.MISS_RELOAD_INTERVAL
+        with mock.patch('adjutant.common.user_store.time',
+                        return_value=later):
+            self.assertIsNone(self.tree.ancestor_ids('missing'))
+            self.assertIsNone(self.tree.depth('missing'))
+            self.assertEqual(self.loads, 2)
+            # nor for another unknown project so soon after
+            self.assertIsNone(self.tree.depth('other_missing'))
+            self.assertEqual(self.loads, 2)
+
+    def test_subtree_ids_list(self):
+        subtree = {self.child.id: {self.grandchild.id: None}}
+        self.assertEqual(user_store.subtree_ids_list(subtree),
+                         [self.child.id, self.grandchild.id])
+        # no state shared between calls
+        self.assertEqual(user_store.subtree_ids_list(subtree),
+                         [self.child.id, self.grandchild.id])
+
+
+@mock.patch('adjutant.common.user_store.get_keystoneclient')
+class ProjectParentsTests(AdjutantTestCase):
+    """
+    The parents of a project are the same whether they come from the
+    project tree or from Keystone.
+    """
+
+    def setUp(self):
+        # default -> parent -> child
+        self.parent = fake_clients.FakeProject("parent", parent_id='default')
+        self.child = fake_clients.FakeProject(
+            "child", parent_id=self.parent.id)
+        self.projects = [self.parent, self.child]
+        tree = user_store.ProjectTree(loader=lambda: self.projects)
+        patcher = mock.patch.object(user_store, 'project_tree', tree)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_child(self, mock_client):
+        def get(project_id, parents_as_ids=False):
+            project = mock.Mock(id=project_id, domain_id='default')
+            if parents_as_ids:
+                project.parents = {self.parent.id: {'default': None}}
+            return project
+
+        mock_client.return_value.projects.get.side_effect = get
+        return user_store.IdentityManager().get_project(
+            self.child.id, parents_as_ids=True)
+
+    def check_parents(self, project):
+        self.assertEqual(project.parent_ids, [self.parent.id])
+        self.assertEqual(project.root, self.parent.id)
+        self.assertEqual(project.depth, 2)
+
+    def test_from_tree(self, mock_client):
+        self.check_parents(self.get_child(mock_client))
+        mock_client.return_value.projects.get.assert_called_once_with(
+            self.child.id)
+
+    def test_from_keystone(self, mock_client):
+        self.projects = []
+        self.check_parents(self.get_child(mock_client))
+        mock_client.return_value.projects.get.assert_called_with(
+            self.child.id, parents_as_ids=True)
+
+
+class NegativeLookupCacheTests(AdjutantTestCase):
+
+    def setUp(self):
+        self.cache = user_store.NegativeLookupCache()
+
+    def test_absent_names(self):
+        self.cache.add('user', 'default', 'missing@example.com')
+        self.assertTrue(
+            self.cache.is_absent('user', 'default', 'missing@example.com'))
+        self.assertFalse(
+            self.cache.is_absent('user', 'other', 'missing@example.com'))
+        self.assertFalse(
+            self.cache.is_absent('project', 'default', 'missing@example.com'))
+
+        self.cache.invalidate('user', 'default')
+        self.assertFalse(
+            self.cache.is_absent('user', 'default', 'missing@example.com'))
+
+    @override_settings(NEGATIVE_LOOKUP_CACHE_SIZE=2)
+    def test_oldest_dropped(self):
+        for name in ('one', 'two', 'three'):
+            self.cache.add('user', 'default', name)
+        self.assertFalse(self.cache.is_absent('user', 'default', 'one'))
+        self.assertTrue(self.cache.is_absent('user', 'default', 'three'))
+
+    @override_settings(NEGATIVE_LOOKUP_CACHE_TIME=0)
+    def test_disabled(self):
+        self.cache.add('user', 'default', 'missing@example.com')
+        self.assertFalse(
+            self.cache.is_absent('user', 'default', 'missing@example.com'))
+
+    @mock.patch('adjutant.common.user_store.get_keystoneclient')
+    def test_fresh_lookups(self, mock_client):
+        """
+        Names remembered as absent, or missing from the name filter, are
+        still looked up in Keystone by checks guarding a create.
+        """
+        list_mock = mock_client.return_value.users.list
+        list_mock.return_value = []
+        self.addCleanup(user_store.negative_lookups.invalidate, 'user')
+        id_manager = user_store.IdentityManager()
+
+        self.assertIsNone(id_manager.find_user('new@example.com', 'default'))
+        self.assertIsNone(id_manager.find_user('new@example.com', 'default'))
+        self.assertEqual(list_mock.call_count, 1)
+
+        # created outside of Adjutant since
+        list_mock.return_value = [mock.Mock(id='user_id')]
+        with mock.patch.object(user_store.name_filters, 'is_absent',
+                               return_value=True):
+            self.assertEqual(
+                id_manager.find_user(
+                    'new@example.com', 'default', use_filter=True,
+                    fresh=True).id,
+                'user_id')
+        self.assertEqual(list_mock.call_count, 2)
+
+
+class MembershipCacheTests(AdjutantTestCase):
+
+    def setUp(self):
+        self.cache = user_store.MembershipCache()
+
+    def test_versioned(self):
+        version = self.cache.version('project_id')
+        self.cache.set('project_id', 'key', version, {'users': []})
+        self.assertEqual(self.cache.get('project_id', 'key'), {'users': []})
+
+        self.cache.bump('other_project_id')
+        self.assertIsNotNone(self.cache.get('project_id', 'key'))
+        self.cache.bump('project_id')
+        self.assertIsNone(self.cache.get('project_id', 'key'))
+
+        # a listing built before a bump is never stored
+        self.cache.set('project_id', 'key', version, {'users': []})
+        self.assertIsNone(self.cache.get('project_id', 'key'))
+
+        self.cache.set('project_id', 'key',
+                       self.cache.version('project_id'), {'users': []})
+        self.cache.bump()
+        self.assertIsNone(self.cache.get('project_id', 'key'))
+
+    def test_expiry(self):
+        self.cache.set('project_id', 'key',
+                       self.cache.version('project_id'), {'users': []})
+        with mock.patch('adjutant.common.user_store.time',
+                        return_value=time.time() + 11):
+            self.assertIsNone(self.cache.get('project_id', 'key'))
+
+    @override_settings(USER_LIST_CACHE_TIME=0)
+    def test_disabled(self):
+        self.cache.set('project_id', 'key',
+                       self.cache.version('project_id'), {'users': []})
+        self.assertIsNone(self.cache.get('project_id', 'key'))
+
+
+class TokenCacheTests(AdjutantTestCase):
+
+    def setUp(self):
+        self.cache = user_store.TokenCache()
+
+    def token_data(self, expires_in):
+        expires_at = timezone.now() + timedelta(seconds=expires_in)
+        return {'user': {'id': 'user_id', 'name': 'test@example.com'},
+                'expires_at': expires_at.isoformat()}
+
+    def test_validated_tokens(self):
+        token_data = self.token_data(3600)
+        self.cache.add('token', token_data)
+        self.assertEqual(self.cache.get('token'), token_data)
+        self.assertIsNone(self.cache.get('other_token'))
+
+    def test_expired_tokens(self):
+        self.cache.add('expired_token', self.token_data(-10))
+        self.assertIsNone(self.cache.get('expired_token'))
+
+        with mock.patch('adjutant.common.user_store.time',
+                        return_value=time.time() + 120):
+            self.cache.add('token', self.token_data(3600))
+        # held for at most TOKEN_CACHE_TIME
+        self.cache.add('other_token', self.token_data(3600))
+        with mock.patch('adjutant.common.user_store.time',
+                        return_value=time.time() + 61):
+            self.assertIsNotNone(self.cache.get('token'))
+            self.assertIsNone(self.cache.get('other_token'))
+
+    def test_middleware_shares_tokens(self):
+        self.addCleanup(user_store.token_cache.clear)
+        token_data = self.token_data(3600)
+        request = RequestFactory().get(
+            '/v1/', HTTP_X_AUTH_TOKEN='token',
+            HTTP_X_IDENTITY_STATUS='Confirmed')
+        request.META['keystone.token_info'] = {'token': token_data}
+        KeystoneHeaderUnwrapper().process_request(request)
+
+        with mock.patch.object(
+                user_store.IdentityManager, '__init__', return_value=None):
+            id_manager = user_store.IdentityManager()
+        id_manager.ks_client = mock.Mock()
+        self.assertEqual(id_manager.validate_token('token'), token_data)
+        id_manager.ks_client.tokens.validate.assert_not_called()
+
+
+@override_settings(NAME_FILTER_REBUILD_INTERVAL=300)
+class NameFiltersTests(AdjutantTestCase):
+
+    def setUp(self):
+        self.names = ['test@example.com']
+        self.filters = user_store.NameFilters(
+            loader=lambda kind, domain_id: list(self.names))
+
+    def wait_for_filter(self):
+        for i in range(100):
+            if self.filters._filters:
+                return
+            time.sleep(0.01)
+
+    def test_filter_built_in_background(self):
+        # no filter yet, so nothing is known to be absent
+        self.assertFalse(
+            self.filters.is_absent('user', 'default', 'missing'))
+        self.wait_for_filter()
+
+        self.assertTrue(self.filters.is_absent('user', 'default', 'missing'))
+        self.assertFalse(
+            self.filters.is_absent('user', 'default', 'Test@example.com'))
+
+    def test_added_names_not_absent(self):
+        self.filters.is_absent('user', 'default', 'missing')
+        self.wait_for_filter()
+
+        self.filters.add('user', 'default', 'new@example.com')
+        self.assertFalse(
+            self.filters.is_absent('user', 'default', 'new@example.com'))
+
+        # unknown domain drops the filters
+        self.filters.add('user', None, 'other@example.com')
+        self.assertFalse(
+            self.filters.is_absent('user', 'default', 'missing'))
+
+    @override_settings(NAME_FILTER_REBUILD_INTERVAL=0)
+    def test_disabled(self):
+        self.assertFalse(
+            self.filters.is_absent('user', 'default', 'missing'))
+        self.assertEqual(self.filters._building, {})
+
+
+class ManagableRolesTests(AdjutantTestCase):
+
+    def test_managable_roles(self):
+        self.assertEqual(
+            user_store.get_managable_roles(['project_mod', 'other']),
+            {'_member_', 'heat_stack_owner', 'project_mod'})
+        self.assertEqual(user_store.get_managable_roles([]), set())
+
+    def test_managable_roles_setting_changed(self):
+        user_store.get_managable_roles(['project_mod'])
+        with self.modify_dict_settings(ROLES_MAPPING={
+                'key_list': ['project_mod'],
+                'operation': 'remove',
+                'value': 'heat_stack_owner'}):
+            self.assertEqual(
+                user_store.get_managable_roles(['project_mod']),
+                {'_member_', 'project_mod'})
+        self.assertEqual(
+            user_store.get_managable_roles(['project_mod']),
+            {'_member_', 'heat_stack_owner', 'project_mod'})
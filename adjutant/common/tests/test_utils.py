@@ -12,18 +12,26 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
+import time
+
 import mock
 
 from rest_framework import status
 
 from adjutant.api.models import Token
+from adjutant.common import user_store
+from adjutant.common.utils import (
+    BloomFilter, run_concurrently, SingleFlight)
 from adjutant.common.tests import fake_clients
 from adjutant.common.tests.fake_clients import (
     FakeManager, setup_identity_cache)
 from adjutant.common.tests.utils import (AdjutantAPITestCase,
+                                         AdjutantTestCase,
                                          modify_dict_settings)
 
 from django.core import mail
+from django.test.utils import override_settings
 
 
 @mock.patch('adjutant.common.user_store.IdentityManager',
@@ -261,3 +269,142 @@ class ModifySettingsTests(AdjutantAPITestCase):
 
         self.assertEqual(len(mail.outbox), 3)
         self.assertNotEqual(mail.outbox[2].subject, 'modified_token_email')
+
+
+class RunConcurrentlyTests(AdjutantTestCase):
+
+    def test_results_in_order(self):
+        results = run_concurrently(lambda x: x * 2, range(20))
+        self.assertEqual(results, [x * 2 for x in range(20)])
+        self.assertEqual(run_concurrently(lambda x: x, []), [])
+
+    def test_uses_worker_threads(self):
+        threads = run_concurrently(
+            lambda x: threading.current_thread().ident, range(4),
+            max_workers=2)
+        self.assertNotIn(threading.current_thread().ident, threads)
+
+    def test_single_worker_runs_inline(self):
+        threads = run_concurrently(
+            lambda x: threading.current_thread().ident, range(4),
+            max_workers=1)
+        self.assertEqual(
+            set(threads), {threading.current_thread().ident})
+
+    def test_exception_raised(self):
+        def fail(x):
+            if x == 3:
+                raise ValueError("bad item")
+            return x
+
+        self.assertRaises(ValueError, run_concurrently, fail, range(5))
+
+    def test_request_cache_shared(self):
+        with user_store.request_cache() as cache:
+            caches = run_concurrently(
+                lambda x: user_store.get_request_cache(), range(4))
+        self.assertEqual(caches, [cache] * 4)
+
+
+class BloomFilterTests(AdjutantTestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(100)
+        names = ["user%s@example.com" % i for i in range(100)]
+        for name in names:
+            bloom.add(name)
+        for name in names:
+            self.assertIn(name, bloom)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add("user%s" % i)
+        false_positives = sum(
+            1 for i in range(10000) if "other%s" % i in bloom)
+        self.assertLess(false_positives, 300)
+
+
+class SingleFlightTests(AdjutantTestCase):
+
+    def blocked_call(self, flight, results, shared=False):
+        """
+        Starts a call through flight that blocks until released, and
+        returns the release event and its thread.
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        def call():
+            started.set()
+            release.wait(5)
+            results.append('leader')
+            return 'result'
+
+        thread = threading.Thread(
+            target=lambda: results.append(flight.do(
+                'namespace', 'key', call, shared=shared)))
+        thread.start()
+        started.wait(5)
+        return release, thread
+
+    def test_concurrent_calls_share_result(self):
+        flight = SingleFlight('test')
+        results = []
+        release, thread = self.blocked_call(flight, results)
+
+        followers = [threading.Thread(target=lambda: results.append(
+            flight.do('namespace', 'key', lambda: 'follower')))
+            for i in range(3)]
+        for follower in followers:
+            follower.start()
+        # a different key isn't coalesced
+        self.assertEqual(
+            flight.do('namespace', 'other_key', lambda: 'other'), 'other')
+
+        release.set()
+        for t in [thread] + followers:
+            t.join(5)
+        self.assertEqual(results.count('leader'), 1)
+        self.assertEqual(results.count('result'), 4)
+
+        # once done, calls start afresh
+        self.assertEqual(
+            flight.do('namespace', 'key', lambda: 'later'), 'later')
+
+    def test_forget(self):
+        flight = SingleFlight('test')
+        results = []
+        release, thread = self.blocked_call(flight, results)
+
+        flight.forget('namespace')
+        self.assertEqual(
+            flight.do('namespace', 'key', lambda: 'fresh'), 'fresh')
+        release.set()
+        thread.join(5)
+
+    def test_error_shared(self):
+        flight = SingleFlight('test')
+
+        def fail():
+            raise ValueError("failed")
+
+        self.assertRaises(ValueError, flight.do, 'namespace', 'key', fail)
+
+    @override_settings(SINGLEFLIGHT_LOCK_STORE='default')
+    def test_shared_across_workers(self):
+        # two instances of the same flight stand in for two workers
+        results = []
+        release, thread = self.blocked_call(
+            SingleFlight('test'), results, shared=True)
+
+        other_worker = threading.Thread(target=lambda: results.append(
+            SingleFlight('test').do(
+                'namespace', 'key', lambda: 'other', shared=True)))
+        other_worker.start()
+        # let the other worker find the lock before the leader finishes
+        time.sleep(SingleFlight.POLL_INTERVAL * 4)
+        release.set()
+        for t in (thread, other_worker):
+            t.join(5)
+        self.assertEqual(sorted(results), ['leader', 'result', 'result'])
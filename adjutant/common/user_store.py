@@ -12,13 +12,42 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict
+from contextlib import contextmanager
+import functools
+import hashlib
+import inspect
+import threading
+from logging import getLogger
+from time import time
 
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from keystoneclient import exceptions as ks_exceptions
 
+from adjutant.common import dependencies
+from adjutant.common.cache import CachedResource, SharedCache
 from adjutant.common.openstack_clients import get_keystoneclient
+from adjutant.common.utils import (
+    BloomFilter, register_context_propagator, run_concurrently, SingleFlight)
+
+
+# Flattened ROLES_MAPPING, as {role_name: frozenset(managable names)},
+# and the results for each combination of user roles seen so far.
+_managable_mapping = None
+_managable_results = {}
+
+
+@receiver(setting_changed)
+def _reset_managable_mapping(setting, **kwargs):
+    global _managable_mapping
+    if setting == 'ROLES_MAPPING':
+        _managable_mapping = None
+        _managable_results.clear()
 
 
 def get_managable_roles(user_roles):
@@ -26,29 +55,815 @@ def get_managable_roles(user_roles):
     Given a list of user role names, returns a list of names
     that the user is allowed to manage.
     """
-    manage_mapping = settings.ROLES_MAPPING
-    # merge mapping lists to form a flat permitted roles list
-    managable_role_names = [mrole for role_name in user_roles
-                            if role_name in manage_mapping
-                            for mrole in manage_mapping[role_name]]
-    # a set has unique items
-    managable_role_names = set(managable_role_names)
-    return managable_role_names
+    global _managable_mapping
+    user_roles = frozenset(user_roles)
+    try:
+        return set(_managable_results[user_roles])
+    except KeyError:
+        pass
+
+    if _managable_mapping is None:
+        _managable_mapping = {
+            role_name: frozenset(managable)
+            for role_name, managable in settings.ROLES_MAPPING.items()}
+
+    # merge mapping sets to form a flat permitted roles set
+    managable_role_names = frozenset().union(*[
+        _managable_mapping[role_name] for role_name in user_roles
+        if role_name in _managable_mapping])
+    _managable_results[user_roles] = managable_role_names
+    return set(managable_role_names)
+
+
+class RoleCatalog(object):
+    """
+    Process wide catalog of the Keystone roles, indexed by id and name.
+
+    Roles change rarely, so rather than listing them for every call that
+    needs them the catalog is loaded once and reloaded after
+    ROLE_CACHE_TIME seconds, or when asked for a role it doesn't know.
+    If shared, the roles loaded by any worker are kept in the shared
+    cache tier for the others.
+    """
+
+    def __init__(self, loader=None, shared=False):
+        self._loader = loader or self._list_roles
+        self._shared = SharedCache('roles') if shared else None
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._by_name = {}
+        self._misses = set()
+        self._expires = 0
+
+    @staticmethod
+    def _list_roles():
+        return get_keystoneclient().roles.list()
+
+    def refresh(self, force=False):
+        """
+        Reloads the catalog, from the shared cache tier unless forced
+        to go to Keystone.
+        """
+        roles = None
+        if self._shared is not None and not force:
+            roles = self._shared.get('roles')
+        if roles is None:
+            roles = list(self._loader())
+            if self._shared is not None:
+                roles = [CachedResource.from_resource(role)
+                         for role in roles]
+                self._shared.set('roles', roles, settings.ROLE_CACHE_TIME)
+        with self._lock:
+            self._by_id = {role.id: role for role in roles}
+            self._by_name = {role.name: role for role in roles}
+            self._misses = set()
+            self._expires = time() + settings.ROLE_CACHE_TIME
+
+    def invalidate(self):
+        with self._lock:
+            self._expires = 0
+        if self._shared is not None:
+            self._shared.invalidate()
+
+    def _lookup(self, index, key):
+        if time() >= self._expires:
+            self.refresh()
+        role = getattr(self, index).get(key)
+        if role is None and key not in self._misses:
+            # Possibly a new role, so reload once (from another worker's
+            # newer copy if there is one) before giving up on it until
+            # the catalog next expires.
+            if self._shared is not None:
+                self.refresh()
+                role = getattr(self, index).get(key)
+            if role is None:
+                self.refresh(force=True)
+                role = getattr(self, index).get(key)
+            if role is None:
+                self._misses.add(key)
+        return role
+
+    def get(self, role_id):
+        return self._lookup('_by_id', role_id)
+
+    def find(self, name):
+        return self._lookup('_by_name', name)
+
+    def list(self):
+        if time() >= self._expires:
+            self.refresh()
+        return list(self._by_id.values())
+
+
+role_catalog = RoleCatalog(shared=True)
+
+
+class TopologyCache(object):
+    """
+    Process wide cache of the Keystone regions and domains.
+
+    These are checked on almost every quota and project request but
+    only change when the cloud itself does, so they are answered from
+    memory. Once loaded, a background thread reloads them every
+    TOPOLOGY_REFRESH_INTERVAL seconds, and a read only goes to Keystone
+    itself when the data is older than TOPOLOGY_CACHE_TIME (such as
+    when background refreshes are off or failing), or for an id or
+    name not seen since the last refresh. If shared, the data loaded
+    by any worker is kept in the shared cache tier for the others.
+    """
+
+    def __init__(self, loader=None, shared=False):
+        self._loader = loader or self._load
+        self._shared = SharedCache('topology') if shared else None
+        self._lock = threading.Lock()
+        self._regions = {}
+        self._domains_by_id = {}
+        self._domains_by_name = {}
+        self._misses = set()
+        self._refreshed_on = None
+        self._expires = 0
+        self._timer = None
+
+    @staticmethod
+    def _load():
+        ks_client = get_keystoneclient()
+        return ks_client.regions.list(), ks_client.domains.list()
+
+    @property
+    def refreshed_on(self):
+        return self._refreshed_on
+
+    def refresh(self, force=False):
+        """
+        Reloads the regions and domains, from the shared cache tier
+        unless forced to go to Keystone.
+        """
+        loaded = None
+        if self._shared is not None and not force:
+            loaded = self._shared.get('topology')
+        if loaded is None:
+            regions, domains = self._loader()
+            if self._shared is not None:
+                regions = [CachedResource.from_resource(region)
+                           for region in regions]
+                domains = [CachedResource.from_resource(domain)
+                           for domain in domains]
+                self._shared.set('topology', (regions, domains),
+                                 settings.TOPOLOGY_CACHE_TIME)
+        else:
+            regions, domains = loaded
+        with self._lock:
+            self._regions = {region.id: region for region in regions}
+            self._domains_by_id = {domain.id: domain for domain in domains}
+            self._domains_by_name = {
+                domain.name: domain for domain in domains}
+            self._misses = set()
+            self._refreshed_on = time()
+            self._expires = self._refreshed_on + settings.TOPOLOGY_CACHE_TIME
+        self._schedule()
+
+    def invalidate(self):
+        with self._lock:
+            self._expires = 0
+        if self._shared is not None:
+            self._shared.invalidate()
+
+    def _schedule(self):
+        interval = settings.TOPOLOGY_REFRESH_INTERVAL
+        with self._lock:
+            if not interval or self._timer is not None:
+                return
+            self._timer = threading.Timer(interval, self._background_refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def stop(self):
+        """Cancels any pending background refresh."""
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+
+    def _background_refresh(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.refresh(force=True)
+        except Exception as e:
+            getLogger('adjutant').warning(
+                "Failed to refresh the region and domain cache: %s" % e)
+            # keep serving what we have until it expires, and try again.
+            self._schedule()
+
+    def _lookup(self, index, key):
+        if time() >= self._expires:
+            self.refresh()
+        value = getattr(self, index).get(key)
+        if value is None and (index, key) not in self._misses:
+            # Possibly created since the last refresh, so reload once
+            # (from another worker's newer copy if there is one) before
+            # giving up on it until the next refresh.
+            if self._shared is not None:
+                self.refresh()
+                value = getattr(self, index).get(key)
+            if value is None:
+                self.refresh(force=True)
+                value = getattr(self, index).get(key)
+            if value is None:
+                self._misses.add((index, key))
+        return value
+
+    def get_region(self, region_id):
+        return self._lookup('_regions', region_id)
+
+    def list_regions(self):
+        if time() >= self._expires:
+            self.refresh()
+        return list(self._regions.values())
+
+    def get_domain(self, domain_id):
+        return self._lookup('_domains_by_id', domain_id)
+
+    def list_domains(self):
+        if time() >= self._expires:
+            self.refresh()
+        return list(self._domains_by_id.values())
+
+    def find_domain(self, domain_name):
+        return self._lookup('_domains_by_name', domain_name)
+
+
+topology = TopologyCache(shared=True)
+
+
+def _domain_key(domain):
+    return getattr(domain, 'id', domain)
+
+
+class NegativeLookupCache(object):
+    """
+    Short lived memory of user and project names that Keystone had no
+    match for, as {(kind, domain_id): {name: expiry}}.
+
+    Unauthenticated endpoints (password reset, signup) look up names
+    that mostly don't exist, so repeats of those are answered here for
+    NEGATIVE_LOOKUP_CACHE_TIME seconds. Each domain keeps at most
+    NEGATIVE_LOOKUP_CACHE_SIZE names, dropping the oldest first, and
+    any write of a name clears its whole domain.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = defaultdict(OrderedDict)
+
+    def is_absent(self, kind, domain, name):
+        key = (kind, _domain_key(domain))
+        with self._lock:
+            expires = self._entries[key].get(name, 0)
+            if expires and expires <= time():
+                del self._entries[key][name]
+        return expires > time()
+
+    def add(self, kind, domain, name):
+        ttl = settings.NEGATIVE_LOOKUP_CACHE_TIME
+        if not ttl:
+            return
+        with self._lock:
+            names = self._entries[(kind, _domain_key(domain))]
+            names.pop(name, None)
+            names[name] = time() + ttl
+            while len(names) > settings.NEGATIVE_LOOKUP_CACHE_SIZE:
+                names.popitem(last=False)
+
+    def invalidate(self, kind, domain=None):
+        """
+        Forgets the absent names of a kind in the domain, or in every
+        domain if it isn't known.
+        """
+        with self._lock:
+            if domain is None:
+                for key in [k for k in self._entries if k[0] == kind]:
+                    del self._entries[key]
+            else:
+                self._entries.pop((kind, _domain_key(domain)), None)
+
+
+negative_lookups = NegativeLookupCache()
+
+
+class MembershipCache(object):
+    """
+    Assembled user listings of each project, checked against a version
+    of the project's membership.
+
+    Adjutant bumps a project's version whenever it grants or revokes
+    roles on it, or saves one of its invite or role edit tasks, and
+    inherited grants bump every project. Listings built against an
+    older version are never returned, and all listings expire after
+    USER_LIST_CACHE_TIME seconds to bound how stale changes made
+    outside of Adjutant can get. If shared, the listings and versions
+    are kept in the shared cache tier, so every worker sees the same.
+    """
+
+    def __init__(self, shared=False):
+        self._cache = SharedCache('user_list', shared=shared)
+
+    def version(self, project_id):
+        return (self._cache.counter('epoch'),
+                self._cache.counter(('version', project_id)))
+
+    def bump(self, project_id=None):
+        """Invalidates the listings of a project, or of every project."""
+        if project_id is None:
+            self._cache.incr('epoch')
+        else:
+            self._cache.incr(('version', project_id))
 
+    def get(self, project_id, key):
+        entry = self._cache.get(('listing', project_id, key))
+        if entry is None:
+            return None
+        expires, version, payload = entry
+        if expires <= time() or version != self.version(project_id):
+            return None
+        return payload
+
+    def set(self, project_id, key, version, payload):
+        ttl = settings.USER_LIST_CACHE_TIME
+        if not ttl or version != self.version(project_id):
+            return
+        self._cache.set(('listing', project_id, key),
+                        (time() + ttl, version, payload), ttl)
+
+    def clear(self):
+        self._cache.invalidate()
+
+
+membership_cache = MembershipCache(shared=True)
+
+
+class TokenCache(object):
+    """
+    Keystone tokens that have been validated, keyed by a hash of the
+    token so the tokens themselves aren't held in memory.
+
+    Entries are kept until the token expires, or for at most
+    TOKEN_CACHE_TIME seconds (as keystonemiddleware does) so revoked
+    tokens stop being accepted. Tokens validated by keystonemiddleware
+    are added by the KeystoneHeaderUnwrapper, so the same token isn't
+    validated again by actions that take it.
+    """
+
+    # most tokens held, dropping the oldest first
+    MAX_SIZE = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = OrderedDict()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        """The token data for a validated token, or None."""
+        key = self._key(token)
+        with self._lock:
+            expires, token_data = self._tokens.get(key, (0, None))
+            if expires and expires <= time():
+                del self._tokens[key]
+                return None
+        return token_data
+
+    def add(self, token, token_data):
+        ttl = settings.TOKEN_CACHE_TIME
+        expires_at = parse_datetime(token_data.get('expires_at') or '')
+        if expires_at is not None:
+            ttl = min(ttl, (expires_at - timezone.now()).total_seconds())
+        if ttl <= 0:
+            return
+        key = self._key(token)
+        with self._lock:
+            self._tokens.pop(key, None)
+            self._tokens[key] = (time() + ttl, token_data)
+            while len(self._tokens) > self.MAX_SIZE:
+                self._tokens.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+token_cache = TokenCache()
+
+
+class NameFilters(object):
+    """
+    Bloom filters of the (lowercased) user and project names in each
+    domain, used to answer that a name is definitely absent without
+    asking Keystone.
+
+    A filter is built in a background thread the first time its domain
+    is checked, and rebuilt once older than NAME_FILTER_REBUILD_INTERVAL
+    seconds, with lookups falling through to Keystone until it is ready.
+    Names added through this process are added to the filters straight
+    away, but names created elsewhere (other workers, or outside of
+    Adjutant) are only seen after the next rebuild, so the filters are
+    only consulted where that is acceptable, and are off unless an
+    interval is set.
+    """
 
-def subtree_ids_list(subtree, id_list=[]):
+    def __init__(self, loader=None):
+        self._loader = loader or self._list_names
+        self._lock = threading.Lock()
+        # {(kind, domain_id): (BloomFilter, built timestamp)}
+        self._filters = {}
+        # names added while a filter is being built, by filter key
+        self._building = {}
+
+    @staticmethod
+    def _list_names(kind, domain_id):
+        ks_client = get_keystoneclient()
+        if kind == 'user':
+            return [user.name for user in ks_client.users.list(
+                domain=domain_id)]
+        return [project.name for project in ks_client.projects.list(
+            domain=domain_id)]
+
+    def _build(self, key):
+        try:
+            names = self._loader(*key)
+            name_filter = BloomFilter(max(len(names) * 2, 1000))
+            for name in names:
+                name_filter.add(name.lower())
+        except Exception as e:
+            getLogger('adjutant').warning(
+                "Failed to build the %s name filter for domain %s: %s"
+                % (key[0], key[1], e))
+            with self._lock:
+                self._building.pop(key, None)
+            return
+        with self._lock:
+            added = self._building.pop(key, None)
+            if added is None:
+                # dropped while building
+                return
+            for name in added:
+                name_filter.add(name)
+            self._filters[key] = (name_filter, time())
+
+    def is_absent(self, kind, domain, name):
+        interval = settings.NAME_FILTER_REBUILD_INTERVAL
+        if not interval:
+            return False
+        key = (kind, _domain_key(domain))
+        with self._lock:
+            name_filter, built = self._filters.get(key, (None, 0))
+            rebuild = (built + interval <= time()
+                       and key not in self._building)
+            if rebuild:
+                self._building[key] = set()
+        if rebuild:
+            thread = threading.Thread(target=self._build, args=(key,))
+            thread.daemon = True
+            thread.start()
+        return name_filter is not None and name.lower() not in name_filter
+
+    def add(self, kind, domain, name):
+        if domain is None:
+            # the domain isn't known, so drop that kind's filters
+            # rather than risk a false 'absent'.
+            self.invalidate(kind)
+            return
+        with self._lock:
+            key = (kind, _domain_key(domain))
+            if self._building.get(key) is not None:
+                self._building[key].add(name.lower())
+            if key in self._filters:
+                self._filters[key][0].add(name.lower())
+
+    def invalidate(self, kind):
+        """Drops the filters of a kind, until they are rebuilt."""
+        with self._lock:
+            for key in [k for k in self._filters if k[0] == kind]:
+                del self._filters[key]
+            for key in [k for k in self._building if k[0] == kind]:
+                self._building[key] = None
+
+
+name_filters = NameFilters()
+
+
+def _record_name(kind, name, domain):
+    """Updates the absent name caches after a name is written."""
+    negative_lookups.invalidate(kind, domain)
+    name_filters.add(kind, domain, name)
+
+
+def _matching(assignments, users):
+    """The UserAssignments for each of the resolved users, in order."""
+    by_user = {user_assignments.user_id: user_assignments
+               for user_assignments in assignments}
+    return [by_user[user.id] for user in users]
+
+
+def subtree_ids_list(subtree, id_list=None):
+    if id_list is None:
+        id_list = []
     if not subtree:
         return id_list
-    for key in subtree.iterkeys():
+    for key, value in subtree.items():
         id_list.append(key)
-        if subtree[key]:
-            subtree_ids_list(subtree[key], id_list)
+        if value:
+            subtree_ids_list(value, id_list)
     return id_list
 
 
+class ProjectTree(object):
+    """
+    Process wide index of the project hierarchy, as parent pointers
+    plus the children and depth of each project.
+
+    The whole tree is loaded with a single project listing and reloaded
+    after PROJECT_TREE_CACHE_TIME seconds, or when asked about a project
+    it doesn't know, at most once every MISS_RELOAD_INTERVAL seconds
+    (callers ask Keystone about the project itself otherwise). Projects
+    created through Adjutant are added as they are created. Ancestor
+    queries walk the parent pointers and descendant queries the
+    children, without calling Keystone.
+
+    Depth follows Keystone's parents listing, so a project directly
+    under its domain has a depth of 1.
+    """
+
+    MISS_RELOAD_INTERVAL = 30
+
+    def __init__(self, loader=None):
+        self._loader = loader or self._list_projects
+        self._lock = threading.Lock()
+        self._parents = {}
+        self._children = defaultdict(set)
+        self._depths = {}
+        self._misses = set()
+        self._expires = 0
+        self._loaded = 0
+
+    @staticmethod
+    def _list_projects():
+        return get_keystoneclient().projects.list()
+
+    def refresh(self):
+        projects = list(self._loader())
+        parents = {project.id: project.parent_id for project in projects}
+        children = defaultdict(set)
+        for project_id, parent_id in parents.items():
+            children[parent_id].add(project_id)
+
+        # walk down from the projects directly under their domains
+        depths = {}
+        layer = [project_id for project_id, parent_id in parents.items()
+                 if parent_id not in parents]
+        depth = 1
+        while layer:
+            next_layer = []
+            for project_id in layer:
+                depths[project_id] = depth
+                next_layer.extend(children.get(project_id, ()))
+            layer = next_layer
+            depth += 1
+
+        with self._lock:
+            self._parents = parents
+            self._children = children
+            self._depths = depths
+            self._misses = set()
+            self._loaded = time()
+            self._expires = self._loaded + settings.PROJECT_TREE_CACHE_TIME
+
+    def invalidate(self):
+        with self._lock:
+            self._expires = 0
+
+    def add(self, project_id, parent_id):
+        """Adds a newly created project to the tree."""
+        with self._lock:
+            self._parents[project_id] = parent_id
+            self._children[parent_id].add(project_id)
+            self._depths[project_id] = self._depths.get(parent_id, 0) + 1
+            self._misses.discard(project_id)
+
+    def __contains__(self, project_id):
+        if time() >= self._expires:
+            self.refresh()
+        if project_id not in self._parents and (
+                project_id not in self._misses) and (
+                time() >= self._loaded + self.MISS_RELOAD_INTERVAL):
+            # Possibly created outside of Adjutant since the last load.
+            self.refresh()
+            if project_id not in self._parents:
+                self._misses.add(project_id)
+        return project_id in self._parents
+
+    def ancestor_ids(self, project_id):
+        """
+        The ids of the projects above the given one, nearest first,
+        not including the domain.
+        """
+        if project_id not in self:
+            return None
+        ancestors = []
+        parent_id = self._parents[project_id]
+        while parent_id in self._parents:
+            ancestors.append(parent_id)
+            parent_id = self._parents[parent_id]
+        return ancestors
+
+    def descendant_ids(self, project_id):
+        """The ids of every project below the given one."""
+        if project_id not in self:
+            return None
+        descendants = []
+        layer = list(self._children.get(project_id, ()))
+        while layer:
+            descendants.extend(layer)
+            layer = [child for parent_id in layer
+                     for child in self._children.get(parent_id, ())]
+        return descendants
+
+    def depth(self, project_id):
+        if project_id not in self:
+            return None
+        return self._depths[project_id]
+
+
+project_tree = ProjectTree()
+
+
+class RequestCache(object):
+    """
+    Memoized identity reads for the lifetime of a single API request
+    or task stage.
+
+    Entries are grouped by namespace (the name of the IdentityManager
+    read method) so that writes can drop every entry they may affect.
+    """
+
+    def __init__(self):
+        self._data = defaultdict(dict)
+
+    def get(self, namespace, key):
+        return self._data[namespace][key]
+
+    def set(self, namespace, key, value):
+        self._data[namespace][key] = value
+
+    def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            self._data.pop(namespace, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+_request_local = threading.local()
+
+
+def get_request_cache():
+    """Returns the active RequestCache for this thread, or None."""
+    return getattr(_request_local, 'cache', None)
+
+
+def set_request_cache(cache):
+    """Sets (or with None, clears) the RequestCache for this thread."""
+    _request_local.cache = cache
+
+
+@contextmanager
+def request_cache(cache=None):
+    """
+    Context manager scoping memoized identity reads.
+
+    Nested uses share the outer cache, so a task stage run inside
+    an API request reuses the request cache. An explicit cache can be
+    passed in to share one across threads.
+    """
+    previous = get_request_cache()
+    current = cache or previous or RequestCache()
+    set_request_cache(current)
+    try:
+        yield current
+    finally:
+        set_request_cache(previous)
+
+
+# Share the request cache with any worker threads the request uses.
+register_context_propagator(
+    lambda: functools.partial(request_cache, get_request_cache()))
+
+
+# getargspec is deprecated on Python 3, and getfullargspec missing on 2.7
+_getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+
+
+def _cache_key(arg_spec, args, kwargs):
+    names = arg_spec.args
+    if len(args) > len(names) or any(name not in names for name in kwargs):
+        raise TypeError("Unexpected arguments.")
+    values = dict(zip(reversed(names), reversed(arg_spec.defaults or ())))
+    values.update(zip(names, args))
+    values.update(kwargs)
+    if len(values) < len(names):
+        raise TypeError("Missing arguments.")
+    # drop 'self', and use ids for any keystone resources passed in.
+    return tuple((name, getattr(values[name], 'id', values[name]))
+                 for name in names[1:])
+
+
+# Identical IdentityManager reads in progress at the same time share one
+# call to Keystone.
+identity_reads = SingleFlight('identity')
+
+
+def cached_read(func):
+    """
+    Memoizes an IdentityManager read in the active request cache, and
+    coalesces it with identical reads in progress in other threads.
+    Slow reads are hedged, if the keystone hedge_percentile is set.
+
+    Memoizing does nothing outside of a request_cache context.
+    """
+    namespace = func.__name__
+    arg_spec = _getargspec(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            key = _cache_key(arg_spec, args, kwargs)
+            hash(key)
+        except TypeError:
+            # unhashable (or invalid) arguments, so just don't cache.
+            return func(*args, **kwargs)
+        cache = get_request_cache()
+        if cache is not None:
+            try:
+                return cache.get(namespace, key)
+            except KeyError:
+                pass
+        value = identity_reads.do(
+            namespace, key, dependencies.get_hedger('keystone').call,
+            namespace, func, *args, **kwargs)
+        if cache is not None:
+            cache.set(namespace, key, value)
+        return value
+    return wrapper
+
+
+def invalidates(*namespaces):
+    """
+    Drops the given read namespaces from the active request cache, and
+    stops later reads joining those in progress, once the decorated
+    IdentityManager write has run.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                identity_reads.forget(*namespaces)
+                cache = get_request_cache()
+                if cache is not None:
+                    cache.invalidate(*namespaces)
+        return wrapper
+    return decorator
+
+
+# A user's role assignments on a project, with the roles as ids into
+# the role catalog rather than role objects, as large projects can have
+# many thousands of them.
+def _resolve_roles(role_ids):
+    """
+    The roles with the given ids, leaving out any deleted since their
+    assignments were listed.
+    """
+    return [role for role in map(role_catalog.get, role_ids) if role]
+
+
+UserAssignments = namedtuple(
+    'UserAssignments',
+    ['user_id', 'domain_id', 'role_ids', 'inherited_role_ids'])
+
+
+_USER_READS = ('find_user', 'get_user')
+_ROLE_READS = ('get_roles', 'get_project_roles', 'get_all_roles',
+               'list_user_assignments', 'list_inherited_user_assignments')
+_PROJECT_READS = ('find_project', 'get_project')
+
+
 # NOTE(adriant): I'm adding no cover here since this class can never be covered
 # by unit and non-tempest functional tests. This class only works when talking
 # to a real Keystone, so tests can never cover it.
+@dependencies.instrumented('keystone')
 class IdentityManager(object):  # pragma: no cover
     """
     A wrapper object for the Keystone Client. Mainly setup as
@@ -64,22 +879,42 @@ class IdentityManager(object):  # pragma: no cover
         self.can_edit_users = settings.KEYSTONE.get('can_edit_users', True)
 
     def validate_token(self, token):
-        try:
-            return self.ks_client.tokens.validate(token, include_catalog=False)
-        except ks_exceptions.NotFound:
-            return None
+        token_data = token_cache.get(token)
+        if token_data is None:
+            try:
+                token_data = self.ks_client.tokens.validate(
+                    token, include_catalog=False)
+            except ks_exceptions.NotFound:
+                return None
+            token_cache.add(token, token_data)
+        return token_data
+
+    @cached_read
+    def find_user(self, name, domain, use_filter=False, fresh=False):
+        """
+        Finds a user by name in the domain, or returns None.
 
-    def find_user(self, name, domain):
+        Names recently found to be absent aren't looked up again, and
+        with use_filter the domain's name filter is checked as well.
+        Both can miss names created since, so checks that a name is free
+        before creating it pass fresh to always ask Keystone.
+        """
+        if not fresh and (
+                negative_lookups.is_absent('user', domain, name)
+                or (use_filter
+                    and name_filters.is_absent('user', domain, name))):
+            return None
         try:
             users = self.ks_client.users.list(name=name, domain=domain)
             if users:
                 # NOTE(adriant) usernames are unique in a domain
                 return users[0]
-            else:
-                return None
         except ks_exceptions.NotFound:
-            return None
+            pass
+        negative_lookups.add('user', domain, name)
+        return None
 
+    @cached_read
     def get_user(self, user_id):
         try:
             user = self.ks_client.users.get(user_id)
@@ -96,139 +931,203 @@ class IdentityManager(object):  # pragma: no cover
         endpoint so we can also fetch all the roles for those users
         in the given project. Saves further api calls later on.
         """
-        try:
-            roles = self.ks_client.roles.list()
-            role_dict = {role.id: role for role in roles}
-
-            users = {}
+        assignments = self.list_user_assignments(project)
+        users = self.get_users(assignments)
+        for user, user_assignments in zip(
+                users, _matching(assignments, users)):
+            user.roles = _resolve_roles(user_assignments.role_ids)
+            user.inherited_roles = _resolve_roles(
+                user_assignments.inherited_role_ids)
+        return users
 
+    @cached_read
+    def list_user_assignments(self, project):
+        """
+        Lists the UserAssignments of each user on the project, ordered
+        by user id, from a single listing of the project's assignments.
+        """
+        user_domains = {}
+        roles = defaultdict(list)
+        inherited_roles = defaultdict(list)
+        try:
             user_assignments = self.ks_client.role_assignments.list(
-                project=project)
+                project=project, include_names=True)
             for assignment in user_assignments:
                 try:
-                    user = users.get(assignment.user['id'], None)
-                    if not user:
-                        user = self.ks_client.users.get(
-                            assignment.user['id'])
-                        user.roles = []
-                        user.inherited_roles = []
-                        users[user.id] = user
-
-                    if assignment.scope.get('OS-INHERIT:inherited_to'):
-                        user.inherited_roles.append(
-                            role_dict[assignment.role['id']])
-                    else:
-                        user.roles.append(role_dict[assignment.role['id']])
+                    user_id = assignment.user['id']
                 except AttributeError:
                     # Just means the assignment is a group, so ignore it.
-                    pass
+                    continue
+                user_domains[user_id] = assignment.user.get(
+                    'domain', {}).get('id')
+
+                if assignment.scope.get('OS-INHERIT:inherited_to'):
+                    inherited_roles[user_id].append(assignment.role['id'])
+                else:
+                    roles[user_id].append(assignment.role['id'])
         except ks_exceptions.NotFound:
             return []
-        return users.values()
 
-    def list_inherited_users(self, project):
+        return [UserAssignments(user_id, user_domains[user_id],
+                                tuple(roles[user_id]),
+                                tuple(inherited_roles[user_id]))
+                for user_id in sorted(user_domains)]
+
+    def get_users(self, assignments):
         """
-        Find all the users whose roles are inherited down to the given project.
+        Resolves the users of a list of UserAssignments, in the same
+        order, leaving out any that no longer exist.
+
+        The users are fetched by id, concurrently on the bounded pool,
+        rather than by listing their domains, which can hold far more
+        users than are wanted (and be truncated by Keystone's list_limit).
         """
+        user_ids = OrderedDict.fromkeys(
+            user_assignments.user_id for user_assignments in assignments)
+        return [user for user in run_concurrently(
+            self._get_user_or_none, user_ids) if user]
+
+    def get_role(self, role_id):
+        return role_catalog.get(role_id)
+
+    def _get_user_or_none(self, user_id):
         try:
-            roles = self.ks_client.roles.list()
-            role_dict = {role.id: role for role in roles}
-
-            users = {}
-
-            project = self.ks_client.projects.get(project)
-            while project.parent_id:
-                project = self.ks_client.projects.get(project.parent_id)
-                user_assignments = self.ks_client.role_assignments.list(
-                    project=project)
-                for assignment in user_assignments:
-                    if not assignment.scope.get('OS-INHERIT:inherited_to'):
-                        continue
-                    try:
-                        user = users.get(
-                            assignment.user['id'], None)
-                        if user:
-                            user.roles.append(
-                                role_dict[assignment.role['id']])
-                        else:
-                            user = self.ks_client.users.get(
-                                assignment.user['id'])
-                            user.roles = [
-                                role_dict[assignment.role['id']], ]
-                            user.inherited_roles = []
-                            users[user.id] = user
-                    except AttributeError:
-                        # Just means the assignment is a group.
-                        pass
-            for user_id, user in users.items():
-                user.roles = list(set(user.roles))
+            return self.ks_client.users.get(user_id)
         except ks_exceptions.NotFound:
+            return None
+
+    def list_inherited_users(self, project):
+        """
+        Find all the users whose roles are inherited down to the given project.
+        """
+        assignments = self.list_inherited_user_assignments(project)
+        users = self.get_users(assignments)
+        for user, user_assignments in zip(
+                users, _matching(assignments, users)):
+            user.roles = _resolve_roles(user_assignments.role_ids)
+            user.inherited_roles = []
+        return users
+
+    @cached_read
+    def list_inherited_user_assignments(self, project):
+        """
+        Lists the UserAssignments of each user whose roles are inherited
+        down to the project, ordered by user id, with the inherited roles
+        as their role_ids.
+
+        The ancestors come from the project tree and their assignments
+        are listed concurrently.
+        """
+        parent_ids = self._parent_ids(getattr(project, 'id', project))
+        if parent_ids is None:
             return []
-        return users.values()
+        assignment_lists = run_concurrently(
+            self._list_inherited_assignments, parent_ids)
+
+        user_domains = {}
+        roles = defaultdict(OrderedDict)
+        for user_assignments in assignment_lists:
+            for assignment in user_assignments:
+                try:
+                    user_id = assignment.user['id']
+                except AttributeError:
+                    # Just means the assignment is a group.
+                    continue
+                user_domains[user_id] = assignment.user.get(
+                    'domain', {}).get('id')
+                if role_catalog.get(assignment.role['id']):
+                    roles[user_id][assignment.role['id']] = None
 
+        return [UserAssignments(user_id, user_domains[user_id],
+                                tuple(roles[user_id]), ())
+                for user_id in sorted(user_domains)]
+
+    def _list_inherited_assignments(self, project_id):
+        user_assignments = self.ks_client.role_assignments.list(
+            project=project_id, include_names=True,
+            os_inherit_extension_inherited_to='projects')
+        return [assignment for assignment in user_assignments
+                if assignment.scope.get('OS-INHERIT:inherited_to')]
+
+    @invalidates(*_USER_READS)
     def create_user(self, name, password, email, created_on, domain=None,
                     default_project=None):
 
         user = self.ks_client.users.create(
             name=name, password=password, domain=domain, email=email,
             default_project=default_project, created_on=created_on)
+        _record_name('user', name, user.domain_id)
         return user
 
+    @invalidates(*_USER_READS)
     def enable_user(self, user):
         self.ks_client.users.update(user, enabled=True)
 
+    @invalidates(*_USER_READS)
     def disable_user(self, user):
         self.ks_client.users.update(user, enabled=False)
 
+    @invalidates(*_USER_READS)
     def update_user_password(self, user, password):
         self.ks_client.users.update(user, password=password)
 
+    @invalidates(*_USER_READS)
     def update_user_email(self, user, email):
         self.ks_client.users.update(user, email=email)
 
+    @invalidates(*_USER_READS)
     def update_user_name(self, user, name):
         self.ks_client.users.update(user, name=name)
+        _record_name('user', name, getattr(user, 'domain_id', None))
 
     def find_role(self, name):
-        try:
-            role = self.ks_client.roles.find(name=name)
-        except ks_exceptions.NotFound:
-            role = None
-        return role
+        return role_catalog.find(name)
 
+    @cached_read
     def get_roles(self, user, project, inherited=False):
-        roles = self.ks_client.roles.list()
-        role_dict = {role.id: role for role in roles}
+        roles, inherited_roles = self.get_project_roles(user, project)
+        return inherited_roles if inherited else roles
 
-        user_roles = []
+    @cached_read
+    def get_project_roles(self, user, project):
+        """
+        Returns the user's direct and inherited roles on the project,
+        as (roles, inherited_roles), from one listing of assignments.
+        """
+        roles = []
+        inherited_roles = []
         user_assignments = self.ks_client.role_assignments.list(
             user=user, project=project)
         for assignment in user_assignments:
-            if (assignment.scope.get('OS-INHERIT:inherited_to') and not
-                    inherited) or (
-                        inherited and not
-                        assignment.scope.get('OS-INHERIT:inherited_to')):
+            role = role_catalog.get(assignment.role['id'])
+            if role is None:
+                # deleted since the assignment was listed
                 continue
-            user_roles.append(role_dict[assignment.role['id']])
-        return user_roles
+            if assignment.scope.get('OS-INHERIT:inherited_to'):
+                inherited_roles.append(role)
+            else:
+                roles.append(role)
+        return roles, inherited_roles
 
+    @cached_read
     def get_all_roles(self, user):
         """
         Returns roles for a given user across all projects.
 
         Uses the new v3 assignments api method to quickly do this.
         """
-        roles = self.ks_client.roles.list()
-        role_dict = {role.id: role for role in roles}
-
         user_assignments = self.ks_client.role_assignments.list(user=user)
         projects = defaultdict(list)
         for assignment in user_assignments:
-            project = assignment.scope['project']['id']
-            projects[project].append(role_dict[assignment.role['id']])
+            role = role_catalog.get(assignment.role['id'])
+            if role is None:
+                # deleted since the assignment was listed
+                continue
+            projects[assignment.scope['project']['id']].append(role)
 
         return projects
 
+    @invalidates(*_ROLE_READS)
     def add_user_role(self, user, role, project, inherited=False):
         try:
             if inherited:
@@ -241,6 +1140,7 @@ class IdentityManager(object):  # pragma: no cover
             # Conflict is ok, it means the user already has this role.
             pass
 
+    @invalidates(*_ROLE_READS)
     def remove_user_role(self, user, role, project, inherited=False):
         if inherited:
             self.ks_client.roles.revoke(
@@ -249,7 +1149,41 @@ class IdentityManager(object):  # pragma: no cover
         else:
             self.ks_client.roles.revoke(role, user=user, project=project)
 
-    def find_project(self, project_name, domain):
+    def add_user_roles(self, assignments):
+        """
+        Grants each (user, role, project, inherited) assignment, making
+        the calls concurrently.
+
+        Returns a list in the same order as the assignments, of None
+        for each role granted (or already held) and the exception for
+        each that failed.
+        """
+        return self._edit_user_roles(self.add_user_role, assignments)
+
+    def remove_user_roles(self, assignments):
+        """
+        Revokes each (user, role, project, inherited) assignment, making
+        the calls concurrently, with results as for add_user_roles.
+        """
+        return self._edit_user_roles(self.remove_user_role, assignments)
+
+    def _edit_user_roles(self, edit, assignments):
+        def run(assignment):
+            user, role, project, inherited = assignment
+            try:
+                edit(user, role, project, inherited=inherited)
+            except Exception as e:
+                return e
+        return run_concurrently(run, assignments)
+
+    @cached_read
+    def find_project(self, project_name, domain, use_filter=False,
+                     fresh=False):
+        if not fresh and (
+                negative_lookups.is_absent('project', domain, project_name)
+                or (use_filter and name_filters.is_absent(
+                    'project', domain, project_name))):
+            return None
         try:
             # Using a filtered list as find is more efficient than
             # using the client find
@@ -260,35 +1194,56 @@ class IdentityManager(object):  # pragma: no cover
                 # it is safe to assume filtering on project name and domain
                 # will only ever return one.
                 return projects[0]
-            else:
-                return None
         except ks_exceptions.NotFound:
-            return None
+            pass
+        negative_lookups.add('project', domain, project_name)
+        return None
 
+    @cached_read
     def get_project(self, project_id, subtree_as_ids=False,
                     parents_as_ids=False):
+        try:
+            project = self.ks_client.projects.get(project_id)
+        except ks_exceptions.NotFound:
+            return None
+
+        if parents_as_ids:
+            parent_ids = self._parent_ids(project.id) or []
+            project.parent_ids = parent_ids
+            project.root = parent_ids[-1] if parent_ids else None
+            project.depth = len(parent_ids) + 1
+        if subtree_as_ids:
+            subtree_ids = project_tree.descendant_ids(project.id)
+            if subtree_ids is None:
+                subtree_ids = subtree_ids_list(self.ks_client.projects.get(
+                    project_id, subtree_as_ids=True).subtree)
+            project.subtree_ids = subtree_ids
+        return project
+
+    def _parent_ids(self, project_id):
+        """
+        The ids of the projects above the given one, nearest first and
+        not including the domain, or None if it doesn't exist.
+        """
+        parent_ids = project_tree.ancestor_ids(project_id)
+        if parent_ids is not None:
+            return parent_ids
+        # NOTE: only if missing from the tree, so just ask keystone
+        # rather than fail.
         try:
             project = self.ks_client.projects.get(
-                project_id, subtree_as_ids=subtree_as_ids,
-                parents_as_ids=parents_as_ids)
-            if parents_as_ids:
-                depth = 1
-                last_root = None
-                root = project.parents.keys()[0]
-                value = project.parents.values()[0]
-                while value is not None:
-                    depth += 1
-                    last_root = root
-                    root = value.keys()[0]
-                    value = value.values()[0]
-                project.root = last_root
-                project.depth = depth
-                project.parent_ids = subtree_ids_list(project.parents)
-            if subtree_as_ids:
-                project.subtree_ids = subtree_ids_list(project.subtree)
-            return project
+                project_id, parents_as_ids=True)
         except ks_exceptions.NotFound:
             return None
+        parents = project.parents or {}
+        parent_ids = []
+        while parents:
+            parent_id, parents = next(iter(parents.items()))
+            parent_ids.append(parent_id)
+        # keystone ends the chain with the domain, which the tree leaves out
+        if parent_ids and parent_ids[-1] == project.domain_id:
+            parent_ids.pop()
+        return parent_ids
 
     def list_sub_projects(self, project_id):
         try:
@@ -296,49 +1251,53 @@ class IdentityManager(object):  # pragma: no cover
         except ks_exceptions.NotFound:
             return []
 
+    @invalidates(*_PROJECT_READS)
     def update_project(self, project, name=None, domain=None, description=None,
                        enabled=None, **kwargs):
         try:
-            return self.ks_client.projects.update(
+            project = self.ks_client.projects.update(
                 project=project, domain=domain, name=name,
                 description=description, enabled=enabled,
                 **kwargs)
         except ks_exceptions.NotFound:
             return None
+        if name:
+            _record_name('project', name, project.domain_id)
+        return project
 
+    @invalidates(*_PROJECT_READS)
     def create_project(self, project_name, created_on, parent=None,
                        domain=None, description=""):
         project = self.ks_client.projects.create(
             project_name, domain, parent=parent, created_on=created_on,
             description=description)
+        _record_name('project', project_name, project.domain_id)
+        project_tree.add(project.id, project.parent_id)
         return project
 
     def get_domain(self, domain_id):
-        try:
-            return self.ks_client.domains.get(domain_id)
-        except ks_exceptions.NotFound:
-            return None
+        return topology.get_domain(domain_id)
 
     def find_domain(self, domain_name):
-        try:
-            domains = self.ks_client.domains.list(name=domain_name)
-            if domains:
-                # NOTE(adriant) domain names are unique
-                return domains[0]
-            else:
-                return None
-        except ks_exceptions.NotFound:
-            return None
+        # NOTE(adriant) domain names are unique
+        return topology.find_domain(domain_name)
 
     def get_region(self, region_id):
-        try:
-            region = self.ks_client.regions.get(region_id)
-        except ks_exceptions.NotFound:
-            region = None
-        return region
+        return topology.get_region(region_id)
 
     def list_regions(self, **kwargs):
-        return self.ks_client.regions.list(**kwargs)
+        if kwargs:
+            # filtered listings are rare, so are left to keystone.
+            return self.ks_client.regions.list(**kwargs)
+        return topology.list_regions()
+
+    def refresh_topology(self):
+        """
+        Reloads the cached regions and domains from keystone,
+        returning them as (regions, domains).
+        """
+        topology.refresh(force=True)
+        return topology.list_regions(), topology.list_domains()
 
     def list_credentials(self, user_id, cred_type=None):
         return self.ks_client.credentials.list(
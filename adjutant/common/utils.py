@@ -12,7 +12,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import binascii
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+import hashlib
+from logging import getLogger
+import math
+import threading
+from time import sleep, time
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
 
 from adjutant.common import constants
 
@@ -22,3 +34,230 @@ def str_datetime(datetime_obj, include_ms=False):
         return datetime.strftime(datetime_obj, constants.DATE_FORMAT_MS)
     else:
         return datetime.strftime(datetime_obj, constants.DATE_FORMAT)
+
+
+# Functions called in the requesting thread that capture any thread local
+# state (such as the identity request cache), returning a factory for a
+# context manager that restores that state inside a worker thread.
+_context_propagators = []
+
+
+def register_context_propagator(capture):
+    _context_propagators.append(capture)
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    A ThreadPoolExecutor whose calls run with the thread local state
+    of the thread that submitted them.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        contexts = [capture() for capture in _context_propagators]
+        return super(ContextThreadPoolExecutor, self).submit(
+            _call_within, contexts, fn, *args, **kwargs)
+
+
+def _call_within(contexts, fn, *args, **kwargs):
+    """Calls fn within each of the (factories of) context managers."""
+    if not contexts:
+        return fn(*args, **kwargs)
+    with contexts[0]():
+        return _call_within(contexts[1:], fn, *args, **kwargs)
+
+
+@contextmanager
+def concurrent_executor(max_workers=None):
+    """
+    Context manager for a bounded ContextThreadPoolExecutor.
+
+    Unlike the executor's own context manager, exiting does not wait on
+    calls still running, so a timed out call doesn't hold the request.
+    """
+    executor = ContextThreadPoolExecutor(
+        max_workers=max_workers or settings.MAX_CONCURRENT_REQUESTS)
+    try:
+        yield executor
+    finally:
+        executor.shutdown(wait=False)
+
+
+def wait_for_results(futures, timeout=None):
+    """
+    Returns the results of the given futures, in order.
+
+    The timeout applies from the start of the wait to every future, and
+    a concurrent.futures.TimeoutError is raised once it has passed.
+    """
+    if timeout is None:
+        return [future.result() for future in futures]
+    end = time() + timeout
+    return [future.result(timeout=max(0, end - time()))
+            for future in futures]
+
+
+def run_concurrently(func, items, max_workers=None, timeout=None):
+    """
+    Calls func once per item on a bounded pool of threads.
+
+    Returns the results in the same order as the items. The first
+    exception raised by a call is re-raised here.
+    """
+    items = list(items)
+    max_workers = min(
+        max_workers or settings.MAX_CONCURRENT_REQUESTS, len(items))
+    if max_workers <= 1:
+        return [func(item) for item in items]
+
+    with concurrent_executor(max_workers) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        return wait_for_results(futures, timeout)
+
+
+class _Flight(object):
+    """A call in progress, and its outcome once done."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent identical calls, so the first to start (the
+    leader) makes the call and the others share its result or error.
+
+    Calls are identified by a namespace and a key within it. Only calls
+    in progress are shared, and forgetting a namespace (such as after a
+    write to what it reads) makes later calls start afresh.
+
+    With SINGLEFLIGHT_LOCK_STORE set to one of the CACHES, calls with
+    shared=True are also coalesced across workers: the leader holds a
+    lock in the store and leaves its result there for the others, who
+    make the call themselves if it doesn't arrive within
+    SINGLEFLIGHT_WAIT seconds. Those results must be picklable.
+    """
+
+    # seconds between checks for another worker's result
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, namespace, key, func, *args, **kwargs):
+        shared = kwargs.pop('shared', False)
+        with self._lock:
+            flight = self._flights.get((namespace, key))
+            leader = flight is None
+            if leader:
+                flight = self._flights[(namespace, key)] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            if shared and settings.SINGLEFLIGHT_LOCK_STORE:
+                flight.result = self._do_shared(
+                    namespace, key, func, *args, **kwargs)
+            else:
+                flight.result = func(*args, **kwargs)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get((namespace, key)) is flight:
+                    del self._flights[(namespace, key)]
+            flight.done.set()
+
+    def forget(self, *namespaces):
+        """
+        Stops later calls in the namespaces joining those in progress
+        in this worker.
+        """
+        with self._lock:
+            for flight_key in [k for k in self._flights
+                               if k[0] in namespaces]:
+                del self._flights[flight_key]
+
+    def _store_key(self, kind, namespace, key):
+        digest = hashlib.sha256(
+            repr((namespace, key)).encode('utf-8')).hexdigest()
+        return "singleflight:%s:%s:%s" % (self.name, kind, digest)
+
+    def _do_shared(self, namespace, key, func, *args, **kwargs):
+        store = caches[settings.SINGLEFLIGHT_LOCK_STORE]
+        wait = settings.SINGLEFLIGHT_WAIT
+        lock_key = self._store_key('lock', namespace, key)
+        token = uuid4().hex
+
+        end = time() + wait
+        leader_token = None
+        while True:
+            if leader_token is not None:
+                result = store.get(self._store_key(
+                    'result:' + leader_token, namespace, key))
+                if result is not None:
+                    return result[0]
+            if store.add(lock_key, token, wait):
+                break
+            leader_token = store.get(lock_key, leader_token)
+            if time() >= end:
+                # the other worker is too slow, so don't wait on it.
+                return func(*args, **kwargs)
+            sleep(self.POLL_INTERVAL)
+
+        try:
+            result = func(*args, **kwargs)
+            try:
+                store.set(
+                    self._store_key('result:' + token, namespace, key),
+                    (result,), wait)
+            except Exception as e:
+                getLogger('adjutant').debug(
+                    "Couldn't share the result of %s %s: %s"
+                    % (namespace, key, e))
+            return result
+        finally:
+            store.delete(lock_key)
+
+
+class BloomFilter(object):
+    """
+    Probabilistic set of strings.
+
+    Membership tests can give false positives (at roughly error_rate
+    once capacity items are added), but never false negatives, so a
+    miss means the item was definitely never added.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(
+            float(self.size) / capacity * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # double hashing, with both halves of one digest
+        digest = hashlib.sha256(item.encode('utf-8')).digest()
+        first = int(binascii.hexlify(digest[:8]), 16)
+        second = int(binascii.hexlify(digest[8:16]), 16) | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, item):
+        return all(self._bits[position // 8] & (1 << (position % 8))
+                   for position in self._positions(item))
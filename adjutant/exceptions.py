@@ -36,3 +36,11 @@ class SerializerMissingException(BaseException):
 
 class ConfirmationException(BaseException):
     """ Missing or incorrect configuration value. """
+
+
+class DependencyUnavailable(BaseException):
+    """ An external service is failing and calls to it are short circuited. """
+
+
+class DeadlineExceeded(BaseException):
+    """ The request ran out of time before an external service answered. """
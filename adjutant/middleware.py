@@ -12,10 +12,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import math
+import os
+import threading
 from time import time
 from logging import getLogger
+from django.conf import settings
+from django.http import JsonResponse
 from django.utils import timezone
 
+from adjutant.common import dependencies, user_store
+from adjutant.common.cache import MemcacheClient
+from adjutant.exceptions import DeadlineExceeded, DependencyUnavailable
+
 
 class KeystoneHeaderUnwrapper(object):
     """
@@ -38,6 +47,14 @@ class KeystoneHeaderUnwrapper(object):
             token_data = {}
         request.keystone_user = token_data
 
+        # Remember the token keystonemiddleware validated, so actions
+        # handed the same token don't validate it again.
+        token = request.META.get('HTTP_X_AUTH_TOKEN')
+        token_info = request.META.get('keystone.token_info')
+        if (token and token_info and 'token' in token_info
+                and request.META.get('HTTP_X_IDENTITY_STATUS') == 'Confirmed'):
+            user_store.token_cache.add(token, token_info['token'])
+
 
 class TestingHeaderUnwrapper(object):
     """
@@ -66,10 +83,72 @@ class TestingHeaderUnwrapper(object):
         request.keystone_user = token_data
 
 
+class IdentityCacheMiddleware(object):
+    """
+    Middleware to scope memoized identity reads to a single request,
+    so repeated Keystone lookups within it are only made once.
+    """
+
+    def process_request(self, request):
+        user_store.set_request_cache(user_store.RequestCache())
+
+    def process_response(self, request, response):
+        user_store.set_request_cache(None)
+        return response
+
+
+class RequestDeadlineMiddleware(object):
+    """
+    Middleware to give each request a deadline, from REQUEST_DEADLINES
+    by the name of the view handling it, that the calls it makes to
+    external services are held to. A request still waiting on them once
+    its deadline passes gets a 504.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view = getattr(view_func, 'cls', view_func)
+        deadlines = settings.REQUEST_DEADLINES
+        seconds = deadlines.get(
+            getattr(view, '__name__', None), deadlines.get('default'))
+        dependencies.set_deadline(time() + seconds if seconds else None)
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, DeadlineExceeded):
+            getLogger('adjutant').warning(
+                '(%s) - Deadline exceeded for [%s]: %s',
+                timezone.now(), request.get_full_path(), exception)
+            return JsonResponse({'errors': [str(exception)]}, status=504)
+
+    def process_response(self, request, response):
+        dependencies.set_deadline(None)
+        return response
+
+
+class DependencyUnavailableMiddleware(object):
+    """
+    Middleware to answer requests that needed an external service whose
+    calls are being short circuited with a 503, and a Retry-After of
+    when calls to it will be let through again.
+    """
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, DependencyUnavailable):
+            getLogger('adjutant').warning(
+                '(%s) - Dependency unavailable for [%s]: %s',
+                timezone.now(), request.get_full_path(), exception)
+            response = JsonResponse(
+                {'errors': [str(exception)]}, status=503)
+            retry_after = getattr(exception, 'retry_after', None)
+            if retry_after:
+                response['Retry-After'] = str(int(math.ceil(retry_after)))
+            return response
+
+
 class RequestLoggingMiddleware(object):
     """
     Middleware to log the requests and responses.
-    Will time the duration of a request and log that.
+    Will time the duration of a request and log that, along with
+    the calls it made to external services.
     """
 
     def __init__(self):
@@ -84,17 +163,108 @@ class RequestLoggingMiddleware(object):
             request.get_full_path()
         )
         request.timer = time()
+        dependencies.set_request_calls([])
 
     def process_response(self, request, response):
         if hasattr(request, 'timer'):
             time_delta = time() - request.timer
         else:
             time_delta = -1
+        calls = dependencies.get_request_calls() or []
+        dependencies.set_request_calls(None)
         self.logger.info(
-            '(%s) - <%s> [%s] - (%.1fs)',
+            '(%s) - <%s> [%s] - (%.1fs)%s',
             timezone.now(),
             response.status_code,
             request.get_full_path(),
-            time_delta
+            time_delta,
+            ' - {%s}' % ', '.join(dependencies.summarize_calls(calls))
+            if calls else ''
         )
         return response
+
+
+# The WSGI environ key keystonemiddleware finds the token cache under
+TOKEN_CACHE_ENVIRON = 'adjutant.token_cache'
+
+
+def auth_token_conf():
+    """
+    The conf for keystonemiddleware's AuthProtocol, which validates the
+    tokens of incoming requests.
+
+    Unless AUTH_TOKEN_CACHE turns it off, validated tokens are cached in
+    the shared cache tier, so a token is validated once for every worker
+    rather than once per worker, and can be protected with a
+    security_strategy of MAC (signed) or ENCRYPT using the secret_key.
+    """
+    conf = {
+        "auth_plugin": "password",
+        'username': settings.KEYSTONE['username'],
+        'password': settings.KEYSTONE['password'],
+        'project_name': settings.KEYSTONE['project_name'],
+        "project_domain_id": settings.KEYSTONE.get('domain_id', "default"),
+        "user_domain_id": settings.KEYSTONE.get('domain_id', "default"),
+        "auth_url": settings.KEYSTONE['auth_url'],
+        'delay_auth_decision': True,
+        'include_service_catalog': False,
+        'token_cache_time': settings.TOKEN_CACHE_TIME,
+    }
+    cache_conf = settings.AUTH_TOKEN_CACHE
+    if cache_conf.get('shared', True):
+        conf['cache'] = TOKEN_CACHE_ENVIRON
+    if cache_conf.get('security_strategy'):
+        conf['memcache_security_strategy'] = cache_conf['security_strategy']
+        conf['memcache_secret_key'] = cache_conf.get('secret_key')
+    return conf
+
+
+class SharedTokenCache(object):
+    """
+    WSGI middleware, wrapped around AuthProtocol, handing it the shared
+    token cache, which reports its hits and misses as 'auth_token'.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.cache = MemcacheClient('auth_token')
+
+    def __call__(self, environ, start_response):
+        environ.setdefault(TOKEN_CACHE_ENVIRON, self.cache)
+        return self.application(environ, start_response)
+
+
+class ProcessStartup(object):
+    """
+    WSGI middleware running the given callables (such as starting
+    background threads) once in each process, on its first request.
+
+    Preforking servers import the application before forking, and the
+    forked workers don't inherit threads started then, so anything per
+    process is started here instead of when the module is imported.
+    """
+
+    def __init__(self, application, *callables):
+        self.application = application
+        self.callables = callables
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            for func in self.callables:
+                try:
+                    func()
+                except Exception as e:
+                    getLogger('adjutant').exception(
+                        "Failed to start %s: %s" % (func.__name__, e))
+            self._pid = pid
+
+    def __call__(self, environ, start_response):
+        self._started()
+        return self.application(environ, start_response)
@@ -16,11 +16,12 @@ from logging import getLogger
 from smtplib import SMTPException
 
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.template import loader
 from django.utils import timezone
 
 from adjutant.api.models import Notification
+from adjutant.common import dependencies
 
 
 class NotificationEngine(object):
@@ -134,7 +135,10 @@ class EmailNotification(NotificationEngine):
                 email.attach_alternative(
                     html_template.render(context), "text/html")
 
-            email.send(fail_silently=False)
+            with dependencies.within_deadline(
+                    'smtp', settings.EMAIL_TIMEOUT) as timeout:
+                email.connection = get_connection(timeout=timeout)
+                email.send(fail_silently=False)
             if not notification.error:
                 notification.acknowledged = True
                 notification.save()
@@ -55,6 +55,9 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'adjutant.middleware.KeystoneHeaderUnwrapper',
+    'adjutant.middleware.IdentityCacheMiddleware',
+    'adjutant.middleware.RequestDeadlineMiddleware',
+    'adjutant.middleware.DependencyUnavailableMiddleware',
     'adjutant.middleware.RequestLoggingMiddleware'
 )
 
@@ -131,11 +134,18 @@ INSTALLED_APPS.append("adjutant.startup")
 
 DATABASES = CONFIG['DATABASES']
 
+# Django's default of a single local memory cache, if not set
+CACHES = CONFIG.get('CACHES', {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+})
+
 LOGGING = CONFIG['LOGGING']
 
 
 EMAIL_BACKEND = CONFIG['EMAIL_SETTINGS']['EMAIL_BACKEND']
-EMAIL_TIMEOUT = 60
+EMAIL_TIMEOUT = CONFIG['EMAIL_SETTINGS'].get('EMAIL_TIMEOUT', 60)
 
 EMAIL_HOST = CONFIG['EMAIL_SETTINGS'].get('EMAIL_HOST')
 EMAIL_PORT = CONFIG['EMAIL_SETTINGS'].get('EMAIL_PORT')
@@ -177,6 +187,74 @@ ROLES_MAPPING = CONFIG['ROLES_MAPPING']
 
 TOKEN_CACHE_TIME = CONFIG.get('TOKEN_CACHE_TIME', 60)
 
+# time in seconds the Keystone role catalog is held in memory
+ROLE_CACHE_TIME = CONFIG.get('ROLE_CACHE_TIME', 300)
+
+# upper bound on the threads a single request uses for concurrent
+# calls to Keystone and other services
+MAX_CONCURRENT_REQUESTS = CONFIG.get('MAX_CONCURRENT_REQUESTS', 8)
+
+# time in seconds to wait on each concurrently fetched source of data
+CONCURRENT_REQUEST_TIMEOUT = CONFIG.get('CONCURRENT_REQUEST_TIMEOUT', 30)
+
+# time in seconds endpoints looked up in the service catalog are reused
+ENDPOINT_CACHE_TIME = CONFIG.get('ENDPOINT_CACHE_TIME', 600)
+
+# time in seconds the Keystone regions and domains are answered from
+# memory, and how often they are reloaded in the background (0 disables)
+TOPOLOGY_CACHE_TIME = CONFIG.get('TOPOLOGY_CACHE_TIME', 600)
+TOPOLOGY_REFRESH_INTERVAL = CONFIG.get('TOPOLOGY_REFRESH_INTERVAL', 300)
+
+# time in seconds user and project names Keystone has no match for are
+# remembered as absent (0 disables), and the most remembered per domain
+NEGATIVE_LOOKUP_CACHE_TIME = CONFIG.get('NEGATIVE_LOOKUP_CACHE_TIME', 30)
+NEGATIVE_LOOKUP_CACHE_SIZE = CONFIG.get('NEGATIVE_LOOKUP_CACHE_SIZE', 10000)
+
+# interval in seconds at which the per domain filters of user and
+# project names are rebuilt (0 disables the filters)
+NAME_FILTER_REBUILD_INTERVAL = CONFIG.get('NAME_FILTER_REBUILD_INTERVAL', 0)
+
+# time in seconds the project hierarchy is indexed in memory before
+# being loaded again
+PROJECT_TREE_CACHE_TIME = CONFIG.get('PROJECT_TREE_CACHE_TIME', 600)
+
+# time in seconds a project's assembled user list is cached for (0
+# disables), on top of being invalidated by changes through Adjutant
+USER_LIST_CACHE_TIME = CONFIG.get('USER_LIST_CACHE_TIME', 10)
+
+# number of users resolved from Keystone at a time when streaming
+# the project user list
+USER_LIST_BATCH_SIZE = CONFIG.get('USER_LIST_BATCH_SIZE', 100)
+
+# transport (and its options) to read Keystone's notifications from, to
+# invalidate the identity caches as soon as things change in Keystone
+IDENTITY_NOTIFICATIONS = CONFIG.get('IDENTITY_NOTIFICATIONS', {})
+
+# cache (of CACHES) used to share quota reads between workers, and the
+# seconds a worker waits on another's read before making its own
+SINGLEFLIGHT_LOCK_STORE = CONFIG.get('SINGLEFLIGHT_LOCK_STORE', None)
+SINGLEFLIGHT_WAIT = CONFIG.get('SINGLEFLIGHT_WAIT', 10)
+
+# cache (of CACHES) holding the role, topology, user list and quota
+# caches, and the seconds quota and usage reads are cached for
+SHARED_CACHE = CONFIG.get('SHARED_CACHE', 'default')
+QUOTA_CACHE_TIME = CONFIG.get('QUOTA_CACHE_TIME', 0)
+
+# whether keystonemiddleware's token cache is the shared cache tier, and
+# how the cached tokens are protected
+AUTH_TOKEN_CACHE = CONFIG.get('AUTH_TOKEN_CACHE', {})
+
+# where the workers share the service token, and when it is refreshed
+SERVICE_TOKEN = CONFIG.get('SERVICE_TOKEN', {})
+
+# seconds a request may spend on calls to external services, by the
+# name of its view or 'default'
+REQUEST_DEADLINES = CONFIG.get('REQUEST_DEADLINES', {})
+
+# call timeouts and circuit breaker limits for the external services,
+# by service name, with a 'default' entry for any not set.
+DEPENDENCY_SETTINGS = CONFIG.get('DEPENDENCY_SETTINGS', {})
+
 PROJECT_QUOTA_SIZES = CONFIG.get('PROJECT_QUOTA_SIZES')
 
 QUOTA_SIZES_ASC = CONFIG.get('QUOTA_SIZES_ASC', [])
@@ -412,6 +412,9 @@ SHOW_ACTION_ENDPOINTS = True
 
 TOKEN_CACHE_TIME = 60
 
+# no background reloads of the region and domain cache in tests
+TOPOLOGY_REFRESH_INTERVAL = 0
+
 conf_dict = {
     "DEBUG": True,
     "SECRET_KEY": SECRET_KEY,
@@ -433,4 +436,5 @@ conf_dict = {
     "QUOTA_SIZES_ASC": QUOTA_SIZES_ASC,
     "TOKEN_CACHE_TIME": TOKEN_CACHE_TIME,
     "QUOTA_SERVICES": QUOTA_SERVICES,
+    "TOPOLOGY_REFRESH_INTERVAL": TOPOLOGY_REFRESH_INTERVAL,
 }
@@ -23,26 +23,24 @@ https://docs.djangoproject.com/en/1.8/howto/deployment/wsgi/
 
 import os
 from django.core.wsgi import get_wsgi_application
-from django.conf import settings
 from keystonemiddleware.auth_token import AuthProtocol
 
+from adjutant.common import identity_events, openstack_clients
+from adjutant import middleware
+
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "adjutant.settings")
 
 
 application = get_wsgi_application()
 
 # Here we replace the default application with one wrapped by
-# the Keystone Auth Middleware.
-conf = {
-    "auth_plugin": "password",
-    'username': settings.KEYSTONE['username'],
-    'password': settings.KEYSTONE['password'],
-    'project_name': settings.KEYSTONE['project_name'],
-    "project_domain_id": settings.KEYSTONE.get('domain_id', "default"),
-    "user_domain_id": settings.KEYSTONE.get('domain_id', "default"),
-    "auth_url": settings.KEYSTONE['auth_url'],
-    'delay_auth_decision': True,
-    'include_service_catalog': False,
-    'token_cache_time': settings.TOKEN_CACHE_TIME,
-}
-application = AuthProtocol(application, conf)
+# the Keystone Auth Middleware, sharing its token cache between workers.
+application = AuthProtocol(application, middleware.auth_token_conf())
+application = middleware.SharedTokenCache(application)
+
+# Once each worker process starts serving, invalidate the identity caches
+# from Keystone's notifications, if set up, and keep the service token
+# refreshed in the background.
+application = middleware.ProcessStartup(
+    application, identity_events.start_consumer,
+    openstack_clients.start_service_token_refresh)